@@ -1,6 +1,6 @@
 from django.apps import AppConfig
 from django.contrib.auth.signals import user_logged_out
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 
 
 class TrackingConfig(AppConfig):
@@ -14,3 +14,4 @@ class TrackingConfig(AppConfig):
         from tracking.models import Visitor
         user_logged_out.connect(handlers.track_ended_session)
         post_save.connect(handlers.post_save_cache, sender=Visitor)
+        post_delete.connect(handlers.post_delete_cache, sender=Visitor)
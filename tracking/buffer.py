@@ -0,0 +1,271 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.core.cache import cache
+from django.db import close_old_connections, transaction
+
+from tracking.cache import touch_visitors, uncache_instances
+from tracking.geoip import geoip_write_fields
+from tracking.models import Pageview, Url, Visitor
+from tracking.sampling import sampler
+from tracking.utils import total_seconds
+from tracking.settings import (
+    TRACK_BUFFERED_WRITES,
+    TRACK_BUFFER_SIZE,
+    TRACK_BUFFER_TIMEOUT,
+    TRACK_VISITOR_REFRESH_INTERVAL,
+)
+
+log = logging.getLogger(__file__)
+
+# A compact record of a single tracked request. `url` is None when the
+# pageview itself should not be recorded, `sample_weight` is the number of
+# pageviews it stands for (see `tracking.sampling`).
+Hit = namedtuple('Hit', (
+    'session_key', 'user_id', 'ip_address', 'user_agent', 'expiry_age',
+    'expiry_time', 'time', 'url', 'method', 'referer', 'query_string',
+    'sample_weight',
+))
+Hit.__new__.__defaults__ = (1.0,)
+
+VISITOR_UPDATE_FIELDS = (
+    'user', 'user_agent', 'agent', 'expiry_age', 'expiry_time',
+    'time_on_site',
+)
+
+
+def refresh_key(session_key):
+    "The cache key of the last refresh of a visitor, see `write_hits`."
+    return 'tracking.refresh:%s' % session_key
+
+
+def registered_key(session_key):
+    "The cache key marking a visitor's pageviews as registered."
+    return 'tracking.registered:%s' % session_key
+
+
+def refresh_state(hit):
+    return (hit.user_id, hit.user_agent)
+
+
+def write_hits(hits, throttle=False):
+    """Writes a batch of hits using one query per table and operation.
+
+    Hits are grouped by session so a visitor seen several times in the batch
+    is only written once, with the values of its latest hit. With `throttle`
+    and `TRACK_VISITOR_REFRESH_INTERVAL`, visitors refreshed within the
+    interval are not updated unless their user or user agent changed, as
+    with the unbuffered middleware.
+    """
+    sessions = OrderedDict()
+    for hit in hits:
+        sessions.setdefault(hit.session_key, []).append(hit)
+
+    throttle = throttle and TRACK_VISITOR_REFRESH_INTERVAL
+    refreshed = {}
+    if throttle:
+        refreshed = cache.get_many([refresh_key(key) for key in sessions])
+
+    with transaction.atomic():
+        agents = Visitor.objects.agent_ids(
+            [hit.user_agent for hit in hits])
+        existing = Visitor.objects.in_bulk(list(sessions))
+        created = []
+        updated = []
+        guests = set()
+
+        for session_key, session_hits in sessions.items():
+            visitor = existing.get(session_key)
+            state = refreshed.get(refresh_key(session_key))
+            if visitor is not None and state is not None and all(
+                refresh_state(hit) == state for hit in session_hits
+            ):
+                continue
+            if visitor is not None and not visitor.user_id:
+                guests.add(session_key)
+            if visitor is None:
+                first = session_hits[0]
+                visitor = Visitor(
+                    pk=session_key, ip_address=first.ip_address,
+                    start_time=first.time,
+                    **geoip_write_fields(first.ip_address))
+                created.append(visitor)
+            else:
+                updated.append(visitor)
+
+            for hit in session_hits:
+                if hit.user_id and not visitor.user_id:
+                    visitor.user_id = hit.user_id
+                if hit.user_agent:
+                    visitor.user_agent = hit.user_agent
+                    visitor.agent_id = agents[hit.user_agent]
+                visitor.expiry_age = hit.expiry_age
+                visitor.expiry_time = hit.expiry_time
+
+            last_time = session_hits[-1].time
+            visitor.time_on_site = int(
+                total_seconds(last_time - visitor.start_time))
+
+        Visitor.objects.bulk_create(created, ignore_conflicts=True)
+        # A concurrent flush may have created some of these visitors first,
+        # merge this batch's values into those rows as the upsert does
+        merged = _merge_conflicts(created, sessions)
+        guests.update(row.pk for row in merged)
+        updated.extend(merged)
+        if updated:
+            Visitor.objects.bulk_update(updated, VISITOR_UPDATE_FIELDS)
+
+        # Pageviews count as registered once their visitor has a user, also
+        # the ones written before it got it
+        users = {key: visitor.user_id for key, visitor in existing.items()}
+        users.update(
+            (visitor.pk, visitor.user_id) for visitor in created + updated)
+        registered = [key for key in guests if users[key]]
+        if registered:
+            Pageview.objects.mark_registered(registered)
+
+        pageview_hits = [hit for hit in hits if hit.url is not None]
+        urls = Url.objects.intern(
+            [hit.url for hit in pageview_hits] +
+            [hit.referer for hit in pageview_hits])
+        Pageview.objects.bulk_create([
+            Pageview(
+                visitor_id=hit.session_key, url=hit.url, view_time=hit.time,
+                method=hit.method, referer=hit.referer,
+                query_string=hit.query_string,
+                registered=users[hit.session_key] is not None,
+                sample_weight=hit.sample_weight, page_id=urls[hit.url],
+                referer_page_id=urls.get(hit.referer))
+            for hit in pageview_hits
+        ])
+
+    # Bulk writes do not send `post_save`, drop the stale cached visitors
+    uncache_instances(Visitor, list(sessions))
+    if created or updated:
+        touch_visitors()
+
+    # Only the visitors written here start a new interval, the skipped ones
+    # are refreshed once theirs is over
+    if throttle:
+        cache.set_many({
+            refresh_key(visitor.pk): refresh_state(sessions[visitor.pk][-1])
+            for visitor in created + updated
+        }, TRACK_VISITOR_REFRESH_INTERVAL)
+
+
+def _merge_conflicts(created, sessions):
+    """Returns the stored rows of the `created` visitors which were written
+    by someone else, updated with the values of this batch. The stored start
+    time and user are kept.
+    """
+    if not created:
+        return []
+    stored = Visitor.objects.in_bulk([visitor.pk for visitor in created])
+    merged = []
+    for visitor in created:
+        row = stored.get(visitor.pk)
+        if row is None or (row.start_time == visitor.start_time
+                           and row.ip_address == visitor.ip_address
+                           and row.time_on_site == visitor.time_on_site):
+            continue
+        row.user_id = row.user_id or visitor.user_id
+        if visitor.user_agent:
+            row.user_agent = visitor.user_agent
+            row.agent_id = visitor.agent_id
+        row.expiry_age = visitor.expiry_age
+        row.expiry_time = visitor.expiry_time
+        last_time = sessions[visitor.pk][-1].time
+        row.time_on_site = max(row.time_on_site or 0, int(
+            total_seconds(last_time - row.start_time)))
+        merged.append(row)
+    return merged
+
+
+class HitBuffer(object):
+    """In-process queue of hits, written in batches.
+
+    The buffer is due for a flush once it holds `size` hits or `timeout`
+    seconds after the previous flush. With `background` the flush is left to
+    a thread of the buffer, which also flushes every `timeout` seconds when
+    no hits arrive, otherwise it is done by the request that made it due.
+    Whatever is left over is flushed when the process exits.
+    """
+    def __init__(self, size, timeout, background=True):
+        self.size = size
+        self.timeout = timeout
+        self.background = background
+        self._hits = []
+        self._lock = threading.Lock()
+        self._due = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._last_flush = time.time()
+
+    def __len__(self):
+        return len(self._hits)
+
+    def add(self, hit):
+        with self._lock:
+            self._hits.append(hit)
+            if self.background:
+                self._start()
+            if (
+                len(self._hits) < self.size
+                and time.time() - self._last_flush < self.timeout
+            ):
+                return
+            if self.background:
+                self._due.set()
+                return
+            hits = self._swap()
+        self._write(hits)
+
+    def flush(self):
+        with self._lock:
+            hits = self._swap()
+        self._write(hits)
+
+    def _swap(self):
+        hits, self._hits = self._hits, []
+        self._last_flush = time.time()
+        return hits
+
+    def _start(self):
+        # Threads do not survive a fork, start one in each process
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._thread = threading.Thread(
+            target=self._run, name='tracking-buffer', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            self._due.wait(self.timeout)
+            self._due.clear()
+            try:
+                self.flush()
+            finally:
+                close_old_connections()
+
+    def _write(self, hits):
+        if not hits:
+            return
+        started = time.time()
+        try:
+            write_hits(hits, throttle=True)
+        except Exception:
+            # Keep the flusher alive, the hits are lost either way
+            log.exception('Error writing %d buffered hits', len(hits))
+        else:
+            sampler.record_latency((time.time() - started) / len(hits))
+
+
+buffer = HitBuffer(TRACK_BUFFER_SIZE, TRACK_BUFFER_TIMEOUT)
+
+if TRACK_BUFFERED_WRITES:
+    atexit.register(buffer.flush)
@@ -1,35 +1,184 @@
 # Inspired by http://eflorenzano.com/blog/2008/11/28/drop-dead-simple-django-caching/
+import threading
+import time
+
+from django.conf import settings
 from django.db import models
+from django.db.models.lookups import Exact, In
+from django.db.models.sql.where import AND
 from django.core.cache import cache
-from django.db.models.query import QuerySet
+
+SESSION_COOKIE_AGE = getattr(settings, 'SESSION_COOKIE_AGE')
+
+
+def get_version(key):
+    version = cache.get(key)
+    if version is None:
+        # Start from the time so an evicted version never reuses old keys
+        version = int(time.time())
+        if not cache.add(key, version, None):
+            version = cache.get(key, version)
+    return version
+
+
+def bump_version(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, int(time.time()), None)
+
+
+# Cached instances are namespaced by a version of their model, bumped when
+# rows were changed without knowing which
+def model_version_key(model):
+    return 'tracking.version:%s' % model._meta.label_lower
+
+
+def model_cache_key(model, pk, version=None):
+    opts = model._meta
+    if version is None:
+        version = get_version(model_version_key(model))
+    return '%s.%s:%s:%s' % (opts.app_label, opts.model_name, version, pk)
 
 
 def instance_cache_key(instance):
-    opts = instance._meta
-    if hasattr(opts, 'model_name'):
-        name = opts.model_name
-    else:
-        name = opts.module_name
-    return '%s.%s:%s' % (opts.app_label, name, instance.pk)
-
-
-class CacheQuerySet(QuerySet):
-    def filter(self, *args, **kwargs):
-        pk = None
-        for val in ('pk', 'pk__exact', 'id', 'id__exact'):
-            if val in kwargs:
-                pk = kwargs[val]
-                break
-        if pk is not None:
-            opts = self.model._meta
-            key = '%s.%s:%s' % (opts.app_label, opts.model_name, pk)
-            obj = cache.get(key)
-            if obj is not None:
-                self._result_cache = [obj]
-        return super(CacheQuerySet, self).filter(*args, **kwargs)
-
-
-class CacheManager(models.Manager):
-    def get_queryset(self):
-        return CacheQuerySet(self.model)
+    return model_cache_key(instance.__class__, instance.pk)
+
+
+def cache_instance(instance):
+    cache.set(instance_cache_key(instance), instance, SESSION_COOKIE_AGE)
+
+
+def uncache_instances(model, pks):
+    version = get_version(model_version_key(model))
+    cache.delete_many([model_cache_key(model, pk, version) for pk in pks])
+
+
+def uncache_model(model):
+    "Drops all cached instances of `model`."
+    bump_version(model_version_key(model))
+
+
+# Cached stats are namespaced by a version, bumped to invalidate all of them
+STATS_VERSION_KEY = 'tracking.stats:version'
+
+
+def stats_version():
+    return get_version(STATS_VERSION_KEY)
+
+
+def stats_cache_key(*parts, version=None):
+    if version is None:
+        version = stats_version()
+    return 'tracking.stats:%s:%s' % (version, ':'.join(str(p) for p in parts))
+
+
+def invalidate_stats():
+    "Invalidates the cached stats, e.g. after rows of the past were changed."
+    bump_version(STATS_VERSION_KEY)
+
+
+# Bumped when visitors are refreshed or ended, changes which no indexed
+# column records, see `tracking.views.stats_etag`
+VISITORS_VERSION_KEY = 'tracking.visitors:version'
+
+
+def visitors_version():
+    return get_version(VISITORS_VERSION_KEY)
+
+
+def touch_visitors():
+    "Marks the visitors as changed, e.g. after refreshing some of them."
+    bump_version(VISITORS_VERSION_KEY)
+
+
+class CacheQuerySet(models.QuerySet):
+    """Drops the cached instances of the rows changed by `update()` and
+    `bulk_update()`, which do not send `post_save`.
+
+    An `update()` filtered by primary key values drops those instances,
+    any other drops all instances of the model rather than reading the
+    primary keys of the rows first.
+    """
+    def _filtered_pks(self):
+        where = self.query.where
+        if where.connector != AND or where.negated:
+            return None
+        pk = self.model._meta.pk
+        for lookup in where.children:
+            if (
+                not isinstance(lookup, (Exact, In))
+                or getattr(lookup.lhs, 'target', None) != pk
+                or hasattr(lookup.rhs, 'resolve_expression')
+            ):
+                continue
+            if isinstance(lookup, Exact):
+                return [lookup.rhs]
+            return list(lookup.rhs)
+        return None
+
+    def update(self, **kwargs):
+        pks = self._filtered_pks()
+        count = super(CacheQuerySet, self).update(**kwargs)
+        if pks is None:
+            uncache_model(self.model)
+        else:
+            uncache_instances(self.model, pks)
+        return count
+    update.alters_data = True
+
+    def bulk_update(self, objs, fields, batch_size=None):
+        count = super(CacheQuerySet, self).bulk_update(
+            objs, fields, batch_size=batch_size)
+        uncache_instances(self.model, [obj.pk for obj in objs])
+        return count
+    bulk_update.alters_data = True
+
+
+class CacheManager(models.Manager.from_queryset(CacheQuerySet)):
+    """Serves primary key `get()` lookups from the cache.
+
+    Lookups that miss are read from the database and cached. Instances are
+    also cached when saved and removed when deleted or updated (see
+    `tracking.handlers` and `CacheQuerySet`) so the cache stays in sync with
+    the table.
+    """
+    def __init__(self):
+        super(CacheManager, self).__init__()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _pk_lookup(self, args, kwargs):
+        if args or len(kwargs) != 1:
+            return None
+        lookups = ('pk', 'pk__exact', self.model._meta.pk.attname,
+                   self.model._meta.pk.attname + '__exact')
+        for lookup in lookups:
+            if lookup in kwargs:
+                return kwargs[lookup]
+        return None
+
+    def get(self, *args, **kwargs):
+        pk = self._pk_lookup(args, kwargs)
+        if pk is None:
+            return super(CacheManager, self).get(*args, **kwargs)
+
+        key = model_cache_key(self.model, pk)
+        obj = cache.get(key)
+        if obj is not None:
+            self._count('hits')
+            return obj
+
+        self._count('misses')
+        obj = super(CacheManager, self).get(*args, **kwargs)
+        cache.set(key, obj, SESSION_COOKIE_AGE)
+        return obj
 
+    def cache_info(self):
+        "Returns the hit and miss counters of pk lookups for this process."
+        return {'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,10 @@
+from functools import wraps
+
+
+def tracking_exempt(view_func):
+    "Marks a view whose requests are not tracked, e.g. a polled API."
+    @wraps(view_func)
+    def wrapped_view(*args, **kwargs):
+        return view_func(*args, **kwargs)
+    wrapped_view.tracking_exempt = True
+    return wrapped_view
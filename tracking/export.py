@@ -0,0 +1,90 @@
+"""Streaming exports of the visitors and pageviews as CSV or JSON lines.
+
+Rows are read with `values_list()` in chunks (from a server-side cursor where
+the database supports it) and written one at a time, so the memory used does
+not depend on the size of the export.
+"""
+import csv
+import json
+import zlib
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from tracking.models import Visitor, Pageview
+
+EXPORTS = {
+    'visitors': (Visitor, 'start_time'),
+    'pageviews': (Pageview, 'view_time'),
+}
+
+FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+CHUNK_SIZE = 2000
+
+
+class Echo(object):
+    "A file-like object returning what is written, for `csv.writer`."
+    def write(self, value):
+        return value
+
+
+def export_columns(name):
+    model, _ = EXPORTS[name]
+    return [field.attname for field in model._meta.concrete_fields]
+
+
+def export_rows(name, start_date=None, end_date=None, chunk_size=CHUNK_SIZE):
+    "Returns an iterator of the value tuples of the rows in the range."
+    model, time_field = EXPORTS[name]
+    rows = model._default_manager.all()
+    if start_date:
+        rows = rows.filter(**{time_field + '__gte': start_date})
+    if end_date:
+        rows = rows.filter(**{time_field + '__lt': end_date})
+    return rows.order_by(time_field, 'pk').values_list(
+        *export_columns(name)).iterator(chunk_size=chunk_size)
+
+
+def csv_lines(columns, rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(columns)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def jsonl_lines(columns, rows):
+    for row in rows:
+        yield json.dumps(dict(zip(columns, row)), cls=DjangoJSONEncoder) + '\n'
+
+
+def gzip_stream(chunks):
+    "Compresses a stream of bytes into a gzip stream."
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export(name, start_date=None, end_date=None, format='csv',
+           compress=False, chunk_size=CHUNK_SIZE):
+    """Returns an iterator of the encoded export of the `name` ('visitors'
+    or 'pageviews') rows in the range, in `format` ('csv' or 'jsonl') and
+    gzipped if `compress` is set.
+    """
+    if name not in EXPORTS:
+        raise ValueError('Unknown export "{0}"'.format(name))
+    if format not in FORMATS:
+        raise ValueError('Unknown export format "{0}"'.format(format))
+
+    lines = csv_lines if format == 'csv' else jsonl_lines
+    chunks = (line.encode('utf-8') for line in lines(
+        export_columns(name),
+        export_rows(name, start_date, end_date, chunk_size)))
+    if compress:
+        chunks = gzip_stream(chunks)
+    return chunks
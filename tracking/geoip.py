@@ -0,0 +1,123 @@
+"""MaxMind GeoIP2 lookups shared by the whole process.
+
+The databases are opened once, on the first lookup, and the data of the most
+recent `TRACK_GEOIP_CACHE_SIZE` addresses are kept in memory. The returned
+dicts are shared between callers and must not be modified.
+"""
+import logging
+import threading
+from functools import lru_cache
+
+from django.conf import settings
+from django.contrib.gis.geoip2 import HAS_GEOIP2 as HAS_GEOIP
+
+from tracking.settings import (
+    TRACK_GEOIP_ASN_PATH,
+    TRACK_GEOIP_CACHE_SIZE,
+    TRACK_GEOIP_ON_WRITE,
+    TRACK_USING_GEOIP,
+)
+
+if HAS_GEOIP:
+    from django.contrib.gis.geoip2 import GeoIP2, GeoIP2Exception
+    from geoip2.database import Reader
+    from geoip2.errors import AddressNotFoundError, GeoIP2Error
+
+# MODE_AUTO, which memory-maps the database (with the C extension if it is
+# installed)
+GEOIP_CACHE_TYPE = getattr(settings, 'GEOIP_CACHE_TYPE', 0)
+
+log = logging.getLogger(__file__)
+
+# The `Visitor` columns filled from the GeoIP data. `geoip_failed` marks the
+# addresses without a country, which the backfill does not look up again.
+GEOIP_FIELDS = ('country_code', 'region', 'city', 'asn', 'geoip_failed')
+
+_reader = None
+_asn_reader = None
+_reader_lock = threading.Lock()
+
+
+def get_reader():
+    "Returns the process-wide `GeoIP2` reader, opening it if needed."
+    global _reader
+    if _reader is None:
+        with _reader_lock:
+            if _reader is None:
+                _reader = GeoIP2(cache=GEOIP_CACHE_TYPE)
+    return _reader
+
+
+def get_asn_reader():
+    "Returns the process-wide reader of the `TRACK_GEOIP_ASN_PATH` database."
+    global _asn_reader
+    if _asn_reader is None:
+        with _reader_lock:
+            if _asn_reader is None:
+                _asn_reader = Reader(
+                    TRACK_GEOIP_ASN_PATH, mode=GEOIP_CACHE_TYPE)
+    return _asn_reader
+
+
+@lru_cache(maxsize=TRACK_GEOIP_CACHE_SIZE)
+def geoip_lookup(ip_address):
+    "Returns the GeoIP city data of an IP address, or None if unavailable."
+    if not HAS_GEOIP:
+        return None
+    try:
+        return get_reader().city(ip_address)
+    except AddressNotFoundError:
+        return None
+    except (GeoIP2Exception, GeoIP2Error, ValueError):
+        log.exception('Error getting GeoIP data for IP "%s"', ip_address)
+        return None
+
+
+@lru_cache(maxsize=TRACK_GEOIP_CACHE_SIZE)
+def asn_lookup(ip_address):
+    "Returns the autonomous system number of an IP address, if known."
+    if not HAS_GEOIP or not TRACK_GEOIP_ASN_PATH:
+        return None
+    try:
+        return get_asn_reader().asn(ip_address).autonomous_system_number
+    except AddressNotFoundError:
+        return None
+    except (GeoIP2Error, OSError, ValueError):
+        log.exception('Error getting the ASN of IP "%s"', ip_address)
+        return None
+
+
+def geoip_lookup_many(ip_addresses):
+    "Returns a dict of the GeoIP city data of each distinct IP address."
+    return {ip: geoip_lookup(ip) for ip in set(ip_addresses)}
+
+
+def geoip_fields(ip_address):
+    "Returns the values of the `GEOIP_FIELDS` of a visitor's IP address."
+    data = geoip_lookup(ip_address) or {}
+    return {
+        'country_code': data.get('country_code'),
+        'region': data.get('region'),
+        'city': data.get('city'),
+        'asn': asn_lookup(ip_address),
+        'geoip_failed': not data.get('country_code'),
+    }
+
+
+def geoip_write_fields(ip_address):
+    """Returns the `GEOIP_FIELDS` to store with a new visitor written off
+    the request (see `tracking.buffer.write_hits`), none unless
+    `TRACK_GEOIP_ON_WRITE` is set.
+    """
+    if TRACK_USING_GEOIP and TRACK_GEOIP_ON_WRITE:
+        return geoip_fields(ip_address)
+    return {}
+
+
+def reset():
+    "Drops the readers and the cached lookups, e.g. after a database update."
+    global _reader, _asn_reader
+    with _reader_lock:
+        _reader = _asn_reader = None
+    geoip_lookup.cache_clear()
+    asn_lookup.cache_clear()
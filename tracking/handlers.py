@@ -1,13 +1,13 @@
 from django.utils import timezone
-from django.core.cache import cache
-from django.conf import settings
 from tracking.models import Visitor
-from tracking.cache import instance_cache_key
-
-SESSION_COOKIE_AGE = getattr(settings, 'SESSION_COOKIE_AGE')
+from tracking.cache import cache_instance, touch_visitors, uncache_instances
+from tracking.presence import presence
 
 
 def track_ended_session(sender, request, user, **kwargs):
+    if presence is not None and request.session.session_key:
+        presence.remove(request.session.session_key)
+
     try:
         visitor = Visitor.objects.get(pk=request.session.session_key)
     # This should rarely ever occur.. e.g. direct request to logout
@@ -18,11 +18,16 @@ def track_ended_session(sender, request, user, **kwargs):
     visitor.end_time = timezone.now()
     visitor.time_on_site = (visitor.end_time - visitor.start_time).seconds
     visitor.save()
+    touch_visitors()
 
     # Unset the cache since the user logged out, this particular visitor will
     # unlikely be accessed individually.
-    cache.delete(instance_cache_key(visitor))
+    uncache_instances(Visitor, [visitor.pk])
 
 
 def post_save_cache(sender, instance, **kwargs):
-    cache.set(instance_cache_key(instance), instance, SESSION_COOKIE_AGE)
+    cache_instance(instance)
+
+
+def post_delete_cache(sender, instance, **kwargs):
+    uncache_instances(sender, [instance.pk])
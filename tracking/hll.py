@@ -0,0 +1,72 @@
+"""HyperLogLog sketches, estimating the number of distinct values of a set.
+
+A sketch of precision `p` has 2 ** p one byte registers and a standard error
+of about 1.04 / sqrt(2 ** p), 1.15% for the default precision of 13.
+Sketches of the same precision merge into the sketch of the union of their
+sets, so the distinct count of a range is estimated from the sketches of its
+hours and days.
+"""
+import math
+import zlib
+from hashlib import blake2b
+
+PRECISION = 13
+
+
+class HyperLogLog(object):
+
+    def __init__(self, p=PRECISION, registers=None):
+        self.p = p
+        self.m = 1 << p
+        self.registers = registers or bytearray(self.m)
+        # The rank is counted over the hash bits left after the index
+        self._bits = 64 - p
+        self._mask = (1 << self._bits) - 1
+
+    @classmethod
+    def of(cls, values, p=PRECISION):
+        sketch = cls(p)
+        sketch.update(values)
+        return sketch
+
+    def add(self, value):
+        if isinstance(value, tuple):
+            value = '\x00'.join(str(part) for part in value)
+        x = int.from_bytes(
+            blake2b(str(value).encode('utf-8'), digest_size=8).digest(),
+            'big')
+        index = x >> self._bits
+        rank = self._bits - (x & self._mask).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def merge(self, other):
+        if other.p != self.p:
+            raise ValueError('Cannot merge sketches of different precisions')
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self):
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / math.fsum(
+            2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        # Linear counting is more accurate for small cardinalities
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def __len__(self):
+        return self.count()
+
+    def to_bytes(self):
+        return bytes([self.p]) + zlib.compress(bytes(self.registers))
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = bytes(data)
+        return cls(data[0], bytearray(zlib.decompress(data[1:])))
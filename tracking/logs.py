@@ -0,0 +1,194 @@
+"""Replay of web server access logs into visitors and pageviews.
+
+Log lines are parsed into `LogEntry` tuples, filtered like the middleware
+filters requests, and turned into `Hit`s of synthesized sessions: the
+requests of one IP address and user agent belong to the same session until
+they are more than the inactivity timeout apart. Lines are expected in
+(roughly) chronological order.
+"""
+import json
+import re
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone as dt_timezone
+from functools import lru_cache
+from hashlib import sha1
+
+from django.utils.dateparse import parse_datetime
+
+from tracking.buffer import Hit
+from tracking.middleware import ignore_url, ignore_user_agent
+from tracking.models import Pageview
+from tracking.settings import (
+    TRACK_IGNORE_STATUS_CODES,
+    TRACK_PAGEVIEWS,
+    TRACK_QUERY_STRING,
+    TRACK_REFERER,
+)
+
+LogEntry = namedtuple('LogEntry', (
+    'ip_address', 'time', 'method', 'path', 'query_string', 'status',
+    'referer', 'user_agent',
+))
+
+# Common log format, optionally followed by the referer and user agent of
+# the combined log format
+LOG_RE = re.compile(
+    r'(?P<ip>\S+) \S+ \S+ \[(?P<time>[^\]]+)\] '
+    r'"(?P<method>[A-Z]+) (?P<url>\S+)[^"]*" (?P<status>\d{3}) \S+'
+    r'(?: "(?P<referer>(?:[^"\\]|\\.)*)" "(?P<user_agent>(?:[^"\\]|\\.)*)")?'
+)
+
+MONTHS = dict((name, number + 1) for number, name in enumerate((
+    'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+    'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec',
+)))
+
+# Number of parsed entries between two prunings of the ended sessions
+PRUNE_INTERVAL = 10000
+
+
+@lru_cache(maxsize=1024)
+def parse_log_time(value):
+    "Parses a log time such as '10/Oct/2000:13:55:36 -0700'."
+    offset = int(value[22:24]) * 60 + int(value[24:26])
+    if value[21] == '-':
+        offset = -offset
+    return datetime(
+        int(value[7:11]), MONTHS[value[3:6]], int(value[0:2]),
+        int(value[12:14]), int(value[15:17]), int(value[18:20]),
+        tzinfo=dt_timezone(timedelta(minutes=offset)))
+
+
+def _dash(value):
+    return None if not value or value == '-' else value
+
+
+def parse_log_line(line):
+    "Parses a common or combined log format line, None if it does not match."
+    match = LOG_RE.match(line)
+    if match is None:
+        return None
+    path, _, query_string = match.group('url').partition('?')
+    return LogEntry(
+        ip_address=match.group('ip'),
+        time=parse_log_time(match.group('time')),
+        method=match.group('method'),
+        path=path,
+        query_string=query_string or None,
+        status=int(match.group('status')),
+        referer=_dash(match.group('referer')),
+        user_agent=_dash(match.group('user_agent')),
+    )
+
+
+def parse_json_line(line):
+    """Parses a JSON object with the `LogEntry` fields, the time being an ISO
+    8601 string or a UNIX timestamp. None if it is not valid.
+    """
+    try:
+        data = json.loads(line)
+        value = data['time']
+        if isinstance(value, (int, float)):
+            time = datetime.fromtimestamp(value, dt_timezone.utc)
+        else:
+            time = parse_datetime(value)
+        if time is None:
+            return None
+        if time.tzinfo is None:
+            time = time.replace(tzinfo=dt_timezone.utc)
+        path, _, query_string = data['path'].partition('?')
+        return LogEntry(
+            ip_address=data['ip_address'],
+            time=time,
+            method=data.get('method', 'GET'),
+            path=path,
+            query_string=data.get('query_string') or query_string or None,
+            status=int(data.get('status', 200)),
+            referer=_dash(data.get('referer')),
+            user_agent=_dash(data.get('user_agent')),
+        )
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return None
+
+
+PARSERS = {
+    'combined': parse_log_line,
+    'jsonl': parse_json_line,
+}
+
+
+def should_import(entry):
+    "The filters of `VisitorTrackingMiddleware` that apply to log entries."
+    return not (
+        entry.status in TRACK_IGNORE_STATUS_CODES
+        or ignore_url(entry.path.lstrip('/'))
+        or ignore_user_agent(entry.user_agent or '')
+    )
+
+
+def session_key(entry):
+    "A session key derived from the first request of a session."
+    return sha1('{0}|{1}|{2}'.format(
+        entry.ip_address, entry.user_agent, entry.time.isoformat(),
+    ).encode('utf-8')).hexdigest()
+
+
+def log_hits(entries, timeout):
+    """Yields a `Hit` per entry, grouping the entries into sessions which
+    end after `timeout` (a timedelta) of inactivity.
+    """
+    expiry_age = int(timeout.total_seconds())
+    sessions = {}
+    for count, entry in enumerate(entries, 1):
+        key = (entry.ip_address, entry.user_agent)
+        session = sessions.get(key)
+        if session is None or entry.time - session[1] > timeout:
+            session = (session_key(entry), entry.time)
+        sessions[key] = (session[0], entry.time)
+
+        url = method = referer = query_string = None
+        if TRACK_PAGEVIEWS:
+            url = entry.path
+            method = entry.method
+            if TRACK_REFERER:
+                referer = entry.referer
+            if TRACK_QUERY_STRING:
+                query_string = entry.query_string
+
+        yield Hit(
+            session_key=session[0],
+            user_id=None,
+            ip_address=entry.ip_address,
+            user_agent=entry.user_agent,
+            expiry_age=expiry_age,
+            expiry_time=entry.time + timeout,
+            time=entry.time,
+            url=url,
+            method=method,
+            referer=referer,
+            query_string=query_string,
+        )
+
+        # Forget the sessions that ended, keeping the memory bounded
+        if count % PRUNE_INTERVAL == 0:
+            ended = entry.time - timeout
+            sessions = dict(
+                (key, value) for key, value in sessions.items()
+                if value[1] >= ended)
+
+
+def imported_pageviews(hits, exclude=()):
+    """Returns the `(session_key, time)` of the pageviews of `hits` which
+    are already stored, e.g. by an earlier import of the same log. Session
+    keys are derived from the log, so they are the same on every import.
+    The sessions in `exclude` are not looked up.
+    """
+    hits = [hit for hit in hits
+            if hit.url is not None and hit.session_key not in exclude]
+    if not hits:
+        return set()
+    return set(Pageview.objects.filter(
+        visitor_id__in=set(hit.session_key for hit in hits),
+        view_time__gte=min(hit.time for hit in hits),
+        view_time__lte=max(hit.time for hit in hits),
+    ).values_list('visitor_id', 'view_time'))
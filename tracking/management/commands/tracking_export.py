@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from tracking.export import CHUNK_SIZE, EXPORTS, FORMATS, export
+from tracking.management.commands.tracking_rollup import parse_time
+
+
+class Command(BaseCommand):
+    help = 'Exports the visitors or pageviews of a date range.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', choices=sorted(EXPORTS))
+        parser.add_argument(
+            '--since', type=parse_time,
+            help='Start of the range, e.g. "2014-11-01 00:00"')
+        parser.add_argument(
+            '--until', type=parse_time,
+            help='End of the range (excluded)')
+        parser.add_argument(
+            '--format', choices=sorted(FORMATS), default='csv')
+        parser.add_argument(
+            '--gzip', action='store_true',
+            help='Compress the output, requires --output')
+        parser.add_argument(
+            '--output', help='File to write to, defaults to stdout')
+        parser.add_argument(
+            '--chunk-size', type=int, default=CHUNK_SIZE,
+            help='Number of rows read from the database at once')
+
+    def handle(self, *args, **options):
+        if options['gzip'] and not options['output']:
+            raise CommandError('--gzip requires --output')
+
+        chunks = export(
+            options['name'], options['since'], options['until'],
+            options['format'], options['gzip'], options['chunk_size'])
+
+        if options['output']:
+            with open(options['output'], 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+        else:
+            for chunk in chunks:
+                self.stdout.write(chunk.decode('utf-8'), ending='')
@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from tracking.geoip import GEOIP_FIELDS, HAS_GEOIP, geoip_fields
+from tracking.models import Visitor
+
+
+class Command(BaseCommand):
+    help = ('Stores the GeoIP country, region, city and ASN of the visitors '
+            'who do not have them yet. Addresses which were not found are '
+            'not looked up again.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of visitors read and updated at once')
+        parser.add_argument(
+            '--all', action='store_true',
+            help='Look up all the visitors again, including those not found '
+                 'before, e.g. after a database update')
+
+    def handle(self, *args, **options):
+        if not HAS_GEOIP:
+            raise CommandError('The geoip2 package is not installed')
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be positive')
+
+        visitors = Visitor.objects.only('pk', 'ip_address')
+        if not options['all']:
+            visitors = visitors.filter(country_code=None, geoip_failed=False)
+
+        count = 0
+        batch = []
+        for visitor in visitors.iterator(chunk_size=options['batch_size']):
+            batch.append(visitor)
+            if len(batch) >= options['batch_size']:
+                count += self.update(batch)
+                batch = []
+        if batch:
+            count += self.update(batch)
+
+        self.stdout.write('{0} visitors updated'.format(count))
+
+    def update(self, visitors):
+        # Each distinct address is looked up once (and cached beyond)
+        locations = dict(
+            (ip, geoip_fields(ip))
+            for ip in set(visitor.ip_address for visitor in visitors))
+        for visitor in visitors:
+            for name, value in locations[visitor.ip_address].items():
+                setattr(visitor, name, value)
+
+        # The updated visitors are dropped from the cache by the manager
+        Visitor.objects.bulk_update(visitors, GEOIP_FIELDS)
+        return len(visitors)
@@ -0,0 +1,104 @@
+import fileinput
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+from tracking.buffer import write_hits
+from tracking.cache import invalidate_stats
+from tracking.logs import (
+    PARSERS, imported_pageviews, log_hits, should_import)
+from tracking.settings import TRACK_ANONYMOUS_USERS
+
+
+class Command(BaseCommand):
+    help = ('Imports web server access logs (common/combined log format or '
+            'JSON lines) as visitors and pageviews.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'files', nargs='*',
+            help='Log files, possibly gzipped, read from stdin if none')
+        parser.add_argument(
+            '--format', choices=sorted(PARSERS), default='combined')
+        parser.add_argument(
+            '--timeout', type=int, default=1800,
+            help='Seconds of inactivity after which a visitor session ends')
+        parser.add_argument(
+            '--batch-size', type=int, default=5000,
+            help='Number of requests written at once')
+
+    def handle(self, *args, **options):
+        if not TRACK_ANONYMOUS_USERS:
+            raise CommandError(
+                'Log entries have no user and TRACK_ANONYMOUS_USERS is False')
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be positive')
+
+        parse = PARSERS[options['format']]
+        self.skipped = self.ignored = self.duplicates = 0
+        # The sessions written by this run, and the time of their last hit
+        self.sessions = {}
+
+        lines = fileinput.input(
+            options['files'], mode='rb', openhook=fileinput.hook_compressed)
+        try:
+            hits = log_hits(
+                self.entries(lines, parse),
+                timedelta(seconds=options['timeout']))
+            imported = 0
+            batch = []
+            for hit in hits:
+                batch.append(hit)
+                if len(batch) >= options['batch_size']:
+                    imported += self.write(batch, options['timeout'])
+                    batch = []
+            if batch:
+                imported += self.write(batch, options['timeout'])
+        finally:
+            lines.close()
+
+        if imported:
+            invalidate_stats()
+
+        self.stdout.write(
+            '{0} requests imported, {1} ignored, {2} unparsable lines '
+            'skipped'.format(imported, self.ignored, self.skipped))
+        if self.duplicates:
+            self.stderr.write(
+                '{0} requests were already imported and have been '
+                'skipped'.format(self.duplicates))
+
+    def write(self, batch, timeout):
+        """Writes the hits of `batch` whose pageviews were not imported
+        before, and returns how many were written. The pageviews of sessions
+        this run has written are not looked up, they are never duplicates.
+        """
+        existing = imported_pageviews(batch, exclude=self.sessions)
+        if existing:
+            hits = [hit for hit in batch
+                    if (hit.session_key, hit.time) not in existing]
+            self.duplicates += len(batch) - len(hits)
+            batch = hits
+        if not batch:
+            return 0
+        write_hits(batch)
+
+        # Sessions more than `timeout` seconds older than this batch ended
+        ended = batch[0].time - timedelta(seconds=timeout)
+        self.sessions = dict(
+            (key, time) for key, time in self.sessions.items()
+            if time >= ended)
+        for hit in batch:
+            self.sessions[hit.session_key] = hit.time
+        return len(batch)
+
+    def entries(self, lines, parse):
+        for line in lines:
+            entry = parse(line.decode('utf-8', 'replace'))
+            if entry is None:
+                if line.strip():
+                    self.skipped += 1
+            elif should_import(entry):
+                yield entry
+            else:
+                self.ignored += 1
@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, router, transaction
+from django.utils import timezone
+
+from tracking import partitions
+from tracking.cache import invalidate_stats
+from tracking.models import Pageview
+from tracking.settings import (
+    TRACK_PARTITION_MONTHS_AHEAD,
+    TRACK_PARTITION_RETENTION_MONTHS,
+)
+
+
+class Command(BaseCommand):
+    help = ('Creates the upcoming monthly partitions of the pageview table '
+            'and drops the expired ones (PostgreSQL only).')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--setup', action='store_true',
+            help='Convert the pageview table into a partitioned table first')
+        parser.add_argument(
+            '--months-ahead', type=int, default=TRACK_PARTITION_MONTHS_AHEAD,
+            help='Number of future monthly partitions to keep ready')
+        parser.add_argument(
+            '--retain', type=int, default=TRACK_PARTITION_RETENTION_MONTHS,
+            help='Number of past months to keep, older partitions are '
+                 'dropped. Nothing is dropped by default')
+
+    def handle(self, *args, **options):
+        connection = connections[router.db_for_write(Pageview)]
+        if connection.vendor != 'postgresql':
+            raise CommandError(
+                'Pageview partitioning is only supported on PostgreSQL, '
+                'not {0}'.format(connection.vendor))
+
+        now = timezone.now()
+        if options['setup']:
+            if partitions.is_partitioned(connection):
+                raise CommandError(
+                    'The pageview table is already partitioned')
+            # Runs its own short transaction
+            legacy = partitions.setup(connection, now)
+            self.stdout.write('Existing pageviews moved to partition '
+                              '{0}'.format(legacy))
+        elif not partitions.is_partitioned(connection):
+            raise CommandError(
+                'The pageview table is not partitioned, use --setup')
+
+        with transaction.atomic(using=connection.alias):
+            for name in partitions.create_partitions(
+                    connection, now, options['months_ahead']):
+                self.stdout.write('Created partition {0}'.format(name))
+
+            if options['retain'] is not None:
+                before = partitions.add_months(
+                    partitions.month_start(now), -options['retain'])
+                dropped = partitions.drop_partitions(connection, before)
+                for name in dropped:
+                    self.stdout.write('Dropped partition {0}'.format(name))
+                if dropped:
+                    invalidate_stats()
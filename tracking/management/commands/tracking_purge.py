@@ -0,0 +1,115 @@
+import os
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import router, transaction
+from django.utils import timezone
+
+from tracking.cache import invalidate_stats
+from tracking.management.commands.tracking_rollup import parse_time
+from tracking.models import Visitor, Pageview
+
+
+class Command(BaseCommand):
+    help = ('Deletes the visitors who started before a cutoff, and their '
+            'pageviews, in small primary key ordered batches.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--before', type=parse_time,
+            help='Delete visitors who started before this date/time')
+        parser.add_argument(
+            '--days', type=int,
+            help='Delete visitors who started more than this many days ago')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of consecutive session keys purged per transaction')
+        parser.add_argument(
+            '--sleep', type=float, default=0,
+            help='Seconds to pause between batches')
+        parser.add_argument(
+            '--checkpoint',
+            help='File keeping the last deleted session key, so an '
+                 'interrupted purge resumes where it stopped')
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only report how many rows would be deleted')
+
+    def handle(self, *args, **options):
+        if (options['before'] is None) == (options['days'] is None):
+            raise CommandError('Either --before or --days is required')
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be positive')
+
+        before = options['before']
+        if before is None:
+            before = timezone.now() - timedelta(days=options['days'])
+        visitors = Visitor.objects.filter(start_time__lt=before)
+
+        if options['dry_run']:
+            pageviews = Pageview.objects.filter(visitor__start_time__lt=before)
+            self.stdout.write(
+                'Would delete {0} visitors and {1} pageviews started before '
+                '{2}'.format(visitors.count(), pageviews.count(), before))
+            return
+
+        checkpoint = options['checkpoint']
+        last = self.read_checkpoint(checkpoint)
+        deleted_visitors = deleted_pageviews = 0
+
+        while True:
+            # Each batch is the range of the next `batch_size` session keys,
+            # read from the primary key index alone, so no batch rescans
+            # the visitors that were kept
+            upper = self.range_end(last, options['batch_size'])
+            batch = visitors
+            if last is not None:
+                batch = batch.filter(pk__gt=last)
+            if upper is not None:
+                batch = batch.filter(pk__lte=upper)
+
+            # Deletes the pageviews of the batch in one query, and sends
+            # `post_delete` for the visitors, which uncaches them
+            with transaction.atomic(using=router.db_for_write(Visitor)):
+                _, deleted = batch.delete()
+            deleted_visitors += deleted.get(Visitor._meta.label, 0)
+            deleted_pageviews += deleted.get(Pageview._meta.label, 0)
+
+            if upper is None:
+                break
+            last = upper
+            self.write_checkpoint(checkpoint, last)
+            if options['verbosity'] > 1:
+                self.stdout.write('Deleted up to session {0}'.format(last))
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        if deleted_visitors or deleted_pageviews:
+            invalidate_stats()
+        if checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        self.stdout.write('Deleted {0} visitors and {1} pageviews'.format(
+            deleted_visitors, deleted_pageviews))
+
+    def range_end(self, last, size):
+        "Returns the last session key of the next range, None if it is open."
+        pks = Visitor.objects.order_by('pk')
+        if last is not None:
+            pks = pks.filter(pk__gt=last)
+        pks = list(pks.values_list('pk', flat=True)[size - 1:size])
+        return pks[0] if pks else None
+
+    def read_checkpoint(self, path):
+        if not path or not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return f.read().strip() or None
+
+    def write_checkpoint(self, path, last):
+        if not path:
+            return
+        # Replace the file atomically so an interruption never truncates it
+        with open(path + '.tmp', 'w') as f:
+            f.write(last)
+        os.replace(path + '.tmp', path)
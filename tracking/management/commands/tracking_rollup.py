@@ -0,0 +1,49 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from tracking.models import PageviewRollup, UrlRollup, VisitorRollup
+from tracking.settings import TRACK_PAGEVIEWS, TRACK_ROLLUP_DELAY
+
+
+def parse_time(value):
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise CommandError('Invalid date/time "{0}"'.format(value))
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+class Command(BaseCommand):
+    help = ('Rolls up the visitor and pageview totals into hourly and daily '
+            'buckets, and the pageviews per URL and referer into daily '
+            'buckets, continuing from the last rollup by default.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--since', type=parse_time,
+            help='Start of the range to (re)compute, e.g. "2014-11-01 00:00"')
+        parser.add_argument(
+            '--until', type=parse_time,
+            help='End of the range, defaults to TRACK_ROLLUP_DELAY seconds '
+                 'ago')
+
+    def handle(self, *args, **options):
+        until = options['until']
+        if until is None:
+            until = timezone.now() - timedelta(seconds=TRACK_ROLLUP_DELAY)
+
+        models = [VisitorRollup]
+        if TRACK_PAGEVIEWS:
+            models.extend([PageviewRollup, UrlRollup])
+
+        for model in models:
+            since = options['since'] or model.objects.next_start()
+            if since is None:
+                continue
+            count = model.objects.build(since, until)
+            self.stdout.write('{0}: {1} rollups written'.format(
+                model._meta.verbose_name, count))
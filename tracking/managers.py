@@ -1,17 +1,216 @@
 from __future__ import division
 
+import threading
+from collections import Counter, OrderedDict
 from datetime import timedelta
 from django.utils import timezone
 from django.contrib.auth import get_user_model
-from django.db import models
-from django.db.models import Count, Avg
-from tracking.settings import TRACK_PAGEVIEWS, TRACK_ANONYMOUS_USERS
-from tracking.cache import CacheManager
+from django.db import IntegrityError, connections, models, router, transaction
+from django.db.models import (
+    Avg, Count, Exists, F, Max, Min, OuterRef, Q, Sum,
+)
+from django.core.cache import cache
+from tracking.settings import (
+    TRACK_ANONYMOUS_USERS,
+    TRACK_APPROXIMATE_UNIQUES,
+    TRACK_CACHE_STATS,
+    TRACK_CACHE_STATS_DELAY,
+    TRACK_PAGEVIEWS,
+    TRACK_USE_ROLLUPS,
+)
+from tracking.cache import (
+    CacheManager,
+    invalidate_stats,
+    stats_cache_key,
+    stats_version,
+    touch_visitors,
+    uncache_instances,
+)
+from tracking.hll import HyperLogLog
+from tracking.presence import presence
+from tracking.useragents import parse_user_agent
+from tracking.utils import (
+    PERIODS,
+    ceil_time,
+    floor_time,
+    text_hash,
+    total_seconds,
+)
+
+# Backend specific pieces of the single statement visitor upsert: the
+# conflict clause, the expression for the whole seconds between the stored
+# and the new start time, and how the new (inserted) values are referenced.
+UPSERT_SQL = {
+    'postgresql': (
+        'ON CONFLICT (%(pk)s) DO UPDATE SET',
+        'CAST(FLOOR(EXTRACT(EPOCH FROM (EXCLUDED.%(start)s - '
+        '%(table)s.%(start)s))) AS INTEGER)',
+        'EXCLUDED.%s',
+    ),
+    'sqlite': (
+        'ON CONFLICT (%(pk)s) DO UPDATE SET',
+        'CAST(ROUND((JULIANDAY(EXCLUDED.%(start)s) - '
+        'JULIANDAY(%(table)s.%(start)s)) * 86400000) / 1000 AS INTEGER)',
+        'EXCLUDED.%s',
+    ),
+    'mysql': (
+        'ON DUPLICATE KEY UPDATE',
+        'TIMESTAMPDIFF(SECOND, %(table)s.%(start)s, VALUES(%(start)s))',
+        'VALUES(%s)',
+    ),
+}
+
+
+# The most session keys `VisitorManager.active()` looks up by primary key,
+# below the query parameter limit of older SQLite versions (999)
+ACTIVE_KEYS_LIMIT = 900
+
+# Seconds the cached user stats of a range that is not settled yet are kept
+OPEN_STATS_TIMEOUT = 60
 
 
 class VisitorManager(CacheManager):
+    totals_fields = (
+        'registered_total', 'registered_unique', 'registered_time_on_site',
+        'registered_timed', 'registered_paged', 'registered_pageviews',
+        'guest_total', 'guest_unique', 'guest_time_on_site',
+        'guest_timed', 'guest_paged', 'guest_pageviews',
+    )
+    time_field = 'start_time'
+    rollup_model = 'VisitorRollup'
+
+    @property
+    def settle_delay(self):
+        # Visitors keep being refreshed after the day they started
+        return TRACK_CACHE_STATS_DELAY
+
+    def upsert(self, session_key, ip_address, visit_time, user_id=None,
+               user_agent=None, expiry_age=None, expiry_time=None):
+        """Creates or refreshes the visitor for `session_key` in a single
+        statement where the database supports it.
+
+        An existing visitor keeps its start time and user, while the time on
+        site is recomputed from the stored start time and `visit_time`.
+        The GeoIP fields are not looked up on this path, which runs during
+        the request, see `TRACK_GEOIP_ON_WRITE`.
+        """
+        using = router.db_for_write(self.model)
+        connection = connections[using]
+        if connection.vendor not in UPSERT_SQL:
+            self._refresh(
+                session_key, ip_address, visit_time, user_id, user_agent,
+                expiry_age, expiry_time)
+            touch_visitors()
+            return
+
+        conflict, time_on_site, new = UPSERT_SQL[connection.vendor]
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        names = {
+            'table': qn(opts.db_table),
+            'pk': qn(opts.pk.column),
+            'start': qn(opts.get_field('start_time').column),
+        }
+        columns = [qn(opts.get_field(name).column) for name in (
+            'session_key', 'ip_address', 'user', 'user_agent', 'start_time',
+            'expiry_age', 'expiry_time', 'time_on_site', 'agent',
+            'geoip_failed',
+        )]
+        _, _, user, agent, _, age, expiry, tos, agent_id, _ = columns
+        assignments = [
+            '%s = COALESCE(%s.%s, %s)' % (user, names['table'], user,
+                                          new % user),
+            '%s = COALESCE(%s, %s.%s)' % (agent, new % agent,
+                                          names['table'], agent),
+            '%s = COALESCE(%s, %s.%s)' % (agent_id, new % agent_id,
+                                          names['table'], agent_id),
+            '%s = %s' % (age, new % age),
+            '%s = %s' % (expiry, new % expiry),
+            '%s = %s' % (tos, time_on_site % names),
+        ]
+        sql = 'INSERT INTO %s (%s) VALUES (%s) %s %s' % (
+            names['table'], ', '.join(columns),
+            ', '.join(['%s'] * len(columns)), conflict % names,
+            ', '.join(assignments))
+
+        adapt = connection.ops.adapt_datetimefield_value
+        params = [
+            session_key, ip_address, user_id, user_agent, adapt(visit_time),
+            expiry_age, adapt(expiry_time), 0,
+            self.agent_ids([user_agent]).get(user_agent), False,
+        ]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+        # The row changed behind the cache's back
+        uncache_instances(self.model, [session_key])
+        touch_visitors()
+
+    def agent_ids(self, user_agents):
+        "Returns a dict of the `UserAgent` ids of the `user_agents`."
+        agents = self.model._meta.get_field('agent').related_model
+        return agents.objects.intern(user_agents)
+
+    def _refresh(self, session_key, ip_address, visit_time, user_id,
+                 user_agent, expiry_age, expiry_time):
+        # Fallback for databases without an upsert statement
+        try:
+            visitor = self.get(pk=session_key)
+        except self.model.DoesNotExist:
+            visitor = self.model(
+                pk=session_key, ip_address=ip_address, start_time=visit_time)
+
+        try:
+            self._apply_refresh(visitor, visit_time, user_id, user_agent,
+                                expiry_age, expiry_time)
+        except IntegrityError:
+            # there is a small chance a second response has saved this
+            # Visitor already and a second save() at the same time (having
+            # failed to UPDATE anything) will attempt to INSERT the same
+            # session key (pk) again. The "winner" is refreshed instead.
+            visitor = self.get_queryset().get(pk=session_key)
+            self._apply_refresh(visitor, visit_time, user_id, user_agent,
+                                expiry_age, expiry_time)
+
+    def _apply_refresh(self, visitor, visit_time, user_id, user_agent,
+                       expiry_age, expiry_time):
+        if user_id and not visitor.user_id:
+            visitor.user_id = user_id
+        if user_agent:
+            visitor.user_agent = user_agent
+            visitor.agent_id = self.agent_ids([user_agent])[user_agent]
+        visitor.expiry_age = expiry_age
+        visitor.expiry_time = expiry_time
+        visitor.time_on_site = int(
+            total_seconds(visit_time - visitor.start_time))
+        with transaction.atomic():
+            visitor.save()
+
     def active(self, registered_only=True):
-        "Returns all active users, e.g. not logged and non-expired session."
+        """Returns all active users, e.g. not logged and non-expired session.
+        With `TRACK_PRESENCE`, they are looked up by the session keys of the
+        presence sets, unless they count more than `ACTIVE_KEYS_LIMIT` keys,
+        which are then not fetched, or the presence sets are unavailable.
+        """
+        if presence is not None:
+            count = presence.active_count(registered_only)
+            if count is not None and count <= ACTIVE_KEYS_LIMIT:
+                keys = presence.active_session_keys(registered_only)
+                if keys is not None:
+                    return self.filter(pk__in=keys)
+        return self._active(registered_only)
+
+    def active_count(self, registered_only=True):
+        """Returns the number of active users, without querying the database
+        when `TRACK_PRESENCE` is set.
+        """
+        if presence is not None:
+            count = presence.active_count(registered_only)
+            if count is not None:
+                return count
+        return self._active(registered_only).count()
+
+    def _active(self, registered_only):
         visitors = self.filter(
             expiry_time__gt=timezone.now(),
             end_time=None
@@ -37,120 +236,186 @@ class VisitorManager(CacheManager):
 
         for all users, registered users and guests.
         """
-        visitors = self.filter(
+        return visitor_stats(
+            range_totals(self, start_date, end_date), registered_only)
+
+    def _totals(self, start_date, end_date):
+        """Returns the additive totals of the visitors who started their
+        visit in the range, see `VisitorRollup` for their meaning.
+
+        This takes one query over the visitors and, if pageviews are
+        tracked, one over their pageviews.
+        """
+        registered = Q(user__isnull=False)
+        guest = Q(user__isnull=True)
+
+        totals = self.filter(
             start_time__gte=start_date,
             start_time__lt=end_date
+        ).aggregate(
+            registered_total=Count('pk', filter=registered),
+            registered_unique=Count('user', distinct=True),
+            registered_time_on_site=Sum('time_on_site', filter=registered),
+            registered_timed=Count('time_on_site', filter=registered),
+            guest_total=Count('pk', filter=guest),
+            guest_unique=Count('ip_address', distinct=True, filter=guest),
+            guest_time_on_site=Sum('time_on_site', filter=guest),
+            guest_timed=Count('time_on_site', filter=guest),
         )
 
-        stats = {
-            'total': 0,
-            'unique': 0,
-            'return_ratio': 0,
+        if TRACK_PAGEVIEWS:
+            pageviews = self.model._meta.get_field('pageviews').related_model
+            registered = Q(visitor__user__isnull=False)
+            guest = Q(visitor__user__isnull=True)
+            paged = pageviews.objects.filter(
+                visitor__start_time__gte=start_date,
+                visitor__start_time__lt=end_date,
+            ).aggregate(
+                registered_rows=Count('pk', filter=registered),
+                registered_weight=Sum('sample_weight', filter=registered),
+                registered_paged=Count(
+                    'visitor', distinct=True, filter=registered),
+                guest_rows=Count('pk', filter=guest),
+                guest_weight=Sum('sample_weight', filter=guest),
+                guest_paged=Count('visitor', distinct=True, filter=guest),
+            )
+            # Scale the sampled pageviews, and visits with pageviews, back up
+            for prefix in ('registered', 'guest'):
+                totals[prefix + '_pageviews'] = _weighted(
+                    paged[prefix + '_weight'])
+                totals[prefix + '_paged'] = _scaled(
+                    paged[prefix + '_paged'], paged[prefix + '_weight'],
+                    paged[prefix + '_rows'])
+
+        return dict(
+            (name, totals.get(name) or 0) for name in self.totals_fields)
+
+    def _rollup_totals(self, start_date, end_date):
+        totals = self._totals(start_date, end_date)
+        if TRACK_APPROXIMATE_UNIQUES:
+            totals.update(sketch_fields(self._sketches(start_date, end_date)))
+        return totals
+
+    def _uniques(self, start_date, end_date):
+        "Returns the unique users and guest IP addresses of the range."
+        return self.filter(
+            start_time__gte=start_date,
+            start_time__lt=end_date,
+        ).aggregate(
+            registered_unique=Count('user', distinct=True),
+            guest_unique=Count(
+                'ip_address', distinct=True, filter=Q(user__isnull=True)),
+        )
+
+    def _added_uniques(self, segments, start_date, end_date):
+        """Returns the unique users and guest IP addresses of the visitors
+        who started in the `segments`, leaving out the ones who also visited
+        between `start_date` and `end_date`.
+        """
+        visitors = self.filter(_segments('start_time', segments))
+        seen = self.filter(
+            start_time__gte=start_date,
+            start_time__lt=end_date,
+        )
+        registered = visitors.filter(user__isnull=False).filter(
+            ~Exists(seen.filter(user=OuterRef('user'))))
+        guests = visitors.filter(user__isnull=True).filter(
+            ~Exists(seen.filter(user__isnull=True,
+                                ip_address=OuterRef('ip_address'))))
+        return {
+            'registered_unique': registered.values('user').distinct().count(),
+            'guest_unique': guests.values('ip_address').distinct().count(),
         }
 
-        # All visitors
-        stats['total'] = total_count = visitors.count()
-        unique_count = 0
-
-        # No visitors! Nothing more to do.
-        if not total_count:
-            return stats
-
-        # Avg time on site
-        total_time_on_site = visitors.aggregate(
-            avg_tos=Avg('time_on_site'))['avg_tos']
-        stats['time_on_site'] = timedelta(seconds=int(total_time_on_site))
-
-        # Registered user sessions
-        registered_visitors = visitors.filter(user__isnull=False)
-        registered_total_count = registered_visitors.count()
-
-        if registered_total_count:
-            registered_unique_count = registered_visitors.values(
-                'user'
-            ).distinct().count()
-            # Avg time on site
-            time_on_site = registered_visitors.aggregate(
-                avg_tos=Avg('time_on_site'))['avg_tos']
-
-            # Update the total unique count..
-            unique_count += registered_unique_count
-
-            # Set the registered stats..
-            returns = (registered_total_count - registered_unique_count)
-            stats['registered'] = {
-                'total': registered_total_count,
-                'unique': registered_unique_count,
-                'return_ratio': (returns / registered_total_count) * 100,
-                'time_on_site': timedelta(seconds=int(time_on_site)),
-            }
+    def _sketches(self, start_date, end_date):
+        "Returns the sketches of the unique users and guest IP addresses."
+        visitors = self.filter(
+            start_time__gte=start_date,
+            start_time__lt=end_date,
+        )
+        return {
+            'registered': HyperLogLog.of(visitors.filter(
+                user__isnull=False,
+            ).values_list('user', flat=True).distinct().iterator()),
+            'guest': HyperLogLog.of(visitors.filter(
+                user__isnull=True,
+            ).values_list('ip_address', flat=True).distinct().iterator()),
+        }
 
-        # Get stats for our guests..
-        if TRACK_ANONYMOUS_USERS and not registered_only:
-            guests = visitors.filter(user__isnull=True)
-            guest_total_count = guests.count()
-
-            if guest_total_count:
-                guest_unique_count = guests.values(
-                    'ip_address'
-                ).distinct().count()
-                # Avg time on site
-                guest_time_on_site = guests.aggregate(
-                    avg_tos=Avg('time_on_site'))['avg_tos']
-                # return rate
-                returns = (guest_total_count - guest_unique_count)
-                return_ratio = (returns / guest_total_count) * 100
-                time_on_site = timedelta(seconds=int(guest_time_on_site))
-            else:
-                guest_total_count = 0
-                guest_unique_count = 0
-                return_ratio = 0.0
-                time_on_site = timedelta(0)
+    def country_stats(self, start_date, end_date, registered_only=False):
+        """Returns the visitors who started their visit in the range grouped
+        by their stored `country_code` (None when unknown), with the `total`
+        visits and average `time_on_site` of each, most visits first.
+        """
+        visitors = self.filter(
+            start_time__gte=start_date,
+            start_time__lt=end_date,
+        )
+        if registered_only:
+            visitors = visitors.filter(user__isnull=False)
 
-            # Update the total unique count
-            unique_count += guest_unique_count
-            stats['guests'] = {
-                'total': guest_total_count,
-                'unique': guest_unique_count,
-                'return_ratio': return_ratio,
-                'time_on_site': time_on_site,
-            }
+        rows = list(visitors.values('country_code').annotate(
+            total=Count('pk'),
+            seconds=Sum('time_on_site'),
+            timed=Count('time_on_site'),
+        ).order_by('-total', 'country_code'))
+        for row in rows:
+            row['time_on_site'] = _time_on_site(
+                row.pop('seconds') or 0, row.pop('timed'))
+        return rows
 
-        # Finish setting the total visitor counts
-        returns = (total_count - unique_count)
-        stats['unique'] = unique_count
-        stats['return_ratio'] = (returns / total_count) * 100
+    def browser_stats(self, start_date, end_date, registered_only=False,
+                      include_bots=False):
+        """Returns the visitors who started their visit in the range grouped
+        by the `browser` family of their user agent (None when unknown),
+        with the `total` visits and average `time_on_site` of each, most
+        visits first. Bots are left out unless `include_bots` is set.
+        """
+        visitors = self.filter(
+            start_time__gte=start_date,
+            start_time__lt=end_date,
+        )
+        if registered_only:
+            visitors = visitors.filter(user__isnull=False)
+        if not include_bots:
+            visitors = visitors.exclude(agent__is_bot=True)
 
-        # If pageviews are being tracked, add the aggregate pages-per-visit
-        if TRACK_PAGEVIEWS:
-            if 'registered' in stats:
-                pages_per_visit = registered_visitors.annotate(
-                    page_count=Count('pageviews')
-                ).filter(page_count__gt=0).aggregate(
-                    pages_per_visit=Avg('page_count'))['pages_per_visit']
-                stats['registered']['pages_per_visit'] = pages_per_visit
-
-            if TRACK_ANONYMOUS_USERS and not registered_only:
-                stats['guests']['pages_per_visit'] = guests.annotate(
-                    page_count=Count('pageviews')
-                ).filter(page_count__gt=0).aggregate(
-                    pages_per_visit=Avg('page_count'))['pages_per_visit']
-
-                total_per_visit = visitors.annotate(
-                    page_count=Count('pageviews')
-                ).filter(page_count__gt=0).aggregate(
-                    pages_per_visit=Avg('page_count'))['pages_per_visit']
-            else:
-                if 'registered' in stats:
-                    total_per_visit = stats['registered']['pages_per_visit']
-                else:
-                    total_per_visit = 0
+        rows = list(visitors.values(browser=F('agent__browser')).annotate(
+            total=Count('pk'),
+            seconds=Sum('time_on_site'),
+            timed=Count('time_on_site'),
+        ).order_by('-total', 'browser'))
+        for row in rows:
+            row['time_on_site'] = _time_on_site(
+                row.pop('seconds') or 0, row.pop('timed'))
+        return rows
 
-            stats['pages_per_visit'] = total_per_visit
+    def user_stats(self, start_date=None, end_date=None, limit=None,
+                   offset=0):
+        """Returns the users who visited in the range, ordered by their
+        average time on site, annotated with their `visit_count`,
+        `time_on_site` and `pages_per_visit`. Use `limit` and `offset` to
+        only load a page of them.
 
-        return stats
+        With `TRACK_CACHE_STATS` they are cached, for good once the range
+        is settled and otherwise for `OPEN_STATS_TIMEOUT` seconds.
+        """
+        if not TRACK_CACHE_STATS:
+            return self._user_stats(start_date, end_date, limit, offset)
 
-    def user_stats(self, start_date=None, end_date=None):
+        key = stats_cache_key(
+            'user_stats', start_date and start_date.isoformat(),
+            end_date.isoformat(), limit, offset)
+        users = cache.get(key)
+        if users is None:
+            users = self._user_stats(start_date, end_date, limit, offset)
+            timeout = None
+            if end_date > settled_time(self):
+                timeout = OPEN_STATS_TIMEOUT
+            cache.set(key, users, timeout)
+        return users
+
+    def _user_stats(self, start_date, end_date, limit, offset):
         user_kwargs = {
             'visit_history__start_time__lt': end_date,
         }
@@ -164,28 +429,54 @@ class VisitorManager(CacheManager):
             user_kwargs['visit_history__start_time__isnull'] = False
             visit_kwargs['start_time__isnull'] = False
 
-        users = list(get_user_model().objects.filter(**user_kwargs).annotate(
+        users = get_user_model().objects.filter(**user_kwargs).annotate(
             visit_count=Count('visit_history'),
             time_on_site=Avg('visit_history__time_on_site'),
         ).filter(visit_count__gt=0).order_by(
             '-time_on_site',
             get_user_model().USERNAME_FIELD,
-        ))
+        )
+        if limit is not None:
+            users = users[offset:offset + limit]
+        elif offset:
+            users = users[offset:]
+        users = list(users)
+
+        # Aggregate pageviews per visit, for all the users at once
+        pages = {}
+        if TRACK_PAGEVIEWS and users:
+            pageviews = self.model._meta.get_field('pageviews').related_model
+            pages = dict(
+                (row['visitor__user'], row)
+                for row in pageviews.objects.filter(
+                    visitor__user__in=[user.pk for user in users],
+                    **dict(('visitor__' + key, value)
+                           for key, value in visit_kwargs.items())
+                ).values('visitor__user').annotate(
+                    page_count=Count('pk'),
+                    visit_count=Count('visitor', distinct=True),
+                ).order_by()
+            )
 
-        # Aggregate pageviews per visit
         for user in users:
-            user.pages_per_visit = user.visit_history.filter(
-                **visit_kwargs
-            ).annotate(
-                page_count=Count('pageviews')
-            ).filter(page_count__gt=0).aggregate(
-                pages_per_visit=Avg('page_count'))['pages_per_visit']
+            row = pages.get(user.pk)
+            user.pages_per_visit = row and _ratio(
+                row['page_count'], row['visit_count'])
             # Lop off the floating point, turn into timedelta
             user.time_on_site = timedelta(seconds=int(user.time_on_site))
         return users
 
 
 class PageviewManager(models.Manager):
+    totals_fields = (
+        'registered_total', 'registered_unique', 'registered_rows',
+        'guest_total', 'guest_unique', 'guest_rows',
+    )
+    time_field = 'view_time'
+    rollup_model = 'PageviewRollup'
+    # Pageviews do not change once written
+    settle_delay = 0
+
     def stats(self, start_date=None, end_date=None, registered_only=False):
         """Returns a dictionary of pageviews including:
 
@@ -193,55 +484,764 @@ class PageviewManager(models.Manager):
 
         for all users, registered users and guests.
         """
+        return pageview_stats(
+            range_totals(self, start_date, end_date), registered_only)
+
+    def mark_registered(self, session_keys):
+        """Marks the guest pageviews of the visitors as registered, once the
+        visitors got their user (see `Pageview.registered`).
+        """
+        count = self.filter(
+            visitor_id__in=session_keys, registered=False,
+        ).update(registered=True)
+        # Past pageviews changed, which is rare enough to drop the cached stats
+        if count and TRACK_CACHE_STATS:
+            invalidate_stats()
+        return count
+
+    def _totals(self, start_date, end_date):
+        """Returns the additive totals of the pageviews viewed in the range,
+        see `PageviewRollup`.
+        """
         pageviews = self.filter(
-            visitor__start_time__lt=end_date,
-            visitor__start_time__gte=start_date,
-        ).select_related('visitor')
+            view_time__gte=start_date,
+            view_time__lt=end_date,
+        )
+        rows = self._weights(pageviews)
+        totals = self._uniques(start_date, end_date, rows)
+        for prefix in ('registered', 'guest'):
+            # Sampled pageviews are scaled back up by their weight
+            totals[prefix + '_total'] = _weighted(rows[prefix + '_weight'])
+            totals[prefix + '_rows'] = rows[prefix + '_rows']
+        return totals
+
+    def _weights(self, pageviews):
+        return pageviews.aggregate(
+            registered_rows=Count('pk', filter=Q(registered=True)),
+            registered_weight=Sum('sample_weight', filter=Q(registered=True)),
+            guest_rows=Count('pk', filter=Q(registered=False)),
+            guest_weight=Sum('sample_weight', filter=Q(registered=False)),
+        )
+
+    def _uniques(self, start_date, end_date, rows=None):
+        """Returns the unique visitor and URL pairs of the range, scaled back
+        up by the sample weights of its pageviews.
+        """
+        pageviews = self.filter(
+            view_time__gte=start_date,
+            view_time__lt=end_date,
+        )
+        if rows is None:
+            rows = self._weights(pageviews)
+        totals = {}
+        for prefix, registered in (('registered', True), ('guest', False)):
+            if rows[prefix + '_rows']:
+                totals[prefix + '_unique'] = _scaled(
+                    pageviews.filter(
+                        registered=registered,
+                    ).values('visitor', 'url').distinct().count(),
+                    rows[prefix + '_weight'], rows[prefix + '_rows'])
+            else:
+                totals[prefix + '_unique'] = 0
+        return totals
+
+    def top_urls(self, start_date, end_date, n=10):
+        """Returns the `n` most viewed URLs of the range as dicts of the `url`
+        and its `total` pageviews, most viewed first.
+        """
+        return self._top('page', start_date, end_date, n)
+
+    def top_referers(self, start_date, end_date, n=10):
+        "Returns the `n` most frequent referers of the range, see `top_urls`."
+        return self._top('referer', start_date, end_date, n)
+
+    def _top(self, kind, start_date, end_date, n):
+        totals = Counter()
+        segments = [(start_date, end_date)]
+        if TRACK_USE_ROLLUPS:
+            rollups = self.model._meta.apps.get_model(
+                self.model._meta.app_label, 'UrlRollup')
+            segments = rollups.objects.add_totals(
+                totals, kind, start_date, end_date)
+
+        field = 'page' if kind == 'page' else 'referer_page'
+        for start, end in segments:
+            for pk, total in self.filter(**{
+                'view_time__gte': start,
+                'view_time__lt': end,
+                field + '__isnull': False,
+            }).values_list(field).annotate(
+                total=Sum('sample_weight'),
+            ).order_by():
+                totals[pk] += total
+
+        top = totals.most_common(n)
+        urls = self.model._meta.get_field('page').related_model.objects
+        names = urls.in_bulk([pk for pk, _ in top])
+        return [{'url': names[pk].url, 'total': _weighted(total)}
+                for pk, total in top]
+
+    def _rollup_totals(self, start_date, end_date):
+        totals = self._totals(start_date, end_date)
+        if TRACK_APPROXIMATE_UNIQUES:
+            totals.update(sketch_fields(self._sketches(start_date, end_date)))
+        return totals
+
+    def _added_uniques(self, segments, start_date, end_date):
+        """Returns the unique visitor and URL pairs viewed in the `segments`,
+        leaving out the ones also viewed between `start_date` and `end_date`,
+        scaled back up by the sample weights of the segments' pageviews.
+        """
+        pageviews = self.filter(_segments('view_time', segments))
+        seen = self.filter(
+            view_time__gte=start_date,
+            view_time__lt=end_date,
+        )
+        rows = self._weights(pageviews)
+        totals = {}
+        for prefix, registered in (('registered', True), ('guest', False)):
+            if rows[prefix + '_rows']:
+                totals[prefix + '_unique'] = _scaled(
+                    pageviews.filter(registered=registered).filter(
+                        ~Exists(seen.filter(
+                            registered=registered,
+                            visitor=OuterRef('visitor'),
+                            url=OuterRef('url'),
+                        )),
+                    ).values('visitor', 'url').distinct().count(),
+                    rows[prefix + '_weight'], rows[prefix + '_rows'])
+            else:
+                totals[prefix + '_unique'] = 0
+        return totals
+
+    def _sketches(self, start_date, end_date):
+        "Returns the sketches of the unique visitor and URL pairs."
+        pageviews = self.filter(
+            view_time__gte=start_date,
+            view_time__lt=end_date,
+        )
+        return dict(
+            (prefix, HyperLogLog.of(pageviews.filter(
+                registered=registered,
+            ).values_list('visitor', 'url').distinct().iterator()))
+            for prefix, registered in (('registered', True), ('guest', False)))
+
+
+class RollupManager(models.Manager):
+    """Manager of a rollup table of hourly and daily totals of the rows of
+    the `source` model. Rows are (re)computed with `build()`.
+    """
+    def __init__(self, source):
+        super(RollupManager, self).__init__()
+        self.source_name = source
+
+    @property
+    def source(self):
+        return self.model._meta.apps.get_model(
+            self.model._meta.app_label, self.source_name)._default_manager
+
+    def next_start(self):
+        "Returns where the next incremental `build()` should start from."
+        last = self.filter(period='hour').aggregate(
+            last=Max('start_time'))['last']
+        if last is not None:
+            return last + PERIODS['hour']
+
+        first = self.source.aggregate(
+            first=Min(self.source.time_field))['first']
+        if first is not None:
+            return floor_time(first, 'day')
+
+    def build(self, start_date, end_date):
+        """Computes the rollups of the hours in the range and of the days
+        ending in it. Returns the number of rollups written.
+        """
+        start_date = floor_time(start_date, 'hour')
+        end_date = floor_time(end_date, 'hour')
+        count = 0
+        for period, start in (('hour', start_date),
+                              ('day', floor_time(start_date, 'day'))):
+            step = PERIODS[period]
+            while start + step <= end_date:
+                self.update_or_create(
+                    period=period, start_time=start,
+                    defaults=self.source._rollup_totals(start, start + step))
+                start += step
+                count += 1
+        return count
+
+    def totals(self, start_date, end_date):
+        """Returns the source totals of the range, summed from the rollups
+        for the whole hours and days it covers. The rest of the range is
+        computed from the source rows.
+
+        Unique counts cannot be summed across the buckets, a visitor (or
+        page) seen in several buckets would be counted once per bucket. They
+        are counted from the source rows of the whole range, or with
+        `TRACK_APPROXIMATE_UNIQUES` estimated from the merged sketches of the
+        buckets.
+        """
+        source = self.source
+        rows, segments = self._buckets(start_date, end_date)
+        if rows is None:
+            return source._totals(start_date, end_date)
 
-        stats = {
-            'total': 0,
-            'unique': 0,
+        totals = rows.aggregate(
+            **{name: Sum(name) for name in source.totals_fields})
+        totals = dict((name, value or 0) for name, value in totals.items())
+        for segment in segments:
+            for name, value in source._totals(*segment).items():
+                totals[name] += value
+
+        sketches = None
+        if TRACK_APPROXIMATE_UNIQUES:
+            sketches = self._merged_sketches(rows, segments)
+        set_uniques(source, totals, sketches, start_date, end_date)
+        return totals
+
+    def sketches(self, start_date, end_date):
+        """Returns the merged sketches of the uniques of the range, from the
+        rollups where they cover it and from the source rows elsewhere.
+        """
+        rows, segments = self._buckets(start_date, end_date)
+        if rows is None:
+            return self.source._sketches(start_date, end_date)
+        return self._merged_sketches(rows, segments)
+
+    def _buckets(self, start_date, end_date):
+        """Returns the rollups of the whole hours and days of the range, and
+        the segments of the range left to compute from the source rows. The
+        rollups are None when the range is not rolled up at all.
+        """
+        covered = self.filter(period='hour').aggregate(
+            first=Min('start_time'), last=Max('start_time'))
+        if covered['first'] is None:
+            return None, [(start_date, end_date)]
+
+        start = ceil_time(max(start_date, covered['first']), 'hour')
+        end = floor_time(
+            min(end_date, covered['last'] + PERIODS['hour']), 'hour')
+        if start >= end:
+            return None, [(start_date, end_date)]
+
+        start_day = ceil_time(start, 'day')
+        end_day = floor_time(end, 'day')
+        if start_day < end_day:
+            buckets = (
+                Q(period='day', start_time__gte=start_day,
+                  start_time__lt=end_day)
+                | Q(period='hour', start_time__gte=start,
+                    start_time__lt=start_day)
+                | Q(period='hour', start_time__gte=end_day,
+                    start_time__lt=end)
+            )
+        else:
+            buckets = Q(period='hour', start_time__gte=start,
+                        start_time__lt=end)
+
+        segments = [segment for segment in ((start_date, start),
+                                            (end, end_date))
+                    if segment[0] < segment[1]]
+        return self.filter(buckets), segments
+
+    def _merged_sketches(self, rows, segments):
+        sketches = {'registered': HyperLogLog(), 'guest': HyperLogLog()}
+        for row in rows.values_list(
+                'registered_sketch', 'guest_sketch').iterator():
+            for prefix, data in zip(('registered', 'guest'), row):
+                if data:
+                    sketches[prefix].merge(HyperLogLog.from_bytes(data))
+        for segment in segments:
+            for prefix, sketch in self.source._sketches(*segment).items():
+                sketches[prefix].merge(sketch)
+        return sketches
+
+
+class InternManager(models.Manager):
+    """Interns values, e.g. URLs, into a table of distinct values. A value's
+    id is its hash, so the ids are known without a query, and the values
+    known to exist are remembered so they are only inserted once per process.
+    """
+    def __init__(self, field, cache_size):
+        super(InternManager, self).__init__()
+        self.field = field
+        self.cache_size = cache_size
+        self._known = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _new(self, pk, value):
+        return self.model(pk=pk, **{self.field: value})
+
+    def intern(self, values):
+        "Returns a dict of the ids of the `values`, inserting the new ones."
+        ids = {}
+        new = []
+        with self._lock:
+            for value in set(values):
+                if value is None:
+                    continue
+                ids[value] = self._known.get(value)
+                if ids[value] is None:
+                    ids[value] = text_hash(value)
+                    new.append(self._new(ids[value], value))
+                else:
+                    self._known.move_to_end(value)
+
+        if new:
+            self.bulk_create(new, ignore_conflicts=True)
+            # The rows are gone if the transaction is rolled back, they are
+            # only known to exist once it is committed
+            transaction.on_commit(
+                lambda: self._remember(new),
+                using=router.db_for_write(self.model))
+        return ids
+
+    def _remember(self, objs):
+        with self._lock:
+            for obj in objs:
+                self._known[getattr(obj, self.field)] = obj.pk
+            while len(self._known) > self.cache_size:
+                self._known.popitem(last=False)
+
+    def clear_cache(self):
+        with self._lock:
+            self._known.clear()
+
+
+class UserAgentManager(InternManager):
+    "Interns user agents along with their parsed browser, OS and device."
+
+    def __init__(self, cache_size):
+        super(UserAgentManager, self).__init__('user_agent', cache_size)
+
+    def _new(self, pk, value):
+        return self.model(pk=pk, user_agent=value, **parse_user_agent(value))
+
+
+class UrlRollupManager(models.Manager):
+    """Daily pageview totals per URL, as the page viewed and as the referer.
+    Each day built also has a row of each kind without a URL, holding the
+    total of the day, which marks the day as rolled up.
+    """
+    @property
+    def pageviews(self):
+        return self.model._meta.apps.get_model(
+            self.model._meta.app_label, 'Pageview')._default_manager
+
+    def next_start(self):
+        "Returns where the next incremental `build()` should start from."
+        last = self.aggregate(last=Max('start_time'))['last']
+        if last is not None:
+            return last + PERIODS['day']
+
+        first = self.pageviews.aggregate(first=Min('view_time'))['first']
+        if first is not None:
+            return floor_time(first, 'day')
+
+    def build(self, start_date, end_date):
+        """Computes the totals of the days ending in the range. Returns the
+        number of days written.
+        """
+        pageviews = self.pageviews
+        day = floor_time(start_date, 'day')
+        end_date = floor_time(end_date, 'hour')
+        count = 0
+        while day + PERIODS['day'] <= end_date:
+            rows = []
+            for kind, field in (('page', 'page'),
+                                ('referer', 'referer_page')):
+                urls = [
+                    self.model(kind=kind, start_time=day, url_id=pk,
+                               total=_weighted(total))
+                    for pk, total in pageviews.filter(**{
+                        'view_time__gte': day,
+                        'view_time__lt': day + PERIODS['day'],
+                        field + '__isnull': False,
+                    }).values_list(field).annotate(
+                        total=Sum('sample_weight'),
+                    ).order_by()]
+                rows.extend(urls)
+                rows.append(self.model(
+                    kind=kind, start_time=day, url_id=None,
+                    total=sum(row.total for row in urls)))
+            with transaction.atomic(using=self.db):
+                self.filter(start_time=day).delete()
+                self.bulk_create(rows)
+            day += PERIODS['day']
+            count += 1
+        return count
+
+    def add_totals(self, totals, kind, start_date, end_date):
+        """Adds the rolled up totals of the whole days of the range to the
+        `totals` Counter of URL ids. Returns the segments of the range that
+        are not rolled up.
+        """
+        first = ceil_time(start_date, 'day')
+        last = floor_time(end_date, 'day')
+        days = sorted(self.filter(
+            kind=kind, url=None, start_time__gte=first, start_time__lt=last,
+        ).values_list('start_time', flat=True))
+        if not days:
+            return [(start_date, end_date)]
+
+        for pk, total in self.filter(
+            kind=kind, start_time__in=days, url__isnull=False,
+        ).values_list('url').annotate(total=Sum('total')).order_by():
+            totals[pk] += total
+
+        # The time around and between the rolled up days
+        segments = []
+        start = start_date
+        for day in days:
+            if start < day:
+                segments.append((start, day))
+            start = day + PERIODS['day']
+        if start < end_date:
+            segments.append((start, end_date))
+        return segments
+
+
+def range_totals(manager, start_date, end_date):
+    if TRACK_CACHE_STATS:
+        return cached_totals(manager, start_date, end_date)
+    return _range_totals(manager, start_date, end_date)
+
+
+def settled_time(manager):
+    """Returns the end of the whole days whose totals no longer change and
+    are cached, see `TRACK_CACHE_STATS_DELAY`.
+    """
+    delay = timedelta(seconds=manager.settle_delay)
+    return floor_time(timezone.now() - delay, 'day')
+
+
+def cached_totals(manager, start_date, end_date):
+    """Returns the totals of the range from the cache where they are settled.
+
+    The totals of the whole settled days of the range, including their
+    unique counts, are cached together, so a range only reads one cache
+    entry for them and computes the rest of the range, e.g. the partial
+    first day and today, from the rows. The totals of a range that is
+    settled as a whole are cached as they are.
+
+    Unique counts are not summed, they are estimated from the merged
+    sketches with `TRACK_APPROXIMATE_UNIQUES`, otherwise the users (or
+    addresses, or pages) of the rest of the range which were not seen on
+    the settled days are added to the count of the days.
+    """
+    settled = settled_time(manager)
+    if end_date > settled:
+        return _split_totals(manager, start_date, end_date, settled)
+
+    key = stats_cache_key(manager.model._meta.label_lower, 'range',
+                          start_date.isoformat(), end_date.isoformat())
+    totals = cache.get(key)
+    if totals is None:
+        totals = _split_totals(manager, start_date, end_date, settled)
+        cache.set(key, totals, None)
+    return totals
+
+
+def _split_totals(manager, start_date, end_date, settled):
+    first = ceil_time(start_date, 'day')
+    last = min(floor_time(end_date, 'day'), settled)
+    if first >= last:
+        return _range_totals(manager, start_date, end_date)
+
+    days = _days_totals(manager, first, last)
+    additive = [name for name in manager.totals_fields
+                if not name.endswith('_unique')]
+    totals = dict((name, days[name]) for name in additive)
+    segments = [segment for segment in ((start_date, first), (last, end_date))
+                if segment[0] < segment[1]]
+    for segment in segments:
+        segment_totals = _range_totals(manager, *segment)
+        for name in additive:
+            totals[name] += segment_totals[name]
+
+    if TRACK_APPROXIMATE_UNIQUES:
+        sketches = _sketches(days)
+        for segment in segments:
+            for prefix, sketch in _range_sketches(manager, *segment).items():
+                sketches[prefix].merge(sketch)
+        set_uniques(manager, totals, sketches, start_date, end_date)
+    else:
+        added = {}
+        if segments:
+            added = manager._added_uniques(segments, first, last)
+        for prefix in ('registered', 'guest'):
+            name = prefix + '_unique'
+            totals[name] = days[name] + added.get(name, 0)
+    return totals
+
+
+def _days_totals(manager, first, last):
+    """Returns the totals of the settled days from `first` to `last`, with
+    the unique counts (or sketches) of all of them.
+    """
+    label = manager.model._meta.label_lower
+    version = stats_version()
+    key = stats_cache_key(label, 'days', first.isoformat(), last.isoformat(),
+                          version=version)
+    totals = cache.get(key)
+    if totals is not None:
+        return totals
+
+    days = {}
+    day = first
+    while day < last:
+        days[stats_cache_key(label, day.isoformat(), version=version)] = day
+        day += PERIODS['day']
+
+    additive = [name for name in manager.totals_fields
+                if not name.endswith('_unique')]
+    totals = dict.fromkeys(additive, 0)
+    sketches = None
+    if TRACK_APPROXIMATE_UNIQUES:
+        sketches = {'registered': HyperLogLog(), 'guest': HyperLogLog()}
+
+    cached = cache.get_many(list(days))
+    missing = {}
+    for day_key, day in days.items():
+        day_totals = cached.get(day_key)
+        if day_totals is None:
+            day_totals = missing[day_key] = _day_totals(manager, day)
+        for name in additive:
+            totals[name] += day_totals[name]
+        if sketches is not None:
+            for prefix, sketch in _sketches(day_totals).items():
+                sketches[prefix].merge(sketch)
+    if missing:
+        cache.set_many(missing, None)
+
+    if sketches is not None:
+        totals.update(sketch_fields(sketches))
+    else:
+        totals.update(manager._uniques(first, last))
+    cache.set(key, totals, None)
+    return totals
+
+
+def _sketches(totals):
+    "Returns the sketches of cached `sketch_fields()`."
+    sketches = {}
+    for prefix in ('registered', 'guest'):
+        data = totals[prefix + '_sketch']
+        sketches[prefix] = (HyperLogLog.from_bytes(data) if data
+                            else HyperLogLog())
+    return sketches
+
+
+def _day_totals(manager, day):
+    "Returns the totals of a day to cache, with its sketches if they are used."
+    totals = _range_totals(manager, day, day + PERIODS['day'])
+    if TRACK_APPROXIMATE_UNIQUES:
+        totals.update(sketch_fields(
+            _range_sketches(manager, day, day + PERIODS['day'])))
+    return totals
+
+
+def _segments(field, segments):
+    "Returns the filter of the rows whose `field` falls in the `segments`."
+    query = Q()
+    for start, end in segments:
+        query |= Q(**{field + '__gte': start, field + '__lt': end})
+    return query
+
+
+def _range_totals(manager, start_date, end_date):
+    if TRACK_USE_ROLLUPS:
+        return _rollups(manager).totals(start_date, end_date)
+    return manager._totals(start_date, end_date)
+
+
+def _range_sketches(manager, start_date, end_date):
+    if TRACK_USE_ROLLUPS:
+        return _rollups(manager).sketches(start_date, end_date)
+    return manager._sketches(start_date, end_date)
+
+
+def _rollups(manager):
+    return manager.model._meta.apps.get_model(
+        manager.model._meta.app_label, manager.rollup_model).objects
+
+
+def set_uniques(manager, totals, sketches, start_date, end_date):
+    """Sets the unique counts of the range in `totals`, estimated from the
+    merged `sketches` if given, otherwise counted from the source rows.
+    Sketches of sampled pageviews are scaled by their average weight, as
+    the exact counts are.
+    """
+    if sketches is not None:
+        for prefix, sketch in sketches.items():
+            count = sketch.count()
+            if prefix + '_rows' in totals:
+                count = _scaled(count, totals[prefix + '_total'],
+                                totals[prefix + '_rows'])
+            totals[prefix + '_unique'] = count
+    else:
+        totals.update(manager._uniques(start_date, end_date))
+
+
+def sketch_fields(sketches):
+    "Returns the rollup fields of sketches, None for the empty ones."
+    return dict(
+        (prefix + '_sketch', sketch.to_bytes() if any(sketch.registers)
+         else None)
+        for prefix, sketch in sketches.items())
+
+
+def _weighted(weight):
+    return int(round(weight or 0))
+
+
+def _scaled(count, weight, rows):
+    "Scales a count of sampled rows by their average weight."
+    if not rows:
+        return count
+    return int(round(count * (weight or 0) / rows))
+
+
+def _ratio(part, whole):
+    if whole:
+        return part / whole
+
+
+def _time_on_site(seconds, count):
+    if count:
+        return timedelta(seconds=int(seconds / count))
+
+
+def visitor_stats(totals, registered_only=False):
+    "Turns visitor totals into the dictionary returned by `stats()`."
+    registered_total = totals['registered_total']
+    guest_total = totals['guest_total']
+
+    stats = {
+        'total': 0,
+        'unique': 0,
+        'return_ratio': 0,
+    }
+
+    # All visitors
+    stats['total'] = total_count = registered_total + guest_total
+    unique_count = 0
+
+    # No visitors! Nothing more to do.
+    if not total_count:
+        return stats
+
+    # Avg time on site
+    stats['time_on_site'] = _time_on_site(
+        totals['registered_time_on_site'] + totals['guest_time_on_site'],
+        totals['registered_timed'] + totals['guest_timed'])
+
+    # Registered user sessions
+    if registered_total:
+        registered_unique_count = totals['registered_unique']
+
+        # Update the total unique count..
+        unique_count += registered_unique_count
+
+        # Set the registered stats..
+        returns = (registered_total - registered_unique_count)
+        stats['registered'] = {
+            'total': registered_total,
+            'unique': registered_unique_count,
+            'return_ratio': (returns / registered_total) * 100,
+            'time_on_site': _time_on_site(
+                totals['registered_time_on_site'],
+                totals['registered_timed']),
         }
 
-        stats['total'] = total_views = pageviews.count()
-        unique_count = 0
+    # Get stats for our guests..
+    include_guests = TRACK_ANONYMOUS_USERS and not registered_only
+    if include_guests:
+        if guest_total:
+            guest_unique_count = totals['guest_unique']
+            # return rate
+            returns = (guest_total - guest_unique_count)
+            return_ratio = (returns / guest_total) * 100
+            time_on_site = _time_on_site(
+                totals['guest_time_on_site'], totals['guest_timed'])
+        else:
+            guest_unique_count = 0
+            return_ratio = 0.0
+            time_on_site = timedelta(0)
 
-        if not total_views:
-            return stats
+        # Update the total unique count
+        unique_count += guest_unique_count
+        stats['guests'] = {
+            'total': guest_total,
+            'unique': guest_unique_count,
+            'return_ratio': return_ratio,
+            'time_on_site': time_on_site,
+        }
 
-        # Registered user sessions
-        registered_pageviews = pageviews.filter(visitor__user__isnull=False)
-        registered_count = registered_pageviews.count()
+    # Finish setting the total visitor counts
+    returns = (total_count - unique_count)
+    stats['unique'] = unique_count
+    stats['return_ratio'] = (returns / total_count) * 100
 
-        if registered_count:
-            registered_unique_count = registered_pageviews.values(
-                'visitor', 'url').distinct().count()
+    # If pageviews are being tracked, add the aggregate pages-per-visit
+    if TRACK_PAGEVIEWS:
+        if 'registered' in stats:
+            stats['registered']['pages_per_visit'] = _ratio(
+                totals['registered_pageviews'], totals['registered_paged'])
 
-            # Update the total unique count...
-            unique_count += registered_unique_count
+        if include_guests:
+            stats['guests']['pages_per_visit'] = _ratio(
+                totals['guest_pageviews'], totals['guest_paged'])
 
-            stats['registered'] = {
-                'total': registered_count,
-                'unique': registered_unique_count,
-            }
+            total_per_visit = _ratio(
+                totals['registered_pageviews'] + totals['guest_pageviews'],
+                totals['registered_paged'] + totals['guest_paged'])
+        else:
+            if 'registered' in stats:
+                total_per_visit = stats['registered']['pages_per_visit']
+            else:
+                total_per_visit = 0
 
-        if TRACK_ANONYMOUS_USERS and not registered_only:
-            guest_pageviews = pageviews.filter(visitor__user__isnull=True)
-            guest_count = guest_pageviews.count()
+        stats['pages_per_visit'] = total_per_visit
 
-            if guest_count:
-                guest_unique_count = guest_pageviews.values(
-                    'visitor', 'url').distinct().count()
+    return stats
 
-                # Update the total unique count...
-                unique_count += guest_unique_count
 
-                stats['guests'] = {
-                    'total': guest_count,
-                    'unique': guest_unique_count,
-                }
+def pageview_stats(totals, registered_only=False):
+    "Turns pageview totals into the dictionary returned by `stats()`."
+    stats = {
+        'total': 0,
+        'unique': 0,
+    }
 
-        # Finish setting the total visitor counts
-        stats['unique'] = unique_count
+    stats['total'] = total_views = (
+        totals['registered_total'] + totals['guest_total'])
+    unique_count = 0
 
+    if not total_views:
         return stats
+
+    # Registered user sessions
+    if totals['registered_total']:
+        # Update the total unique count...
+        unique_count += totals['registered_unique']
+
+        stats['registered'] = {
+            'total': totals['registered_total'],
+            'unique': totals['registered_unique'],
+        }
+
+    if TRACK_ANONYMOUS_USERS and not registered_only:
+        if totals['guest_total']:
+            # Update the total unique count...
+            unique_count += totals['guest_unique']
+
+            stats['guests'] = {
+                'total': totals['guest_total'],
+                'unique': totals['guest_unique'],
+            }
+
+    # Finish setting the total visitor counts
+    stats['unique'] = unique_count
+
+    return stats
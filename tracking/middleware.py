@@ -1,8 +1,13 @@
 import re
 import logging
+import time
 import warnings
+from functools import lru_cache
 
-from django.db import IntegrityError, transaction
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
 from django.utils import timezone
 from django.utils.encoding import smart_str
 try:
@@ -10,11 +15,21 @@ try:
 except ImportError:
     MiddlewareMixin = object
 
+from tracking.buffer import (
+    Hit, buffer, refresh_key, refresh_state, registered_key,
+)
 from tracking.models import Visitor, Pageview
-from tracking.utils import get_ip_address, total_seconds
+from tracking.presence import presence
+from tracking.sampling import sampler
+from tracking.useragents import is_bot
+from tracking.utils import compile_patterns, get_ip_address
+from tracking.writer import writer
 from tracking.settings import (
     TRACK_AJAX_REQUESTS,
     TRACK_ANONYMOUS_USERS,
+    TRACK_BACKGROUND_WRITES,
+    TRACK_BUFFERED_WRITES,
+    TRACK_IGNORE_BOTS,
     TRACK_IGNORE_STATUS_CODES,
     TRACK_IGNORE_URLS,
     TRACK_IGNORE_USER_AGENTS,
@@ -22,17 +37,54 @@ from tracking.settings import (
     TRACK_QUERY_STRING,
     TRACK_REFERER,
     TRACK_SUPERUSERS,
+    TRACK_USER_AGENT_CACHE_SIZE,
+    TRACK_VISITOR_REFRESH_INTERVAL,
 )
 
-track_ignore_urls = [re.compile(x) for x in TRACK_IGNORE_URLS]
-track_ignore_user_agents = [
-    re.compile(x, re.IGNORECASE) for x in TRACK_IGNORE_USER_AGENTS
-]
+track_ignore_urls = compile_patterns(TRACK_IGNORE_URLS)
+track_ignore_user_agents = compile_patterns(
+    TRACK_IGNORE_USER_AGENTS, re.IGNORECASE)
 
 log = logging.getLogger(__file__)
 
 
+def ignore_url(path):
+    return bool(track_ignore_urls and track_ignore_urls.match(path))
+
+
+# The same few user agents make up most of the traffic, remember the verdict
+@lru_cache(maxsize=TRACK_USER_AGENT_CACHE_SIZE)
+def ignore_user_agent(user_agent):
+    if TRACK_IGNORE_BOTS and is_bot(user_agent):
+        return True
+    pattern = track_ignore_user_agents
+    return bool(pattern and pattern.match(user_agent))
+
+
 class VisitorTrackingMiddleware(MiddlewareMixin):
+    sync_capable = True
+    async_capable = True
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        # The tracking writes do not depend on the request's thread, so rather
+        # than funnelling them through the single thread sensitive executor
+        # they are run in the shared pool of worker threads.
+        await sync_to_async(self._track_in_thread, thread_sensitive=False)(
+            request, response)
+        return response
+
+    def _track_in_thread(self, request, response):
+        try:
+            self.process_response(request, response)
+        finally:
+            # Worker threads are not covered by the request_finished signal
+            close_old_connections()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if getattr(view_func, 'tracking_exempt', False):
+            request.tracking_exempt = True
+
     def _should_track(self, user, request, response):
         # Session framework not installed, nothing to see here..
         if not hasattr(request, 'session'):
@@ -41,6 +93,10 @@ class VisitorTrackingMiddleware(MiddlewareMixin):
             warnings.warn(msg, RuntimeWarning)
             return False
 
+        # Do not track views marked with `tracking_exempt`
+        if getattr(request, 'tracking_exempt', False):
+            return False
+
         # Do not track AJAX requests
         if (
             request.META.get('HTTP_X_REQUESTED_WITH') == 'XMLHttpRequest'
@@ -61,82 +117,89 @@ class VisitorTrackingMiddleware(MiddlewareMixin):
             return False
 
         # Do not track ignored urls
-        path = request.path_info.lstrip('/')
-        for url in track_ignore_urls:
-            if url.match(path):
-                return False
+        if ignore_url(request.path_info.lstrip('/')):
+            return False
 
         # Do not track ignored user agents
-        user_agent = request.META.get('HTTP_USER_AGENT', '')
-        for user_agent_pattern in track_ignore_user_agents:
-            if user_agent_pattern.match(user_agent):
-                return False
+        if ignore_user_agent(request.META.get('HTTP_USER_AGENT', '')):
+            return False
 
         # everything says we should track this hit
         return True
 
-    def _refresh_visitor(self, user, request, visit_time):
-        # A Visitor row is unique by session_key
-        session_key = request.session.session_key
+    def _refresh_visitor(self, hit):
+        # Skip the write if this visitor was refreshed recently and nothing
+        # but its time on site and expiry would change. The cache entry
+        # expires with the refresh interval.
+        if TRACK_VISITOR_REFRESH_INTERVAL:
+            key = refresh_key(hit.session_key)
+            state = refresh_state(hit)
+            if cache.get(key) == state:
+                return
+
+        # A Visitor row is unique by session_key. The user is only set if the
+        # visitor has none yet, which implies authentication has occured on
+        # this request.
+        Visitor.objects.upsert(
+            hit.session_key, hit.ip_address, hit.time, user_id=hit.user_id,
+            user_agent=hit.user_agent, expiry_age=hit.expiry_age,
+            expiry_time=hit.expiry_time)
+
+        if TRACK_VISITOR_REFRESH_INTERVAL:
+            cache.set(key, state, TRACK_VISITOR_REFRESH_INTERVAL)
+
+        # Pageviews count as registered once their visitor has a user, also
+        # the ones written before it got it. Checked once per session.
+        if (
+            hit.user_id and TRACK_PAGEVIEWS
+            and cache.add(registered_key(hit.session_key), True,
+                          settings.SESSION_COOKIE_AGE)
+        ):
+            Pageview.objects.mark_registered([hit.session_key])
 
-        try:
-            visitor = Visitor.objects.get(pk=session_key)
-        except Visitor.DoesNotExist:
-            # Log the ip address. Start time is managed via the field
-            # `default` value
-            ip_address = get_ip_address(request)
-            visitor = Visitor(pk=session_key, ip_address=ip_address)
-
-        # Update the user field if the visitor user is not set. This
-        # implies authentication has occured on this request and now
-        # the user is object exists. Check using `user_id` to prevent
-        # a database hit.
-        if user and not visitor.user_id:
-            visitor.user_id = user.id
-
-        # update some session expiration details
-        visitor.expiry_age = request.session.get_expiry_age()
-        visitor.expiry_time = request.session.get_expiry_date()
-
-        # grab the latest User-Agent and store it
+    def _add_pageview(self, hit):
+        Pageview.objects.create(
+            visitor_id=hit.session_key, url=hit.url, view_time=hit.time,
+            method=hit.method, referer=hit.referer,
+            query_string=hit.query_string, registered=bool(hit.user_id),
+            sample_weight=hit.sample_weight)
+
+    def _build_hit(self, user, request, visit_time):
         user_agent = request.META.get('HTTP_USER_AGENT', None)
         if user_agent:
-            visitor.user_agent = smart_str(
+            user_agent = smart_str(
                 user_agent, encoding='latin-1', errors='ignore')
 
-        time_on_site = 0
-        if visitor.start_time:
-            time_on_site = total_seconds(visit_time - visitor.start_time)
-        visitor.time_on_site = int(time_on_site)
-
-        try:
-            with transaction.atomic():
-                visitor.save()
-        except IntegrityError:
-            # there is a small chance a second response has saved this
-            # Visitor already and a second save() at the same time (having
-            # failed to UPDATE anything) will attempt to INSERT the same
-            # session key (pk) again causing an IntegrityError
-            # If this happens we'll just grab the "winner" and use that!
-            visitor = Visitor.objects.get(pk=session_key)
-
-        return visitor
-
-    def _add_pageview(self, visitor, request, view_time):
-        referer = None
-        query_string = None
-
-        if TRACK_REFERER:
-            referer = request.META.get('HTTP_REFERER', None)
-
-        if TRACK_QUERY_STRING:
-            query_string = request.META.get('QUERY_STRING')
-
-        pageview = Pageview(
-            visitor=visitor, url=request.path, view_time=view_time,
-            method=request.method, referer=referer,
-            query_string=query_string)
-        pageview.save()
+        url = method = referer = query_string = None
+        sample_weight = self._sample_weight(request.session.session_key)
+        if TRACK_PAGEVIEWS and sample_weight is not None:
+            url = request.path
+            method = request.method
+            if TRACK_REFERER:
+                referer = request.META.get('HTTP_REFERER', None)
+            if TRACK_QUERY_STRING:
+                query_string = request.META.get('QUERY_STRING')
+
+        return Hit(
+            session_key=request.session.session_key,
+            user_id=user.id if user else None,
+            ip_address=get_ip_address(request),
+            user_agent=user_agent,
+            expiry_age=request.session.get_expiry_age(),
+            expiry_time=request.session.get_expiry_date(),
+            time=visit_time,
+            url=url,
+            method=method,
+            referer=referer,
+            query_string=query_string,
+            sample_weight=sample_weight or 1.0,
+        )
+
+    def _sample_weight(self, session_key):
+        queue_fill = 0
+        if TRACK_BACKGROUND_WRITES and writer.queue.maxsize:
+            queue_fill = writer.queue.qsize() / writer.queue.maxsize
+        return sampler.weight(session_key, queue_fill)
 
     def process_response(self, request, response):
         # If dealing with a non-authenticated user, we still should track the
@@ -160,10 +223,28 @@ class VisitorTrackingMiddleware(MiddlewareMixin):
         # is the only time we can guarantee.
         now = timezone.now()
 
+        hit = self._build_hit(user, request, now)
+
+        if presence is not None:
+            presence.touch(hit.session_key, hit.expiry_time,
+                           registered=hit.user_id is not None)
+
+        # hand the hit off to the worker threads
+        if TRACK_BACKGROUND_WRITES:
+            writer.put(hit)
+            return response
+
+        # defer the writes to the buffer, it is flushed in batches
+        if TRACK_BUFFERED_WRITES:
+            buffer.add(hit)
+            return response
+
         # update/create the visitor object for this request
-        visitor = self._refresh_visitor(user, request, now)
+        started = time.time()
+        self._refresh_visitor(hit)
 
-        if TRACK_PAGEVIEWS:
-            self._add_pageview(visitor, request, now)
+        if hit.url is not None:
+            self._add_pageview(hit)
+        sampler.record_latency(time.time() - started)
 
         return response
@@ -0,0 +1,54 @@
+# Generated by Django 4.2.30 on 2026-10-18 14:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracking', '0002_auto_20180918_2014'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VisitorRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day')], max_length=4)),
+                ('start_time', models.DateTimeField()),
+                ('registered_total', models.PositiveIntegerField(default=0)),
+                ('registered_unique', models.PositiveIntegerField(default=0)),
+                ('registered_time_on_site', models.BigIntegerField(default=0)),
+                ('registered_timed', models.PositiveIntegerField(default=0)),
+                ('registered_paged', models.PositiveIntegerField(default=0)),
+                ('registered_pageviews', models.PositiveIntegerField(default=0)),
+                ('guest_total', models.PositiveIntegerField(default=0)),
+                ('guest_unique', models.PositiveIntegerField(default=0)),
+                ('guest_time_on_site', models.BigIntegerField(default=0)),
+                ('guest_timed', models.PositiveIntegerField(default=0)),
+                ('guest_paged', models.PositiveIntegerField(default=0)),
+                ('guest_pageviews', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'ordering': ('-start_time',),
+                'unique_together': {('period', 'start_time')},
+            },
+        ),
+        migrations.CreateModel(
+            name='PageviewRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day')], max_length=4)),
+                ('start_time', models.DateTimeField()),
+                ('registered_total', models.PositiveIntegerField(default=0)),
+                ('registered_unique', models.PositiveIntegerField(default=0)),
+                ('guest_total', models.PositiveIntegerField(default=0)),
+                ('guest_unique', models.PositiveIntegerField(default=0)),
+                ('urls', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'ordering': ('-start_time',),
+                'unique_together': {('period', 'start_time')},
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+from django.db import migrations, models
+
+from tracking.operations import AddIndexConcurrently
+
+
+class Migration(migrations.Migration):
+
+    # Indexes are built concurrently on PostgreSQL, outside of a transaction
+    atomic = False
+
+    dependencies = [
+        ('tracking', '0003_rollups'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='pageview',
+            index=models.Index(fields=['visitor', 'view_time'], name='tracking_pageview_visitor_time'),
+        ),
+        AddIndexConcurrently(
+            model_name='visitor',
+            index=models.Index(fields=['start_time', 'user'], name='tracking_visitor_start_user'),
+        ),
+        AddIndexConcurrently(
+            model_name='visitor',
+            index=models.Index(condition=models.Q(('end_time', None)), fields=['expiry_time'], name='tracking_visitor_active'),
+        ),
+    ]
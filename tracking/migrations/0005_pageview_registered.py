@@ -0,0 +1,47 @@
+from django.db import migrations, models
+from django.db.models import Max, Min
+
+from tracking.operations import AddIndexConcurrently
+
+# Number of pageview ids updated at once, each batch is committed on its own
+BACKFILL_BATCH_SIZE = 10000
+
+
+def backfill_registered(apps, schema_editor):
+    Pageview = apps.get_model('tracking', 'Pageview')
+    pageviews = Pageview.objects.using(schema_editor.connection.alias)
+    bounds = pageviews.aggregate(first=Min('pk'), last=Max('pk'))
+    if bounds['first'] is None:
+        return
+
+    for start in range(bounds['first'], bounds['last'] + 1,
+                       BACKFILL_BATCH_SIZE):
+        batch = pageviews.filter(
+            pk__gte=start, pk__lt=start + BACKFILL_BATCH_SIZE,
+            registered=None)
+        batch.filter(visitor__user__isnull=False).update(registered=True)
+        batch.filter(visitor__user__isnull=True).update(registered=False)
+
+
+class Migration(migrations.Migration):
+
+    # The backfill commits per batch and the index is built concurrently on
+    # PostgreSQL, neither can run in a single transaction
+    atomic = False
+
+    dependencies = [
+        ('tracking', '0004_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pageview',
+            name='registered',
+            field=models.BooleanField(editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_registered, migrations.RunPython.noop),
+        AddIndexConcurrently(
+            model_name='pageview',
+            index=models.Index(fields=['view_time', 'registered'], name='tracking_pageview_time_reg'),
+        ),
+    ]
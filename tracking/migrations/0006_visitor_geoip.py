@@ -0,0 +1,40 @@
+from django.db import migrations, models
+
+from tracking.operations import AddIndexConcurrently
+
+
+class Migration(migrations.Migration):
+
+    # The index is built concurrently on PostgreSQL, outside of a transaction
+    atomic = False
+
+    dependencies = [
+        ('tracking', '0005_pageview_registered'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='visitor',
+            name='asn',
+            field=models.PositiveIntegerField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='visitor',
+            name='city',
+            field=models.CharField(editable=False, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='visitor',
+            name='country_code',
+            field=models.CharField(editable=False, max_length=2, null=True),
+        ),
+        migrations.AddField(
+            model_name='visitor',
+            name='region',
+            field=models.CharField(editable=False, max_length=10, null=True),
+        ),
+        AddIndexConcurrently(
+            model_name='visitor',
+            index=models.Index(fields=['start_time', 'country_code'], name='tracking_visitor_start_country'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracking', '0006_visitor_geoip'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pageviewrollup',
+            name='guest_sketch',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='pageviewrollup',
+            name='registered_sketch',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='visitorrollup',
+            name='guest_sketch',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='visitorrollup',
+            name='registered_sketch',
+            field=models.BinaryField(null=True),
+        ),
+    ]
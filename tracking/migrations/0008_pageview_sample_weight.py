@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracking', '0007_rollup_sketches'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pageview',
+            name='sample_weight',
+            field=models.FloatField(default=1, editable=False),
+        ),
+    ]
@@ -0,0 +1,88 @@
+from hashlib import blake2b
+
+from django.db import migrations, models
+from django.db.models import Max, Min
+import django.db.models.deletion
+
+# Number of pageview ids updated at once, each batch is committed on its own
+BACKFILL_BATCH_SIZE = 10000
+
+
+def url_hash(url):
+    # The URL ids as of this migration, a copy so later changes to the app
+    # do not change it
+    digest = blake2b(url.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') >> 1
+
+
+def backfill_urls(apps, schema_editor):
+    Url = apps.get_model('tracking', 'Url')
+    Pageview = apps.get_model('tracking', 'Pageview')
+    alias = schema_editor.connection.alias
+    pageviews = Pageview.objects.using(alias)
+    bounds = pageviews.aggregate(first=Min('pk'), last=Max('pk'))
+    if bounds['first'] is None:
+        return
+
+    for start in range(bounds['first'], bounds['last'] + 1,
+                       BACKFILL_BATCH_SIZE):
+        batch = list(pageviews.filter(
+            pk__gte=start, pk__lt=start + BACKFILL_BATCH_SIZE,
+            page=None).only('url', 'referer'))
+        urls = {}
+        for pageview in batch:
+            for url in (pageview.url, pageview.referer):
+                if url is not None and url not in urls:
+                    urls[url] = url_hash(url)
+            pageview.page_id = urls.get(pageview.url)
+            pageview.referer_page_id = urls.get(pageview.referer)
+
+        Url.objects.using(alias).bulk_create(
+            [Url(pk=pk, url=url) for url, pk in urls.items()],
+            ignore_conflicts=True)
+        pageviews.bulk_update(batch, ['page', 'referer_page'])
+
+
+class Migration(migrations.Migration):
+
+    # The backfill commits per batch
+    atomic = False
+
+    dependencies = [
+        ('tracking', '0008_pageview_sample_weight'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Url',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('url', models.TextField(editable=False)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='pageview',
+            name='page',
+            field=models.ForeignKey(db_constraint=False, db_index=False, editable=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='tracking.url'),
+        ),
+        migrations.AddField(
+            model_name='pageview',
+            name='referer_page',
+            field=models.ForeignKey(db_constraint=False, db_index=False, editable=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='tracking.url'),
+        ),
+        migrations.RunPython(backfill_urls, migrations.RunPython.noop),
+        migrations.CreateModel(
+            name='UrlRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('page', 'Page'), ('referer', 'Referer')], max_length=7)),
+                ('start_time', models.DateTimeField()),
+                ('total', models.PositiveIntegerField(default=0)),
+                ('url', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='tracking.url')),
+            ],
+            options={
+                'ordering': ('-start_time',),
+                'unique_together': {('kind', 'start_time', 'url')},
+            },
+        ),
+    ]
@@ -0,0 +1,134 @@
+import re
+from hashlib import blake2b
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Number of visitors updated at once, each batch is committed on its own
+BACKFILL_BATCH_SIZE = 10000
+
+# Copies of the user agent ids and parser as of this migration, so later
+# changes to the app do not change it
+BROWSER_RES = tuple((name, re.compile(pattern)) for name, pattern in (
+    ('Edge', r'Edg(?:e|A|iOS)?/'),
+    ('Opera', r'OPR/|Opera'),
+    ('Samsung Internet', r'SamsungBrowser/'),
+    ('Chrome', r'Chrome/|CriOS/'),
+    ('Firefox', r'Firefox/|FxiOS/'),
+    ('Safari', r'Safari/'),
+    ('IE', r'MSIE |Trident/'),
+))
+OS_RES = tuple((name, re.compile(pattern)) for name, pattern in (
+    ('iOS', r'iPhone|iPad|iPod'),
+    ('Android', r'Android'),
+    ('Windows', r'Windows'),
+    ('Mac OS X', r'Mac OS X'),
+    ('Chrome OS', r'CrOS'),
+    ('Linux', r'Linux'),
+))
+DEVICE_RES = tuple((name, re.compile(pattern)) for name, pattern in (
+    ('Tablet', r'iPad|Tablet'),
+    ('Mobile', r'Mobi|iPhone|iPod|Android'),
+))
+BOT_RE = re.compile(
+    r'bot\b|bot/|crawl|spider|slurp|archiver|facebookexternalhit|'
+    r'headless|curl/|wget/|python-|java/|go-http-client|okhttp',
+    re.IGNORECASE)
+
+
+def text_hash(value):
+    digest = blake2b(value.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') >> 1
+
+
+def family(patterns, user_agent):
+    for name, pattern in patterns:
+        if pattern.search(user_agent):
+            return name
+    return 'Other'
+
+
+def parse_user_agent(user_agent):
+    try:
+        from user_agents import parse
+    except ImportError:
+        is_bot = bool(BOT_RE.search(user_agent))
+        return {
+            'browser': family(BROWSER_RES, user_agent),
+            'os': family(OS_RES, user_agent),
+            'device': ('Spider' if is_bot
+                       else family(DEVICE_RES, user_agent)),
+            'is_bot': is_bot,
+        }
+
+    parsed = parse(user_agent)
+    return {
+        'browser': parsed.browser.family[:100],
+        'os': parsed.os.family[:100],
+        'device': parsed.device.family[:100],
+        'is_bot': parsed.is_bot,
+    }
+
+
+def backfill_user_agents(apps, schema_editor):
+    UserAgent = apps.get_model('tracking', 'UserAgent')
+    Visitor = apps.get_model('tracking', 'Visitor')
+    alias = schema_editor.connection.alias
+    visitors = Visitor.objects.using(alias).filter(
+        agent=None, user_agent__isnull=False).order_by('pk')
+    known = set()
+
+    # Batches of visitors in session key order, each continuing after the
+    # last key of the previous one
+    last = None
+    while True:
+        batch = visitors
+        if last is not None:
+            batch = batch.filter(pk__gt=last)
+        batch = list(batch.only('pk', 'user_agent')[:BACKFILL_BATCH_SIZE])
+        if not batch:
+            break
+
+        agents = {}
+        for visitor in batch:
+            if visitor.user_agent not in agents:
+                agents[visitor.user_agent] = text_hash(visitor.user_agent)
+            visitor.agent_id = agents[visitor.user_agent]
+        UserAgent.objects.using(alias).bulk_create(
+            [UserAgent(pk=pk, user_agent=user_agent,
+                       **parse_user_agent(user_agent))
+             for user_agent, pk in agents.items() if pk not in known],
+            ignore_conflicts=True)
+        known.update(agents.values())
+        Visitor.objects.using(alias).bulk_update(batch, ['agent'])
+        last = batch[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    # The backfill commits per batch
+    atomic = False
+
+    dependencies = [
+        ('tracking', '0009_urls'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserAgent',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('user_agent', models.TextField(editable=False)),
+                ('browser', models.CharField(editable=False, max_length=100)),
+                ('os', models.CharField(editable=False, max_length=100)),
+                ('device', models.CharField(editable=False, max_length=100)),
+                ('is_bot', models.BooleanField(default=False, editable=False)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='visitor',
+            name='agent',
+            field=models.ForeignKey(db_constraint=False, db_index=False, editable=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='tracking.useragent'),
+        ),
+        migrations.RunPython(backfill_user_agents, migrations.RunPython.noop),
+    ]
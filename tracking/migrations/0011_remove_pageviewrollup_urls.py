@@ -0,0 +1,15 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracking', '0010_user_agents'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='pageviewrollup',
+            name='urls',
+        ),
+    ]
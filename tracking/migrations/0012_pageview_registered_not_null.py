@@ -0,0 +1,46 @@
+from django.db import migrations, models
+from django.db.models import Max, Min
+
+from tracking.operations import AlterFieldNotNull
+
+# Number of pageview ids updated at once, each batch is committed on its own
+BACKFILL_BATCH_SIZE = 10000
+
+
+def backfill_registered(apps, schema_editor):
+    # Pageviews written by processes still running the code from before
+    # 0005 after its backfill
+    Pageview = apps.get_model('tracking', 'Pageview')
+    pageviews = Pageview.objects.using(schema_editor.connection.alias)
+    bounds = pageviews.filter(registered=None).aggregate(
+        first=Min('pk'), last=Max('pk'))
+    if bounds['first'] is None:
+        return
+
+    for start in range(bounds['first'], bounds['last'] + 1,
+                       BACKFILL_BATCH_SIZE):
+        batch = pageviews.filter(
+            pk__gte=start, pk__lt=start + BACKFILL_BATCH_SIZE,
+            registered=None)
+        batch.filter(visitor__user__isnull=False).update(registered=True)
+        batch.filter(visitor__user__isnull=True).update(registered=False)
+
+
+class Migration(migrations.Migration):
+
+    # The backfill commits per batch and the constraint is validated outside
+    # of the transaction making the column NOT NULL on PostgreSQL
+    atomic = False
+
+    dependencies = [
+        ('tracking', '0011_remove_pageviewrollup_urls'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_registered, migrations.RunPython.noop),
+        AlterFieldNotNull(
+            model_name='pageview',
+            name='registered',
+            field=models.BooleanField(editable=False),
+        ),
+    ]
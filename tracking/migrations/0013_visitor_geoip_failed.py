@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracking', '0012_pageview_registered_not_null'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='visitor',
+            name='geoip_failed',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+    ]
@@ -0,0 +1,31 @@
+from django.db import migrations, models
+from django.db.models import F
+
+
+def backfill_rows(apps, schema_editor):
+    # Exact for the pageviews stored before sampling, which weigh 1. The
+    # rollups table is small, one statement updates it
+    PageviewRollup = apps.get_model('tracking', 'PageviewRollup')
+    PageviewRollup.objects.using(schema_editor.connection.alias).update(
+        registered_rows=F('registered_total'), guest_rows=F('guest_total'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracking', '0013_visitor_geoip_failed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pageviewrollup',
+            name='guest_rows',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='pageviewrollup',
+            name='registered_rows',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_rows, migrations.RunPython.noop),
+    ]
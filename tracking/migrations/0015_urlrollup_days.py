@@ -0,0 +1,35 @@
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Sum
+
+# Number of day rows created at once
+BACKFILL_BATCH_SIZE = 1000
+
+
+def backfill_days(apps, schema_editor):
+    # The days built so far are those with URL totals. Days without any
+    # are computed from the pageviews, which are none or were never rolled up
+    UrlRollup = apps.get_model('tracking', 'UrlRollup')
+    rollups = UrlRollup.objects.using(schema_editor.connection.alias)
+    days = rollups.values('kind', 'start_time').annotate(
+        total=Sum('total')).order_by()
+    rollups.bulk_create(
+        (UrlRollup(kind=day['kind'], start_time=day['start_time'],
+                   url_id=None, total=day['total']) for day in days),
+        batch_size=BACKFILL_BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracking', '0014_pageviewrollup_rows'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='urlrollup',
+            name='url',
+            field=models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='tracking.url'),
+        ),
+        migrations.RunPython(backfill_days, migrations.RunPython.noop),
+    ]
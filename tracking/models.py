@@ -1,20 +1,39 @@
-import logging
-
 from django.conf import settings
 from django.db import models
+from django.db.models import Q
 from django.utils import timezone
 
-from tracking.managers import VisitorManager, PageviewManager
-from tracking.settings import TRACK_USING_GEOIP
+from tracking.geoip import HAS_GEOIP, geoip_lookup
+from tracking.managers import (
+    InternManager,
+    PageviewManager,
+    RollupManager,
+    UrlRollupManager,
+    UserAgentManager,
+    VisitorManager,
+)
+from tracking.settings import (
+    TRACK_URL_CACHE_SIZE,
+    TRACK_USER_AGENT_CACHE_SIZE,
+    TRACK_USING_GEOIP,
+)
 
-from django.contrib.gis.geoip2 import HAS_GEOIP2 as HAS_GEOIP
 
-if HAS_GEOIP:
-    from django.contrib.gis.geoip2 import GeoIP2, GeoIP2Exception
+class UserAgent(models.Model):
+    """A distinct user agent and its parsed families. The id is a hash of
+    the user agent, see `tracking.utils.text_hash`.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    user_agent = models.TextField(editable=False)
+    browser = models.CharField(max_length=100, editable=False)
+    os = models.CharField(max_length=100, editable=False)
+    device = models.CharField(max_length=100, editable=False)
+    is_bot = models.BooleanField(default=False, editable=False)
 
-GEOIP_CACHE_TYPE = getattr(settings, 'GEOIP_CACHE_TYPE', 4)
+    objects = UserAgentManager(TRACK_USER_AGENT_CACHE_SIZE)
 
-log = logging.getLogger(__file__)
+    def __str__(self):
+        return self.user_agent
 
 
 class Visitor(models.Model):
@@ -34,9 +53,26 @@ class Visitor(models.Model):
     expiry_time = models.DateTimeField(null=True, editable=False)
     time_on_site = models.IntegerField(null=True, editable=False)
     end_time = models.DateTimeField(null=True, editable=False)
+    # Stored GeoIP data, see `TRACK_GEOIP_ON_WRITE` and `tracking_geoip`
+    country_code = models.CharField(max_length=2, null=True, editable=False)
+    region = models.CharField(max_length=10, null=True, editable=False)
+    city = models.CharField(max_length=255, null=True, editable=False)
+    asn = models.PositiveIntegerField(null=True, editable=False)
+    geoip_failed = models.BooleanField(default=False, editable=False)
+    # The user agent in the table of distinct user agents, to group by
+    # browser with an integer join. Its id is derived from the user agent.
+    agent = models.ForeignKey(
+        UserAgent, null=True, editable=False, related_name='+',
+        db_index=False, db_constraint=False, on_delete=models.DO_NOTHING)
 
     objects = VisitorManager()
 
+    def save(self, *args, **kwargs):
+        if self.agent_id is None and self.user_agent:
+            self.agent_id = UserAgent.objects.intern(
+                [self.user_agent])[self.user_agent]
+        super(Visitor, self).save(*args, **kwargs)
+
     def session_expired(self):
         """The session has ended due to session expiration."""
         if self.expiry_time:
@@ -56,14 +92,7 @@ class Visitor(models.Model):
             return
 
         if not hasattr(self, '_geoip_data'):
-            self._geoip_data = None
-            try:
-                gip = GeoIP2(cache=GEOIP_CACHE_TYPE)
-                self._geoip_data = gip.city(self.ip_address)
-            except GeoIP2Exception:
-                msg = 'Error getting GeoIP data for IP "{0}"'.format(
-                    self.ip_address)
-                log.exception(msg)
+            self._geoip_data = geoip_lookup(self.ip_address)
 
         return self._geoip_data
 
@@ -72,6 +101,33 @@ class Visitor(models.Model):
         permissions = (
             ('visitor_log', 'Can view visitor'),
         )
+        indexes = (
+            # Date range stats, split by registered users and guests
+            models.Index(
+                fields=('start_time', 'user'),
+                name='tracking_visitor_start_user'),
+            # Active visitors, a partial index where supported
+            models.Index(
+                fields=('expiry_time',), condition=Q(end_time=None),
+                name='tracking_visitor_active'),
+            # Per country stats
+            models.Index(
+                fields=('start_time', 'country_code'),
+                name='tracking_visitor_start_country'),
+        )
+
+
+class Url(models.Model):
+    """A distinct URL, viewed or referring. The id is a hash of the URL, see
+    `tracking.utils.text_hash`.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    url = models.TextField(editable=False)
+
+    objects = InternManager('url', TRACK_URL_CACHE_SIZE)
+
+    def __str__(self):
+        return self.url
 
 
 class Pageview(models.Model):
@@ -85,8 +141,132 @@ class Pageview(models.Model):
     query_string = models.TextField(null=True, editable=False)
     method = models.CharField(max_length=20, null=True)
     view_time = models.DateTimeField()
+    # Whether the visitor has a user, copied from the visitor so the stats do
+    # not need to join it. The visitor's earlier pageviews are updated when it
+    # gets its user.
+    registered = models.BooleanField(editable=False)
+    # Number of pageviews this one stands for when pageviews are sampled
+    sample_weight = models.FloatField(default=1, editable=False)
+    # The URL and referer in the table of distinct URLs, so they are grouped
+    # by integer. Their id is derived from the URL, no constraint is needed,
+    # and pageviews are only looked up by time, not by URL.
+    page = models.ForeignKey(
+        Url, null=True, editable=False, related_name='+', db_index=False,
+        db_constraint=False, on_delete=models.DO_NOTHING)
+    referer_page = models.ForeignKey(
+        Url, null=True, editable=False, related_name='+', db_index=False,
+        db_constraint=False, on_delete=models.DO_NOTHING)
 
     objects = PageviewManager()
 
+    def save(self, *args, **kwargs):
+        if self.registered is None and self.visitor_id:
+            # A visitor that is not loaded yet is read from the cache
+            if Pageview.visitor.is_cached(self):
+                visitor = self.visitor
+            else:
+                visitor = Visitor.objects.get(pk=self.visitor_id)
+            self.registered = visitor.user_id is not None
+        if self.page_id is None and self.url:
+            ids = Url.objects.intern([self.url, self.referer])
+            self.page_id = ids[self.url]
+            self.referer_page_id = ids.get(self.referer)
+        super(Pageview, self).save(*args, **kwargs)
+
     class Meta(object):
         ordering = ('-view_time',)
+        indexes = (
+            models.Index(
+                fields=('visitor', 'view_time'),
+                name='tracking_pageview_visitor_time'),
+            models.Index(
+                fields=('view_time', 'registered'),
+                name='tracking_pageview_time_reg'),
+        )
+
+
+PERIOD_CHOICES = (
+    ('hour', 'Hour'),
+    ('day', 'Day'),
+)
+
+
+class VisitorRollup(models.Model):
+    """Totals of the visitors who started their visit in an hour or a day,
+    for registered users and guests. `unique` counts distinct users (or IP
+    addresses for guests), `timed` the visits with a time on site and
+    `paged` the visits with pageviews, which sum up to `pageviews`. With
+    `TRACK_APPROXIMATE_UNIQUES`, the `sketch` fields hold the HyperLogLog
+    sketches of the unique users and IP addresses.
+    """
+    period = models.CharField(max_length=4, choices=PERIOD_CHOICES)
+    start_time = models.DateTimeField()
+    registered_total = models.PositiveIntegerField(default=0)
+    registered_unique = models.PositiveIntegerField(default=0)
+    registered_time_on_site = models.BigIntegerField(default=0)
+    registered_timed = models.PositiveIntegerField(default=0)
+    registered_paged = models.PositiveIntegerField(default=0)
+    registered_pageviews = models.PositiveIntegerField(default=0)
+    guest_total = models.PositiveIntegerField(default=0)
+    guest_unique = models.PositiveIntegerField(default=0)
+    guest_time_on_site = models.BigIntegerField(default=0)
+    guest_timed = models.PositiveIntegerField(default=0)
+    guest_paged = models.PositiveIntegerField(default=0)
+    guest_pageviews = models.PositiveIntegerField(default=0)
+    registered_sketch = models.BinaryField(null=True)
+    guest_sketch = models.BinaryField(null=True)
+
+    objects = RollupManager('Visitor')
+
+    class Meta(object):
+        ordering = ('-start_time',)
+        unique_together = ('period', 'start_time')
+
+
+class PageviewRollup(models.Model):
+    """Totals of the pageviews viewed in an hour or a day. `unique` counts
+    distinct visitor and URL pairs. The `sketch` fields are the HyperLogLog
+    sketches of the pairs. `total` sums the sample weights of the `rows`
+    stored, which scales the sampled uniques back up.
+    """
+    period = models.CharField(max_length=4, choices=PERIOD_CHOICES)
+    start_time = models.DateTimeField()
+    registered_total = models.PositiveIntegerField(default=0)
+    registered_unique = models.PositiveIntegerField(default=0)
+    registered_rows = models.PositiveIntegerField(default=0)
+    guest_total = models.PositiveIntegerField(default=0)
+    guest_unique = models.PositiveIntegerField(default=0)
+    guest_rows = models.PositiveIntegerField(default=0)
+    registered_sketch = models.BinaryField(null=True)
+    guest_sketch = models.BinaryField(null=True)
+
+    objects = RollupManager('Pageview')
+
+    class Meta(object):
+        ordering = ('-start_time',)
+        unique_together = ('period', 'start_time')
+
+
+URL_KIND_CHOICES = (
+    ('page', 'Page'),
+    ('referer', 'Referer'),
+)
+
+
+class UrlRollup(models.Model):
+    """Pageview totals of a URL in a day, as the page viewed or as the
+    referer, built along with the `PageviewRollup` days. The row without a
+    `url` holds the total of the day and marks it as built.
+    """
+    kind = models.CharField(max_length=7, choices=URL_KIND_CHOICES)
+    start_time = models.DateTimeField()
+    url = models.ForeignKey(
+        Url, null=True, related_name='+', db_constraint=False,
+        on_delete=models.DO_NOTHING)
+    total = models.PositiveIntegerField(default=0)
+
+    objects = UrlRollupManager()
+
+    class Meta(object):
+        ordering = ('-start_time',)
+        unique_together = ('kind', 'start_time', 'url')
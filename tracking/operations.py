@@ -0,0 +1,68 @@
+from django.db import migrations
+
+
+class AddIndexConcurrently(migrations.AddIndex):
+    """Adds an index without blocking writes to the table on PostgreSQL
+    (`CREATE INDEX CONCURRENTLY`) and as a regular index elsewhere.
+
+    Concurrent index builds cannot run in a transaction, so migrations using
+    this operation must set `atomic = False`.
+    """
+    def database_forwards(self, app_label, schema_editor, from_state,
+                          to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.add_index(model, self.index, **self._options(
+                schema_editor))
+
+    def database_backwards(self, app_label, schema_editor, from_state,
+                           to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.remove_index(model, self.index, **self._options(
+                schema_editor))
+
+    def _options(self, schema_editor):
+        if schema_editor.connection.vendor == 'postgresql':
+            return {'concurrently': True}
+        return {}
+
+    def describe(self):
+        return 'Concurrently create index %s on field(s) %s of model %s' % (
+            self.index.name, ', '.join(self.index.fields), self.model_name)
+
+
+class AlterFieldNotNull(migrations.AlterField):
+    """Makes a column NOT NULL without blocking writes while the table is
+    scanned on PostgreSQL (12+). A `NOT VALID` check constraint is added and
+    validated first, which `SET NOT NULL` then uses instead of scanning the
+    table itself. Elsewhere this is a regular `AlterField`.
+
+    Migrations using this operation must set `atomic = False`, so the
+    validation does not run in the transaction holding the table's lock.
+    """
+    def database_forwards(self, app_label, schema_editor, from_state,
+                          to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return super(AlterFieldNotNull, self).database_forwards(
+                app_label, schema_editor, from_state, to_state)
+
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+        qn = schema_editor.quote_name
+        table = model._meta.db_table
+        column = model._meta.get_field(self.name).column
+        check = '%s_%s_not_null' % (table, column)
+        for sql in (
+            'ALTER TABLE %s ADD CONSTRAINT %s CHECK (%s IS NOT NULL) '
+            'NOT VALID' % (qn(table), qn(check), qn(column)),
+            'ALTER TABLE %s VALIDATE CONSTRAINT %s' % (qn(table), qn(check)),
+            'ALTER TABLE %s ALTER COLUMN %s SET NOT NULL' % (
+                qn(table), qn(column)),
+            'ALTER TABLE %s DROP CONSTRAINT %s' % (qn(table), qn(check)),
+        ):
+            schema_editor.execute(sql)
+
+    def describe(self):
+        return 'Set field %s on %s NOT NULL' % (self.name, self.model_name)
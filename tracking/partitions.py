@@ -0,0 +1,199 @@
+"""Monthly range partitioning of the pageview table by `view_time` on
+PostgreSQL (10+, 12+ for the foreign key to the visitor table).
+
+Partitions are named after the table and their month, e.g.
+`tracking_pageview_p201411`, and bounded in UTC. Dropping an expired
+partition replaces deleting its rows.
+"""
+import re
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db import transaction
+from django.db.models import Max
+
+from tracking.models import Pageview
+
+BOUND_RE = re.compile(r"FOR VALUES FROM \((.+)\) TO \((.+)\)")
+
+# Pageviews keep being written to the table while it is prepared, the bound
+# of the existing table is at least this far ahead of them
+SETUP_MARGIN = timedelta(days=1)
+
+
+def month_start(value):
+    if value.tzinfo is not None:
+        value = value.astimezone(dt_timezone.utc)
+    return datetime(value.year, value.month, 1, tzinfo=dt_timezone.utc)
+
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def partition_name(month):
+    return '%s_p%04d%02d' % (Pageview._meta.db_table, month.year, month.month)
+
+
+def is_partitioned(connection):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT 1 FROM pg_partitioned_table p JOIN pg_class c '
+            'ON c.oid = p.partrelid WHERE c.relname = %s',
+            [Pageview._meta.db_table])
+        return cursor.fetchone() is not None
+
+
+def partitions(connection):
+    """Returns the `(name, upper bound)` of the partitions, ordered by their
+    bound. The upper bound is None for an unbounded (MAXVALUE) partition.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) '
+            'FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+            'JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = %s',
+            [Pageview._meta.db_table])
+        rows = cursor.fetchall()
+
+        result = []
+        for name, bound in rows:
+            match = BOUND_RE.match(bound)
+            upper = match and match.group(2)
+            if upper and upper != 'MAXVALUE':
+                cursor.execute('SELECT %s::timestamptz' % upper)
+                upper = cursor.fetchone()[0]
+            else:
+                upper = None
+            result.append((name, upper))
+
+    unbounded = datetime.max.replace(tzinfo=dt_timezone.utc)
+    return sorted(result, key=lambda row: row[1] or unbounded)
+
+
+def legacy_bound(connection, now):
+    """Returns the upper bound of the partition of the existing pageviews:
+    the start of the month after the current one (or after the latest view
+    time, if that is later).
+    """
+    last = Pageview.objects.using(connection.alias).aggregate(
+        last=Max('view_time'))['last']
+    latest = max(now, last) if last is not None else now
+    return add_months(month_start(latest + SETUP_MARGIN), 1)
+
+
+def setup(connection, now):
+    """Turns the pageview table into a partitioned table. The existing table
+    becomes the partition of everything before `legacy_bound()`.
+
+    This must run in autocommit mode. The existing table is checked and
+    indexed for its partition first, without blocking writes, so only a
+    short transaction of catalog changes locks the table.
+    """
+    if connection.in_atomic_block:
+        raise RuntimeError('Partitioning setup cannot run in a transaction')
+
+    qn = connection.ops.quote_name
+    opts = Pageview._meta
+    table = opts.db_table
+    legacy = table + '_legacy'
+    bound = "'%s'::timestamptz" % legacy_bound(connection, now).isoformat()
+    check = table + '_partition_check'
+    key = table + '_partition_key'
+    visitor = opts.get_field('visitor')
+
+    # The check lets ATTACH PARTITION skip scanning the table, and the
+    # unique constraint matches the primary key of the partitioned table.
+    # VALIDATE and CONCURRENTLY do not block writes.
+    prepare = [
+        'ALTER TABLE %s ADD CONSTRAINT %s CHECK (%s IS NOT NULL AND %s < %s) '
+        'NOT VALID' % (qn(table), qn(check), qn('view_time'),
+                       qn('view_time'), bound),
+        'ALTER TABLE %s VALIDATE CONSTRAINT %s' % (qn(table), qn(check)),
+        'CREATE UNIQUE INDEX CONCURRENTLY %s ON %s (%s, %s)' % (
+            qn(key), qn(table), qn('id'), qn('view_time')),
+        'ALTER TABLE %s ADD CONSTRAINT %s UNIQUE USING INDEX %s' % (
+            qn(table), qn(key), qn(key)),
+    ]
+
+    swap = [
+        'ALTER TABLE %s RENAME TO %s' % (qn(table), qn(legacy)),
+        'CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING IDENTITY) '
+        'PARTITION BY RANGE (%s)' % (qn(table), qn(legacy), qn('view_time')),
+        # An identity column gets a new sequence, continue the legacy ids. A
+        # serial column keeps using the legacy sequence (and this is a no-op)
+        "SELECT setval(pg_get_serial_sequence('%s', 'id'), "
+        'COALESCE((SELECT MAX(%s) FROM %s), 1))' % (
+            table, qn('id'), qn(legacy)),
+        # Partitioned tables need the partition key in their primary key
+        'ALTER TABLE %s ADD PRIMARY KEY (%s, %s)' % (
+            qn(table), qn('id'), qn('view_time')),
+        'ALTER TABLE %s ADD FOREIGN KEY (%s) REFERENCES %s (%s) '
+        'DEFERRABLE INITIALLY DEFERRED' % (
+            qn(table), qn(visitor.column),
+            qn(visitor.related_model._meta.db_table),
+            qn(visitor.target_field.column)),
+    ]
+    # Indexes of the (still empty) partitioned table are matched with the
+    # equivalent indexes the legacy table already has when it is attached,
+    # rather than built
+    indexes = [(table + '_visitor_p', [visitor.column])]
+    for index in opts.indexes:
+        indexes.append((index.name + '_p', [
+            opts.get_field(name).column for name in index.fields]))
+    for name, columns in indexes:
+        swap.append('CREATE INDEX %s ON %s (%s)' % (
+            qn(name), qn(table), ', '.join(qn(c) for c in columns)))
+    swap.append(
+        'ALTER TABLE %s ATTACH PARTITION %s FOR VALUES FROM (MINVALUE) '
+        'TO (%s)' % (qn(table), qn(legacy), bound))
+
+    with connection.cursor() as cursor:
+        for sql in prepare:
+            cursor.execute(sql)
+    with transaction.atomic(using=connection.alias):
+        with connection.cursor() as cursor:
+            for sql in swap:
+                cursor.execute(sql)
+    with connection.cursor() as cursor:
+        cursor.execute('ALTER TABLE %s DROP CONSTRAINT %s' % (
+            qn(legacy), qn(check)))
+    return legacy
+
+
+def create_partitions(connection, now, months_ahead):
+    "Creates the missing monthly partitions up to `months_ahead` months."
+    qn = connection.ops.quote_name
+    existing = partitions(connection)
+    last = existing[-1][1] if existing else month_start(now)
+    if last is None:
+        return []
+
+    created = []
+    until = add_months(month_start(now), months_ahead + 1)
+    with connection.cursor() as cursor:
+        while last < until:
+            upper = add_months(last, 1)
+            name = partition_name(last)
+            cursor.execute(
+                "CREATE TABLE %s PARTITION OF %s FOR VALUES FROM ('%s') "
+                "TO ('%s')" % (qn(name), qn(Pageview._meta.db_table),
+                               last.isoformat(), upper.isoformat()))
+            created.append(name)
+            last = upper
+    return created
+
+
+def drop_partitions(connection, before):
+    "Detaches and drops the partitions only holding rows before `before`."
+    qn = connection.ops.quote_name
+    dropped = []
+    with connection.cursor() as cursor:
+        for name, upper in partitions(connection):
+            if upper is None or upper > before:
+                break
+            cursor.execute('ALTER TABLE %s DETACH PARTITION %s' % (
+                qn(Pageview._meta.db_table), qn(name)))
+            cursor.execute('DROP TABLE %s' % qn(name))
+            dropped.append(name)
+    return dropped
@@ -0,0 +1,184 @@
+"""Live presence of the active visitors, kept out of the database.
+
+The middleware records each tracked session with its expiry time as score,
+in one sorted set for all the visitors and another for registered users. A
+session is active until its expiry time, or until it is removed on logout,
+which mirrors `VisitorManager.active()`. Counting the active visitors is a
+range count over the scores, O(log n).
+
+`TRACK_PRESENCE` selects the backend: 'redis' (`redis` must be installed)
+for deployments of several processes, 'local' for a single process and the
+tests. Presence is off by default.
+"""
+import logging
+import threading
+import time
+from bisect import bisect_right, insort
+
+from tracking.settings import (
+    TRACK_PRESENCE,
+    TRACK_PRESENCE_PRUNE_INTERVAL,
+    TRACK_PRESENCE_REDIS_URL,
+)
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+log = logging.getLogger(__file__)
+
+# Sorts after any session key, so `(now, LAST_KEY)` follows all the sessions
+# expiring at `now`
+LAST_KEY = '\U0010ffff'
+
+
+class BasePresence(object):
+    sets = ('all', 'registered')
+
+    def __init__(self, prune_interval=TRACK_PRESENCE_PRUNE_INTERVAL):
+        self.prune_interval = prune_interval
+        self._last_prune = time.time()
+
+    def touch(self, session_key, expiry_time, registered=False):
+        "Records a session as active until `expiry_time`."
+        now = time.time()
+        self._add(session_key, expiry_time.timestamp(),
+                  self.sets if registered else self.sets[:1])
+        if now - self._last_prune >= self.prune_interval:
+            self._last_prune = now
+            self.prune(now)
+
+    def active_count(self, registered_only=False, now=None):
+        "Returns the number of active sessions, None if it is unavailable."
+        return self._count(self._set(registered_only), now or time.time())
+
+    def active_session_keys(self, registered_only=False, now=None):
+        "Returns the keys of the active sessions, None if unavailable."
+        return self._keys(self._set(registered_only), now or time.time())
+
+    def _set(self, registered_only):
+        return self.sets[1] if registered_only else self.sets[0]
+
+
+class LocalPresence(BasePresence):
+    "Sorted lists of `(expiry, session key)` in the memory of the process."
+
+    def __init__(self, *args, **kwargs):
+        super(LocalPresence, self).__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        self._scores = dict((name, {}) for name in self.sets)
+        self._sorted = dict((name, []) for name in self.sets)
+
+    def _add(self, session_key, score, sets):
+        with self._lock:
+            for name in sets:
+                self._discard(name, session_key)
+                self._scores[name][session_key] = score
+                insort(self._sorted[name], (score, session_key))
+
+    def _discard(self, name, session_key):
+        score = self._scores[name].pop(session_key, None)
+        if score is not None:
+            items = self._sorted[name]
+            del items[bisect_right(items, (score, session_key)) - 1]
+
+    def remove(self, session_key):
+        "Removes an ended session."
+        with self._lock:
+            for name in self.sets:
+                self._discard(name, session_key)
+
+    def prune(self, now=None):
+        "Forgets the expired sessions."
+        now = now or time.time()
+        with self._lock:
+            for name in self.sets:
+                items = self._sorted[name]
+                index = bisect_right(items, (now, LAST_KEY))
+                for _, session_key in items[:index]:
+                    del self._scores[name][session_key]
+                del items[:index]
+
+    def _count(self, name, now):
+        with self._lock:
+            items = self._sorted[name]
+            return len(items) - bisect_right(items, (now, LAST_KEY))
+
+    def _keys(self, name, now):
+        with self._lock:
+            items = self._sorted[name]
+            index = bisect_right(items, (now, LAST_KEY))
+            return [session_key for _, session_key in items[index:]]
+
+
+class RedisPresence(BasePresence):
+    "Redis sorted sets, shared by all the processes."
+    prefix = 'tracking:presence:'
+
+    def __init__(self, client, *args, **kwargs):
+        super(RedisPresence, self).__init__(*args, **kwargs)
+        self.client = client
+
+    def _add(self, session_key, score, sets):
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            for name in sets:
+                pipe.zadd(self.prefix + name, {session_key: score})
+            pipe.execute()
+        except redis.RedisError:
+            log.exception('Error recording the presence of a session')
+
+    def remove(self, session_key):
+        "Removes an ended session."
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            for name in self.sets:
+                pipe.zrem(self.prefix + name, session_key)
+            pipe.execute()
+        except redis.RedisError:
+            log.exception('Error removing the presence of a session')
+
+    def prune(self, now=None):
+        "Forgets the expired sessions."
+        now = now or time.time()
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            for name in self.sets:
+                pipe.zremrangebyscore(self.prefix + name, '-inf', now)
+            pipe.execute()
+        except redis.RedisError:
+            log.exception('Error pruning the presence of sessions')
+
+    def _count(self, name, now):
+        try:
+            return self.client.zcount(
+                self.prefix + name, '(%r' % now, '+inf')
+        except redis.RedisError:
+            # The visitor manager falls back to the database
+            log.exception('Error counting the active sessions')
+
+    def _keys(self, name, now):
+        try:
+            keys = self.client.zrangebyscore(
+                self.prefix + name, '(%r' % now, '+inf')
+        except redis.RedisError:
+            log.exception('Error getting the active sessions')
+            return None
+        return [key.decode() if isinstance(key, bytes) else key
+                for key in keys]
+
+
+def get_presence(backend=TRACK_PRESENCE):
+    if not backend:
+        return None
+    if backend == 'local':
+        return LocalPresence()
+    if backend == 'redis':
+        if redis is None:
+            raise ImportError('TRACK_PRESENCE = "redis" requires redis')
+        return RedisPresence(redis.Redis.from_url(TRACK_PRESENCE_REDIS_URL))
+    raise ValueError('Unknown TRACK_PRESENCE "{0}"'.format(backend))
+
+
+presence = get_presence()
@@ -0,0 +1,88 @@
+"""Sampling of the stored pageviews under load.
+
+Sessions are sampled as a whole: a session is kept when the hash of its key,
+mapped to [0, 1), is below the current rate. Each stored pageview records
+its weight, the inverse of that rate, and the stats sum the weights rather
+than count the rows.
+
+The rate is `TRACK_PAGEVIEW_SAMPLE_RATE`. With `TRACK_DYNAMIC_SAMPLING` it
+is lowered further while the background writer's queue is more than half
+full, and while the average write latency exceeds
+`TRACK_SAMPLING_LATENCY` seconds, down to `TRACK_SAMPLING_MIN_RATE`. A
+session then keeps the weight it got on its first request, in the cache,
+so it is still sampled as a whole.
+"""
+from hashlib import blake2b
+
+from django.conf import settings
+from django.core.cache import cache
+
+from tracking.settings import (
+    TRACK_DYNAMIC_SAMPLING,
+    TRACK_PAGEVIEW_SAMPLE_RATE,
+    TRACK_SAMPLING_LATENCY,
+    TRACK_SAMPLING_MIN_RATE,
+)
+
+
+def session_fraction(session_key):
+    "Maps a session key uniformly and deterministically to [0, 1)."
+    digest = blake2b(session_key.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') / 2 ** 64
+
+
+class PageviewSampler(object):
+
+    # Weight of the latest measure in the average write latency
+    smoothing = 0.2
+
+    def __init__(self, rate=1.0, dynamic=False, min_rate=0.01,
+                 latency=0.05):
+        self.base_rate = rate
+        self.dynamic = dynamic
+        self.min_rate = min_rate
+        self.target_latency = latency
+        self.latency = 0.0
+
+    def record_latency(self, seconds):
+        "Records the time taken to write a hit."
+        self.latency += self.smoothing * (seconds - self.latency)
+
+    def rate(self, queue_fill=0):
+        "Returns the current rate, given how full the write queue is."
+        rate = self.base_rate
+        if not self.dynamic:
+            return rate
+        if queue_fill > 0.5:
+            rate *= 2 * (1 - queue_fill)
+        if self.latency > self.target_latency:
+            rate *= self.target_latency / self.latency
+        return max(rate, self.min_rate)
+
+    def weight(self, session_key, queue_fill=0):
+        """Returns the weight of a pageview of the session if it is kept,
+        None if it is not.
+        """
+        if not self.dynamic:
+            return self._weight(session_key, self.base_rate)
+
+        # The rate changes over time, a session keeps the first decision
+        key = 'tracking.sample:%s' % session_key
+        weight = cache.get(key)
+        if weight is None:
+            # 0 stands for a session whose pageviews are skipped
+            weight = self._weight(session_key, self.rate(queue_fill)) or 0
+            cache.set(key, weight, settings.SESSION_COOKIE_AGE)
+        return weight or None
+
+    def _weight(self, session_key, rate):
+        if rate >= 1:
+            return 1.0
+        if session_fraction(session_key) < rate:
+            return 1 / rate
+        return None
+
+
+sampler = PageviewSampler(
+    TRACK_PAGEVIEW_SAMPLE_RATE, TRACK_DYNAMIC_SAMPLING,
+    TRACK_SAMPLING_MIN_RATE, TRACK_SAMPLING_LATENCY)
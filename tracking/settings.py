@@ -12,12 +12,66 @@ TRACK_IGNORE_URLS = getattr(settings, 'TRACK_IGNORE_URLS', (
 
 TRACK_IGNORE_USER_AGENTS = getattr(settings, 'TRACK_IGNORE_USER_AGENTS', tuple())
 
+TRACK_USER_AGENT_CACHE_SIZE = getattr(
+    settings, 'TRACK_USER_AGENT_CACHE_SIZE', 1024)
+
+TRACK_IGNORE_BOTS = getattr(settings, 'TRACK_IGNORE_BOTS', False)
+
 TRACK_IGNORE_STATUS_CODES = getattr(settings, 'TRACK_IGNORE_STATUS_CODES', [])
 
 TRACK_USING_GEOIP = getattr(settings, 'TRACK_USING_GEOIP', False)
 if hasattr(settings, 'TRACKING_USE_GEOIP'):
     raise DeprecationWarning('TRACKING_USE_GEOIP is now TRACK_USING_GEOIP')
 
+TRACK_GEOIP_CACHE_SIZE = getattr(settings, 'TRACK_GEOIP_CACHE_SIZE', 10000)
+
+TRACK_GEOIP_ASN_PATH = getattr(settings, 'TRACK_GEOIP_ASN_PATH', None)
+
+TRACK_GEOIP_ON_WRITE = getattr(settings, 'TRACK_GEOIP_ON_WRITE', False)
+
 TRACK_REFERER = getattr(settings, 'TRACK_REFERER', False)
 
 TRACK_QUERY_STRING = getattr(settings, 'TRACK_QUERY_STRING', False)
+
+TRACK_BUFFERED_WRITES = getattr(settings, 'TRACK_BUFFERED_WRITES', False)
+TRACK_BUFFER_SIZE = getattr(settings, 'TRACK_BUFFER_SIZE', 100)
+TRACK_BUFFER_TIMEOUT = getattr(settings, 'TRACK_BUFFER_TIMEOUT', 5)
+
+TRACK_PAGEVIEW_SAMPLE_RATE = getattr(
+    settings, 'TRACK_PAGEVIEW_SAMPLE_RATE', 1.0)
+TRACK_DYNAMIC_SAMPLING = getattr(settings, 'TRACK_DYNAMIC_SAMPLING', False)
+TRACK_SAMPLING_MIN_RATE = getattr(settings, 'TRACK_SAMPLING_MIN_RATE', 0.01)
+TRACK_SAMPLING_LATENCY = getattr(settings, 'TRACK_SAMPLING_LATENCY', 0.05)
+
+TRACK_VISITOR_REFRESH_INTERVAL = getattr(
+    settings, 'TRACK_VISITOR_REFRESH_INTERVAL', 0)
+
+TRACK_BACKGROUND_WRITES = getattr(settings, 'TRACK_BACKGROUND_WRITES', False)
+TRACK_WRITER_QUEUE_SIZE = getattr(settings, 'TRACK_WRITER_QUEUE_SIZE', 10000)
+TRACK_WRITER_THREADS = getattr(settings, 'TRACK_WRITER_THREADS', 1)
+TRACK_WRITER_OVERFLOW = getattr(settings, 'TRACK_WRITER_OVERFLOW', 'drop')
+TRACK_WRITER_SAMPLE_RATE = getattr(settings, 'TRACK_WRITER_SAMPLE_RATE', 0.1)
+
+TRACK_USE_ROLLUPS = getattr(settings, 'TRACK_USE_ROLLUPS', False)
+TRACK_ROLLUP_DELAY = getattr(settings, 'TRACK_ROLLUP_DELAY', 24 * 3600)
+TRACK_APPROXIMATE_UNIQUES = getattr(
+    settings, 'TRACK_APPROXIMATE_UNIQUES', False)
+
+TRACK_PRESENCE = getattr(settings, 'TRACK_PRESENCE', None)
+TRACK_PRESENCE_REDIS_URL = getattr(
+    settings, 'TRACK_PRESENCE_REDIS_URL', 'redis://localhost:6379/0')
+TRACK_PRESENCE_PRUNE_INTERVAL = getattr(
+    settings, 'TRACK_PRESENCE_PRUNE_INTERVAL', 60)
+
+TRACK_URL_CACHE_SIZE = getattr(settings, 'TRACK_URL_CACHE_SIZE', 10000)
+
+TRACK_CACHE_STATS = getattr(settings, 'TRACK_CACHE_STATS', False)
+TRACK_CACHE_STATS_DELAY = getattr(settings, 'TRACK_CACHE_STATS_DELAY', 3600)
+
+TRACK_DASHBOARD_USER_LIMIT = getattr(
+    settings, 'TRACK_DASHBOARD_USER_LIMIT', 100)
+
+TRACK_PARTITION_MONTHS_AHEAD = getattr(
+    settings, 'TRACK_PARTITION_MONTHS_AHEAD', 3)
+TRACK_PARTITION_RETENTION_MONTHS = getattr(
+    settings, 'TRACK_PARTITION_RETENTION_MONTHS', None)
@@ -0,0 +1,197 @@
+import time
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import OperationalError
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+
+from tracking import buffer
+from tracking.buffer import Hit, HitBuffer, write_hits
+from tracking.models import Visitor, Pageview
+
+
+def make_hit(session_key, time, **kwargs):
+    values = {
+        'session_key': session_key, 'user_id': None,
+        'ip_address': '10.0.0.1', 'user_agent': 'django', 'expiry_age': 60,
+        'expiry_time': time + timedelta(seconds=60), 'time': time,
+        'url': '/', 'method': 'GET', 'referer': None, 'query_string': None,
+    }
+    values.update(kwargs)
+    return Hit(**values)
+
+
+class WriteHitsTestCase(TestCase):
+
+    def setUp(self):
+        self.now = timezone.now()
+
+    def test_write_hits(self):
+        user = User.objects.create_user(username='foo')
+        later = self.now + timedelta(seconds=30)
+        write_hits([
+            make_hit('A', self.now),
+            make_hit('B', self.now, url=None),
+            make_hit('A', later, user_id=user.id, url='/foo/'),
+        ])
+        self.assertEqual(Visitor.objects.count(), 2)
+        self.assertEqual(Pageview.objects.count(), 2)
+
+        visitor = Visitor.objects.get(pk='A')
+        self.assertEqual(visitor.user, user)
+        self.assertEqual(visitor.start_time, self.now)
+        self.assertEqual(visitor.time_on_site, 30)
+        self.assertEqual(
+            list(visitor.pageviews.values_list('url', flat=True)),
+            ['/foo/', '/'])
+        # Both pageviews are the user's, as the visitor's
+        self.assertEqual(visitor.pageviews.filter(registered=True).count(), 2)
+
+    def test_write_hits_registered_later(self):
+        user = User.objects.create_user(username='foo')
+        write_hits([make_hit('A', self.now)])
+        self.assertFalse(Pageview.objects.get().registered)
+
+        later = self.now + timedelta(seconds=30)
+        write_hits([make_hit('A', later, user_id=user.id)])
+        self.assertEqual(Pageview.objects.filter(registered=True).count(), 2)
+
+    def test_write_hits_existing(self):
+        Visitor.objects.create(
+            pk='A', ip_address='10.0.0.1', start_time=self.now)
+        later = self.now + timedelta(seconds=45)
+        write_hits([make_hit('A', later, user_agent='other')])
+
+        self.assertEqual(Visitor.objects.count(), 1)
+        visitor = Visitor.objects.get(pk='A')
+        self.assertEqual(visitor.time_on_site, 45)
+        self.assertEqual(visitor.user_agent, 'other')
+        self.assertEqual(visitor.start_time, self.now)
+
+    def test_write_hits_conflict(self):
+        user = User.objects.create_user(username='foo')
+        Visitor.objects.create(
+            pk='A', ip_address='10.0.0.2', start_time=self.now, user=user)
+        later = self.now + timedelta(seconds=20)
+        # Another flush created the visitor after this one looked it up
+        with patch('tracking.buffer.Visitor.objects.in_bulk',
+                   side_effect=[{}, Visitor.objects.in_bulk(['A'])]):
+            write_hits([make_hit('A', later, user_agent='other')])
+
+        visitor = Visitor.objects.get(pk='A')
+        self.assertEqual(visitor.start_time, self.now)
+        self.assertEqual(visitor.ip_address, '10.0.0.2')
+        self.assertEqual(visitor.user, user)
+        self.assertEqual(visitor.user_agent, 'other')
+        self.assertEqual(visitor.time_on_site, 20)
+
+    @patch('tracking.buffer.TRACK_VISITOR_REFRESH_INTERVAL', 60)
+    def test_write_hits_throttle(self):
+        cache.clear()
+        write_hits([make_hit('A', self.now)], throttle=True)
+        later = self.now + timedelta(seconds=30)
+        write_hits([make_hit('A', later)], throttle=True)
+        self.assertEqual(Visitor.objects.get(pk='A').time_on_site, 0)
+        self.assertEqual(Pageview.objects.count(), 2)
+
+        # A new user agent is written anyway
+        write_hits([make_hit('A', later, user_agent='other')], throttle=True)
+        self.assertEqual(Visitor.objects.get(pk='A').time_on_site, 30)
+
+        # Without `throttle`, e.g. when importing logs, every batch is written
+        cache.clear()
+        write_hits([make_hit('B', self.now)], throttle=True)
+        write_hits([make_hit('B', later)])
+        self.assertEqual(Visitor.objects.get(pk='B').time_on_site, 30)
+        cache.clear()
+
+    @patch('tracking.buffer.TRACK_VISITOR_REFRESH_INTERVAL', 60)
+    def test_write_hits_throttle_skipped(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        write_hits([make_hit('A', self.now)], throttle=True)
+        later = self.now + timedelta(seconds=30)
+        # The interval of a skipped visitor is not extended
+        with patch('tracking.buffer.cache.set_many') as set_many:
+            write_hits([make_hit('A', later), make_hit('B', later)],
+                       throttle=True)
+        self.assertEqual(list(set_many.call_args[0][0]),
+                         ['tracking.refresh:B'])
+
+
+class HitBufferTestCase(TestCase):
+
+    def test_flush_on_size(self):
+        hit_buffer = HitBuffer(size=2, timeout=60, background=False)
+        hit_buffer.add(make_hit('A', timezone.now()))
+        self.assertEqual(len(hit_buffer), 1)
+        self.assertEqual(Visitor.objects.count(), 0)
+
+        hit_buffer.add(make_hit('B', timezone.now()))
+        self.assertEqual(len(hit_buffer), 0)
+        self.assertEqual(Visitor.objects.count(), 2)
+
+    def test_flush_on_timeout(self):
+        hit_buffer = HitBuffer(size=100, timeout=0, background=False)
+        hit_buffer.add(make_hit('A', timezone.now()))
+        self.assertEqual(len(hit_buffer), 0)
+        self.assertEqual(Visitor.objects.count(), 1)
+
+    def test_middleware(self):
+        hit_buffer = HitBuffer(size=100, timeout=60, background=False)
+        with patch('tracking.middleware.TRACK_BUFFERED_WRITES', True), \
+                patch('tracking.middleware.buffer', hit_buffer):
+            self.client.get('/')
+            self.client.get('/')
+        self.assertEqual(Visitor.objects.count(), 0)
+        self.assertEqual(len(hit_buffer), 2)
+
+        hit_buffer.flush()
+        self.assertEqual(Visitor.objects.count(), 2)
+        self.assertEqual(Pageview.objects.count(), 2)
+
+
+class HitBufferThreadTestCase(TransactionTestCase):
+
+    def wait_for(self, count):
+        for _ in range(100):
+            try:
+                if Visitor.objects.count() == count:
+                    break
+            except OperationalError:
+                # The in-memory test database locks the table being written
+                pass
+            time.sleep(0.05)
+        self.assertEqual(Visitor.objects.count(), count)
+
+    def test_background_flush(self):
+        hit_buffer = HitBuffer(size=2, timeout=60)
+        hit_buffer.add(make_hit('A', timezone.now()))
+        hit_buffer.add(make_hit('B', timezone.now()))
+        # The request that filled the buffer does not write it
+        self.wait_for(2)
+        self.assertEqual(len(hit_buffer), 0)
+
+    def test_background_flush_on_timeout(self):
+        hit_buffer = HitBuffer(size=100, timeout=0.2)
+        hit_buffer.add(make_hit('A', timezone.now()))
+        # No other hit arrives to make the buffer due
+        self.wait_for(1)
+        self.assertEqual(len(hit_buffer), 0)
+
+    def test_background_flush_error(self):
+        hit_buffer = HitBuffer(size=1, timeout=60)
+        with patch('tracking.buffer.write_hits',
+                   side_effect=[ValueError, None]) as write, \
+                self.assertLogs(buffer.log, 'ERROR'):
+            for count, key in enumerate('AB', 1):
+                hit_buffer.add(make_hit(key, timezone.now()))
+                for _ in range(100):
+                    if write.call_count == count:
+                        break
+                    time.sleep(0.05)
+                # The thread survives the failed write
+                self.assertEqual(write.call_count, count)
@@ -0,0 +1,234 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase
+from django.utils import timezone
+
+from tracking.cache import instance_cache_key, invalidate_stats
+from tracking.models import Visitor, Pageview
+
+
+class CacheManagerTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        Visitor.objects.hits = Visitor.objects.misses = 0
+
+    def test_get_cached(self):
+        visitor = Visitor.objects.create(pk='A', ip_address='10.0.0.1')
+        self.assertEqual(cache.get(instance_cache_key(visitor)), visitor)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(Visitor.objects.get(pk='A'), visitor)
+            self.assertEqual(Visitor.objects.get(session_key='A'), visitor)
+        self.assertEqual(Visitor.objects.cache_info(),
+                         {'hits': 2, 'misses': 0})
+
+    def test_get_read_through(self):
+        visitor = Visitor.objects.create(pk='A', ip_address='10.0.0.1')
+        cache.clear()
+
+        with self.assertNumQueries(1):
+            self.assertEqual(Visitor.objects.get(pk='A'), visitor)
+            self.assertEqual(Visitor.objects.get(pk='A'), visitor)
+        self.assertEqual(Visitor.objects.cache_info(),
+                         {'hits': 1, 'misses': 1})
+
+    def test_get_missing(self):
+        with self.assertRaises(Visitor.DoesNotExist):
+            Visitor.objects.get(pk='A')
+        self.assertEqual(Visitor.objects.cache_info(),
+                         {'hits': 0, 'misses': 1})
+
+    def test_get_not_pk(self):
+        Visitor.objects.create(pk='A', ip_address='10.0.0.1')
+        with self.assertNumQueries(1):
+            Visitor.objects.get(ip_address='10.0.0.1')
+        self.assertEqual(Visitor.objects.cache_info(),
+                         {'hits': 0, 'misses': 0})
+
+    def test_delete_invalidates(self):
+        visitor = Visitor.objects.create(pk='A', ip_address='10.0.0.1')
+        visitor.delete()
+        self.assertIsNone(cache.get(instance_cache_key(visitor)))
+        with self.assertRaises(Visitor.DoesNotExist):
+            Visitor.objects.get(pk='A')
+
+    def test_update_invalidates(self):
+        visitor = Visitor.objects.create(pk='A', ip_address='10.0.0.1')
+        Visitor.objects.filter(pk='A').update(ip_address='10.0.0.2')
+        self.assertIsNone(cache.get(instance_cache_key(visitor)))
+        self.assertEqual(Visitor.objects.get(pk='A').ip_address, '10.0.0.2')
+
+        visitor.ip_address = '10.0.0.3'
+        Visitor.objects.bulk_update([visitor], ['ip_address'])
+        self.assertEqual(Visitor.objects.get(pk='A').ip_address, '10.0.0.3')
+
+    def test_update_by_pk(self):
+        Visitor.objects.create(pk='A', ip_address='10.0.0.1')
+        b = Visitor.objects.create(pk='B', ip_address='10.0.0.1')
+        # The pks are taken from the filter, without reading the rows
+        with self.assertNumQueries(1):
+            Visitor.objects.filter(pk__in=['A']).update(ip_address='10.0.0.2')
+        self.assertEqual(Visitor.objects.get(pk='A').ip_address, '10.0.0.2')
+        self.assertEqual(cache.get(instance_cache_key(b)), b)
+
+    def test_update_not_by_pk(self):
+        visitor = Visitor.objects.create(pk='A', ip_address='10.0.0.1')
+        key = instance_cache_key(visitor)
+        with self.assertNumQueries(1):
+            Visitor.objects.filter(ip_address='10.0.0.1').update(
+                ip_address='10.0.0.2')
+        # All cached visitors are dropped
+        self.assertNotEqual(instance_cache_key(visitor), key)
+        self.assertEqual(Visitor.objects.get(pk='A').ip_address, '10.0.0.2')
+        self.assertEqual(Visitor.objects.cache_info(),
+                         {'hits': 0, 'misses': 1})
+
+
+@patch('tracking.managers.TRACK_CACHE_STATS', True)
+class StatsCacheTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.day = datetime(2014, 11, 3, tzinfo=dt_timezone.utc)
+        for i in range(3):
+            Visitor.objects.create(
+                session_key=str(i), ip_address='10.0.0.%d' % i,
+                start_time=self.day + timedelta(days=i, hours=10),
+                time_on_site=60)
+
+    def test_cached_days(self):
+        start, end = self.day, self.day + timedelta(days=3)
+        stats = Visitor.objects.stats(start, end)
+        self.assertEqual(stats['total'], 3)
+        self.assertEqual(stats['guests']['unique'], 3)
+
+        # the range is settled and cached as a whole
+        with self.assertNumQueries(0):
+            self.assertEqual(Visitor.objects.stats(start, end), stats)
+
+        # the partial day at the start is computed from the rows, the days
+        # after it are summed from the cached days, their uniques counted
+        with self.assertNumQueries(5):
+            stats = Visitor.objects.stats(start + timedelta(hours=11), end)
+        self.assertEqual(stats['total'], 2)
+        with self.assertNumQueries(0):
+            Visitor.objects.stats(start + timedelta(hours=11), end)
+
+    def test_uniques_across_days(self):
+        Visitor.objects.filter(pk='1').update(ip_address='10.0.0.0')
+        start, end = self.day, self.day + timedelta(days=3)
+        Visitor.objects.stats(start, end)
+        stats = Visitor.objects.stats(start, end)
+        self.assertEqual(stats['total'], 3)
+        self.assertEqual(stats['guests']['unique'], 2)
+
+        # the address of the partial day was also seen on the cached days
+        stats = Visitor.objects.stats(start - timedelta(hours=1), end)
+        self.assertEqual(stats['guests']['unique'], 2)
+        Visitor.objects.create(
+            session_key='A', ip_address='10.0.0.0',
+            start_time=start - timedelta(minutes=30))
+        Visitor.objects.create(
+            session_key='B', ip_address='10.0.0.9',
+            start_time=start - timedelta(minutes=30))
+        stats = Visitor.objects.stats(start - timedelta(hours=2), end)
+        self.assertEqual(stats['total'], 5)
+        self.assertEqual(stats['guests']['unique'], 3)
+
+    @patch('tracking.managers.TRACK_APPROXIMATE_UNIQUES', True)
+    def test_cached_sketches(self):
+        Visitor.objects.filter(pk='1').update(ip_address='10.0.0.0')
+        start, end = self.day, self.day + timedelta(days=3)
+        stats = Visitor.objects.stats(start, end)
+        self.assertEqual(stats['guests']['unique'], 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(Visitor.objects.stats(start, end), stats)
+
+    def test_open_range(self):
+        # Only today is computed, the settled days are read as one entry
+        today = timezone.now().replace(hour=0, minute=0, second=0,
+                                       microsecond=0)
+        for i in range(3):
+            Visitor.objects.create(
+                session_key='A%d' % i, ip_address='10.0.0.9',
+                start_time=today - timedelta(days=i))
+        start = today - timedelta(days=2)
+        end = timezone.now() + timedelta(hours=1)
+        with patch('tracking.managers.TRACK_CACHE_STATS_DELAY', 0):
+            Visitor.objects.stats(start, end)
+            # the totals of today, and today's new users and addresses
+            with self.assertNumQueries(4):
+                stats = Visitor.objects.stats(start, end)
+        self.assertEqual(stats['total'], 3)
+        self.assertEqual(stats['guests']['unique'], 1)
+
+    @patch('tracking.managers.TRACK_CACHE_STATS_DELAY', 3 * 86400)
+    def test_unsettled_days(self):
+        # Days whose visitors may still be refreshed are not cached
+        day = timezone.now().replace(hour=0, minute=0, second=0,
+                                     microsecond=0) - timedelta(days=2)
+        Visitor.objects.create(
+            session_key='A', ip_address='10.0.0.9', start_time=day)
+        Visitor.objects.stats(day, day + timedelta(days=1))
+        Visitor.objects.filter(pk='A').update(time_on_site=30)
+        stats = Visitor.objects.stats(day, day + timedelta(days=1))
+        self.assertEqual(stats['time_on_site'], timedelta(seconds=30))
+
+    @patch('tracking.managers.TRACK_CACHE_STATS_DELAY', 3 * 86400)
+    def test_pageviews_settled(self):
+        # Pageviews are cached once their day is over
+        day = timezone.now().replace(hour=0, minute=0, second=0,
+                                     microsecond=0) - timedelta(days=1)
+        visitor = Visitor.objects.get(pk='0')
+        Pageview.objects.create(visitor=visitor, url='/', view_time=day)
+        self.assertEqual(
+            Pageview.objects.stats(day, day + timedelta(days=1))['total'], 1)
+        with self.assertNumQueries(0):
+            Pageview.objects.stats(day, day + timedelta(days=1))
+
+    def test_pageviews_open_range(self):
+        today = timezone.now().replace(hour=0, minute=0, second=0,
+                                       microsecond=0)
+        visitor = Visitor.objects.get(pk='0')
+        for url, view_time in (('/', today - timedelta(hours=1)),
+                               ('/', today), ('/a/', today)):
+            Pageview.objects.create(
+                visitor=visitor, url=url, view_time=view_time)
+        start, end = today - timedelta(days=1), today + timedelta(hours=1)
+        Pageview.objects.stats(start, end)
+        stats = Pageview.objects.stats(start, end)
+        self.assertEqual(stats['total'], 3)
+        # the page viewed again today is counted once
+        self.assertEqual(stats['unique'], 2)
+
+    def test_user_stats(self):
+        user = User.objects.create_user(username='foo')
+        Visitor.objects.filter(pk='0').update(user=user)
+        start, end = self.day, self.day + timedelta(days=3)
+        users = Visitor.objects.user_stats(start, end)
+        self.assertEqual(users, [user])
+        with self.assertNumQueries(0):
+            self.assertEqual(Visitor.objects.user_stats(start, end), users)
+
+    def test_invalidate(self):
+        start, end = self.day, self.day + timedelta(days=3)
+        Visitor.objects.stats(start, end)
+        Visitor.objects.filter(pk='0').delete()
+        self.assertEqual(Visitor.objects.stats(start, end)['total'], 3)
+        invalidate_stats()
+        self.assertEqual(Visitor.objects.stats(start, end)['total'], 2)
+
+    def test_open_days(self):
+        now = timezone.now()
+        Visitor.objects.create(
+            session_key='A', ip_address='10.0.0.9', start_time=now)
+        start = now - timedelta(days=1)
+        Visitor.objects.stats(start, now + timedelta(hours=1))
+        Visitor.objects.create(
+            session_key='B', ip_address='10.0.0.9', start_time=now)
+        stats = Visitor.objects.stats(start, now + timedelta(hours=1))
+        self.assertEqual(stats['total'], 2)
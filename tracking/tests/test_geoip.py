@@ -1,18 +1,29 @@
+from io import StringIO
 from os import getenv
+from django.core.management import call_command
 from django.test import TestCase
+from django.utils import timezone
 from unittest.mock import patch
 
 from django.contrib.gis.geoip2 import HAS_GEOIP2
 if HAS_GEOIP2:
     from django.contrib.gis.geoip2 import GeoIP2Exception
+    from geoip2.errors import AddressNotFoundError
 
 from unittest import skipUnless
 
+from tracking import geoip
+from tracking.buffer import write_hits
 from tracking.models import Visitor  # noqa
+from tracking.tests.test_buffer import make_hit
 
 
 class GeoIPTestCase(TestCase):
 
+    def setUp(self):
+        geoip.reset()
+        self.addCleanup(geoip.reset)
+
     def test_geoip_none(self):
         v = Visitor.objects.create(ip_address='8.8.8.8')  # sorry Google
         self.assertEqual(v.geoip_data, None)
@@ -84,7 +95,95 @@ class GeoIPTestCase(TestCase):
 
     @patch('tracking.models.TRACK_USING_GEOIP', True)
     def test_geoip_exc(self):
-        with patch('tracking.models.GeoIP2', autospec=True) as mock_geo:
+        with patch('tracking.geoip.GeoIP2', autospec=True) as mock_geo:
             mock_geo.side_effect = GeoIP2Exception('bad data')
             v = Visitor.objects.create(ip_address='64.17.254.216')
             self.assertEqual(v.geoip_data, None)
+
+    @skipUnless(HAS_GEOIP2, 'geoip2 is not installed')
+    @patch('tracking.models.TRACK_USING_GEOIP', True)
+    def test_geoip_shared(self):
+        with patch('tracking.geoip.GeoIP2', autospec=True) as mock_geo:
+            mock_geo.return_value.city.side_effect = lambda ip: {'ip': ip}
+            for i in range(3):
+                v = Visitor.objects.create(
+                    session_key=str(i), ip_address='64.17.254.216')
+                self.assertEqual(v.geoip_data, {'ip': '64.17.254.216'})
+
+            self.assertEqual(
+                geoip.geoip_lookup_many(['81.2.69.160', '64.17.254.216',
+                                         '81.2.69.160']),
+                {'81.2.69.160': {'ip': '81.2.69.160'},
+                 '64.17.254.216': {'ip': '64.17.254.216'}})
+
+        # One reader and one lookup per distinct address
+        self.assertEqual(mock_geo.call_count, 1)
+        self.assertEqual(mock_geo.return_value.city.call_count, 2)
+
+
+@skipUnless(HAS_GEOIP2, 'geoip2 is not installed')
+@patch('tracking.geoip.TRACK_USING_GEOIP', True)
+class GeoIPFieldsTestCase(TestCase):
+
+    def setUp(self):
+        geoip.reset()
+        self.addCleanup(geoip.reset)
+        patcher = patch('tracking.geoip.GeoIP2', autospec=True)
+        self.city = patcher.start().return_value.city
+        self.addCleanup(patcher.stop)
+        self.city.return_value = {
+            'country_code': 'GB', 'region': 'ENG', 'city': 'London'}
+        self.fields = {
+            'country_code': 'GB', 'region': 'ENG', 'city': 'London',
+            'asn': None, 'geoip_failed': False}
+
+    def test_geoip_fields(self):
+        self.assertEqual(geoip.geoip_fields('81.2.69.160'), self.fields)
+        self.assertEqual(geoip.geoip_write_fields('81.2.69.160'), {})
+
+    @patch('tracking.geoip.TRACK_GEOIP_ON_WRITE', True)
+    def test_on_write(self):
+        now = timezone.now()
+        write_hits([make_hit('A', now, ip_address='81.2.69.160')])
+        visitor = Visitor.objects.get(pk='A')
+        self.assertEqual(visitor.country_code, 'GB')
+        self.assertEqual(visitor.city, 'London')
+
+        # only set when the visitor is created
+        geoip.reset()
+        self.city.return_value = {'country_code': 'US'}
+        write_hits([make_hit('A', now, ip_address='81.2.69.160')])
+        self.assertEqual(Visitor.objects.get(pk='A').country_code, 'GB')
+
+    @patch('tracking.geoip.TRACK_GEOIP_ON_WRITE', True)
+    def test_not_on_request(self):
+        # The synchronous middleware path leaves the lookup to the backfill
+        Visitor.objects.upsert('A', '81.2.69.160', timezone.now())
+        self.assertIsNone(Visitor.objects.get(pk='A').country_code)
+        self.assertEqual(self.city.call_count, 0)
+
+    def test_backfill(self):
+        for i in range(3):
+            Visitor.objects.create(
+                session_key=str(i), ip_address='81.2.69.16%d' % (i % 2))
+        Visitor.objects.filter(pk='2').update(country_code='US')
+
+        call_command('tracking_geoip', batch_size=1, stdout=StringIO())
+        self.assertEqual(
+            list(Visitor.objects.order_by('pk').values_list(
+                'country_code', 'city')),
+            [('GB', 'London'), ('GB', 'London'), ('US', None)])
+        self.assertEqual(self.city.call_count, 2)
+
+    def test_backfill_failed(self):
+        self.city.side_effect = AddressNotFoundError('not found')
+        Visitor.objects.create(session_key='A', ip_address='10.0.0.1')
+        call_command('tracking_geoip', stdout=StringIO())
+        self.assertTrue(Visitor.objects.get(pk='A').geoip_failed)
+
+        # Not looked up again, unless all the visitors are
+        call_command('tracking_geoip', stdout=StringIO())
+        self.assertEqual(self.city.call_count, 1)
+        geoip.reset()
+        call_command('tracking_geoip', all=True, stdout=StringIO())
+        self.assertEqual(self.city.call_count, 2)
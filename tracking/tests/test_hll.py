@@ -0,0 +1,30 @@
+from django.test import SimpleTestCase
+
+from tracking.hll import HyperLogLog
+
+
+class HyperLogLogTestCase(SimpleTestCase):
+
+    def test_count(self):
+        sketch = HyperLogLog.of(range(50000))
+        self.assertAlmostEqual(sketch.count() / 50000, 1, delta=0.04)
+        # duplicates do not count
+        sketch.update(range(1000))
+        self.assertAlmostEqual(sketch.count() / 50000, 1, delta=0.04)
+        self.assertEqual(HyperLogLog().count(), 0)
+        self.assertEqual(HyperLogLog.of(['a', 'b', 'a']).count(), 2)
+
+    def test_merge(self):
+        sketch = HyperLogLog.of(range(0, 20000))
+        sketch.merge(HyperLogLog.of(range(10000, 30000)))
+        self.assertAlmostEqual(sketch.count() / 30000, 1, delta=0.04)
+        with self.assertRaises(ValueError):
+            sketch.merge(HyperLogLog(p=10))
+
+    def test_bytes(self):
+        sketch = HyperLogLog.of([('A', '/'), ('A', '/a/'), ('B', '/')])
+        data = sketch.to_bytes()
+        self.assertLess(len(data), 200)
+        copy = HyperLogLog.from_bytes(memoryview(data))
+        self.assertEqual(copy.registers, sketch.registers)
+        self.assertEqual(copy.count(), 3)
@@ -0,0 +1,95 @@
+import json
+import os
+import tempfile
+from datetime import datetime, timedelta, timezone as dt_timezone
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from tracking.logs import parse_json_line, parse_log_line
+from tracking.models import Visitor, Pageview
+
+LINES = [
+    # two requests of one session, a third after more than 30 minutes
+    '10.0.0.1 - - [03/Nov/2014:10:00:00 +0100] "GET /a/?x=1 HTTP/1.1" 200 '
+    '512 "-" "Mozilla/5.0"',
+    '10.0.0.1 - - [03/Nov/2014:10:10:00 +0100] "GET /b/ HTTP/1.1" 200 '
+    '512 "http://example.com/" "Mozilla/5.0"',
+    '10.0.0.1 - - [03/Nov/2014:11:00:00 +0100] "GET /c/ HTTP/1.1" 200 '
+    '512 "-" "Mozilla/5.0"',
+    # another user agent on the same address is another visitor
+    '10.0.0.1 - - [03/Nov/2014:10:05:00 +0100] "POST /a/ HTTP/1.1" 200 '
+    '512 "-" "curl/7.0"',
+    # ignored url and an unparsable line
+    '10.0.0.2 - - [03/Nov/2014:10:05:00 +0100] "GET /favicon.ico HTTP/1.1" '
+    '200 512 "-" "Mozilla/5.0"',
+    'garbage',
+]
+
+
+class LogImportTestCase(TestCase):
+
+    def test_parse_log_line(self):
+        entry = parse_log_line(LINES[1])
+        self.assertEqual(entry.ip_address, '10.0.0.1')
+        self.assertEqual(
+            entry.time, datetime(2014, 11, 3, 9, 10, tzinfo=dt_timezone.utc))
+        self.assertEqual(entry.referer, 'http://example.com/')
+        self.assertEqual(entry.user_agent, 'Mozilla/5.0')
+        entry = parse_log_line(LINES[0])
+        self.assertEqual((entry.path, entry.query_string), ('/a/', 'x=1'))
+        self.assertIsNone(entry.referer)
+        self.assertIsNone(parse_log_line('garbage'))
+
+    def test_parse_json_line(self):
+        entry = parse_json_line(json.dumps({
+            'ip_address': '10.0.0.1', 'time': 1415005200, 'path': '/a/',
+            'status': 404}))
+        self.assertEqual(
+            entry.time, datetime(2014, 11, 3, 9, tzinfo=dt_timezone.utc))
+        self.assertEqual((entry.method, entry.status), ('GET', 404))
+        self.assertIsNone(parse_json_line('{"path": "/a/"}'))
+
+    def test_import(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'access.log')
+            with open(path, 'w') as f:
+                f.write('\n'.join(LINES) + '\n')
+            stdout = StringIO()
+            call_command('tracking_import_logs', path, batch_size=2,
+                         stdout=stdout)
+
+        self.assertIn('4 requests imported, 1 ignored, 1 unparsable',
+                      stdout.getvalue())
+        self.assertEqual(Pageview.objects.count(), 4)
+        visitors = Visitor.objects.order_by('start_time', 'user_agent')
+        self.assertEqual(
+            [(v.user_agent, v.time_on_site, v.pageviews.count())
+             for v in visitors],
+            [('Mozilla/5.0', 600, 2), ('curl/7.0', 0, 1),
+             ('Mozilla/5.0', 0, 1)])
+        self.assertEqual(
+            visitors[0].start_time,
+            datetime(2014, 11, 3, 9, tzinfo=dt_timezone.utc))
+        self.assertEqual(visitors[0].expiry_time,
+                         visitors[0].start_time + timedelta(minutes=40))
+
+    def test_import_again(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'access.log')
+            with open(path, 'w') as f:
+                f.write('\n'.join(LINES[:2]) + '\n')
+            call_command('tracking_import_logs', path, stdout=StringIO())
+
+            # The log grew since the first import
+            with open(path, 'a') as f:
+                f.write(LINES[2] + '\n')
+            stdout, stderr = StringIO(), StringIO()
+            call_command('tracking_import_logs', path, batch_size=2,
+                         stdout=stdout, stderr=stderr)
+
+        self.assertIn('1 requests imported', stdout.getvalue())
+        self.assertIn('2 requests were already imported', stderr.getvalue())
+        self.assertEqual(Pageview.objects.count(), 3)
+        self.assertEqual(Visitor.objects.count(), 2)
@@ -1,8 +1,11 @@
 from __future__ import division
 
 from datetime import timedelta
+from unittest.mock import patch
 
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import IntegrityError
 from django.test import TestCase
 from django.utils import timezone
 
@@ -12,6 +15,7 @@ from tracking.models import Visitor, Pageview
 class VisitorManagerTestCase(TestCase):
 
     def setUp(self):
+        cache.clear()
         self.user1 = User.objects.create_user(username='foo')
         self.user2 = User.objects.create_user(username='bar')
         self.base_time = timezone.now()
@@ -94,6 +98,11 @@ class VisitorManagerTestCase(TestCase):
         }
         self.assertEqual(stats['guests'], guests)
 
+    def test_visitor_stats_queries(self):
+        self._create_visits_and_views()
+        with self.assertNumQueries(2):
+            Visitor.objects.stats(self.past, self.future)
+
     def test_visitor_stats_registered(self):
         self._create_visits_and_views()
         start_time = self.base_time - timedelta(days=1)
@@ -175,6 +184,23 @@ class VisitorManagerTestCase(TestCase):
         self.assertEqual(user2.time_on_site, timedelta(seconds=30))
         self.assertEqual(user2.pages_per_visit, 1)
 
+    def test_user_stats_queries(self):
+        self._create_visits_and_views()
+        end_time = self.base_time + timedelta(days=1)
+        with self.assertNumQueries(2):
+            stats = Visitor.objects.user_stats(None, end_time)
+        self.assertEqual(
+            [user.pages_per_visit for user in stats], [1, 2.0])
+
+    def test_user_stats_limit(self):
+        self._create_visits_and_views()
+        end_time = self.base_time + timedelta(days=1)
+        stats = Visitor.objects.user_stats(None, end_time, limit=1)
+        self.assertEqual([user.username for user in stats], ['bar'])
+        stats = Visitor.objects.user_stats(None, end_time, limit=1, offset=1)
+        self.assertEqual([user.username for user in stats], ['foo'])
+        self.assertEqual(stats[0].pages_per_visit, 2.0)
+
     def test_pageview_stats(self):
         self._create_visits_and_views()
         # full time range for this
@@ -194,3 +220,105 @@ class VisitorManagerTestCase(TestCase):
             }
         }
         self.assertEqual(stats, expected)
+
+    def test_upsert(self):
+        Visitor.objects.upsert(
+            'A', '10.0.0.1', self.past, user_agent='django',
+            expiry_age=60, expiry_time=self.future)
+        visitor = Visitor.objects.get()
+        self.assertEqual(visitor.start_time, self.past)
+        self.assertEqual(visitor.time_on_site, 0)
+        self.assertEqual(visitor.user, None)
+
+        # refresh the visitor an hour later, after logging in
+        Visitor.objects.upsert(
+            'A', '10.0.0.2', self.present, user_id=self.user1.id,
+            expiry_age=120, expiry_time=self.future)
+        visitor = Visitor.objects.get(pk='A')
+        self.assertEqual(visitor.start_time, self.past)
+        self.assertEqual(visitor.time_on_site, 3600)
+        self.assertEqual(visitor.ip_address, '10.0.0.1')
+        self.assertEqual(visitor.user_agent, 'django')
+        self.assertEqual(visitor.user, self.user1)
+        self.assertEqual(visitor.expiry_age, 120)
+
+        # the user is kept
+        Visitor.objects.upsert(
+            'A', '10.0.0.1', self.present, user_id=self.user2.id)
+        self.assertEqual(Visitor.objects.get(pk='A').user, self.user1)
+
+    def test_refresh_fallback(self):
+        Visitor.objects._refresh(
+            'A', '10.0.0.1', self.past, None, 'django', 60, self.future)
+        Visitor.objects._refresh(
+            'A', '10.0.0.1', self.present, self.user1.id, None, 60,
+            self.future)
+        visitor = Visitor.objects.get(pk='A')
+        self.assertEqual(visitor.start_time, self.past)
+        self.assertEqual(visitor.time_on_site, 3600)
+        self.assertEqual(visitor.user_agent, 'django')
+        self.assertEqual(visitor.user, self.user1)
+
+    def test_refresh_conflict(self):
+        Visitor.objects.create(
+            session_key='A', ip_address='10.0.0.1', start_time=self.past)
+        save = Visitor.save
+        failed = []
+
+        def save_once(visitor, *args, **kwargs):
+            # a second response inserted the visitor first
+            if not failed:
+                failed.append(visitor)
+                raise IntegrityError
+            return save(visitor, *args, **kwargs)
+
+        with patch.object(Visitor, 'save', save_once), \
+                patch.object(Visitor.objects, 'get',
+                             side_effect=Visitor.DoesNotExist):
+            Visitor.objects._refresh(
+                'A', '10.0.0.2', self.present, self.user1.id, 'django', 60,
+                self.future)
+        visitor = Visitor.objects.get(pk='A')
+        self.assertEqual(visitor.start_time, self.past)
+        self.assertEqual(visitor.time_on_site, 3600)
+        self.assertEqual(visitor.user, self.user1)
+
+    def test_pageview_stats_view_time(self):
+        self._create_visits_and_views()
+        # visitor1 started in the past, but viewed a page in the present
+        stats = Pageview.objects.stats(self.present, self.future)
+        self.assertEqual(stats['total'], 1)
+        self.assertEqual(stats['registered'], {'total': 1, 'unique': 1})
+        self.assertNotIn('guests', stats)
+
+    def test_pageview_registered(self):
+        self._create_visits_and_views()
+        self.assertEqual(
+            Pageview.objects.filter(registered=True).count(), 3)
+        self.assertEqual(
+            Pageview.objects.filter(registered=False).count(), 1)
+
+    def test_pageview_registered_cached_visitor(self):
+        Visitor.objects.create(
+            user=self.user1, start_time=self.past, session_key='A')
+        # the visitor is read from the cache, not the database
+        with self.assertNumQueries(1):
+            pageview = Pageview.objects.create(
+                visitor_id='A', view_time=self.present)
+        self.assertTrue(pageview.registered)
+
+    def test_country_stats(self):
+        self._create_visits_and_views()
+        Visitor.objects.filter(pk__in=['A', 'B']).update(country_code='GB')
+        start_time = self.base_time - timedelta(days=1)
+        end_time = start_time + timedelta(days=3)
+        self.assertEqual(
+            Visitor.objects.country_stats(start_time, end_time), [
+                {'country_code': 'GB', 'total': 2,
+                 'time_on_site': timedelta(seconds=30)},
+                {'country_code': None, 'total': 1,
+                 'time_on_site': timedelta(seconds=30)},
+            ])
+        stats = Visitor.objects.country_stats(
+            start_time, end_time, registered_only=True)
+        self.assertEqual([row['country_code'] for row in stats], ['GB'])
@@ -1,10 +1,15 @@
 import re
 from unittest.mock import patch
 
+from asgiref.sync import sync_to_async
+
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.core.cache import cache
+from django.test import TestCase, TransactionTestCase
 
+from tracking.middleware import ignore_user_agent
 from tracking.models import Visitor, Pageview
+from tracking.utils import compile_patterns
 
 
 class MiddlewareTestCase(TestCase):
@@ -76,6 +81,23 @@ class MiddlewareTestCase(TestCase):
         visitor = Visitor.objects.get()
         self.assertEqual(visitor.user, user)
 
+    def test_track_user_registered_later(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        auth = {'username': 'me', 'password': 'me'}
+        User.objects.create_user(**auth)
+        self.assertTrue(self.client.login(**auth))
+        # A guest pageview of the session, before it had the user
+        session_key = self.client.session.session_key
+        visitor = Visitor.objects.create(pk=session_key, ip_address='10.0.0.1')
+        Pageview.objects.create(
+            visitor=visitor, url='/', view_time=visitor.start_time)
+        self.assertEqual(Pageview.objects.filter(registered=False).count(), 1)
+
+        self.client.get('/')
+        self.client.get('/')
+        self.assertEqual(Pageview.objects.filter(registered=True).count(), 3)
+
     @patch('tracking.middleware.TRACK_ANONYMOUS_USERS', False)
     def test_track_anonymous_users(self):
         self.client.get('/')
@@ -103,7 +125,7 @@ class MiddlewareTestCase(TestCase):
         self.assertEqual(Pageview.objects.count(), 0)
 
     def test_track_ignore_url(self):
-        ignore_urls = [re.compile('foo')]
+        ignore_urls = re.compile('foo')
         with patch('tracking.middleware.track_ignore_urls', ignore_urls):
             self.client.get('/')
             self.client.get('/foo/')
@@ -122,3 +144,53 @@ class MiddlewareTestCase(TestCase):
         view = Pageview.objects.get()
         self.assertEqual(view.referer, 'http://foo/bar')
         self.assertEqual(view.query_string, 'foo=bar&baz=bin')
+
+    @patch('tracking.middleware.TRACK_PAGEVIEWS', True)
+    @patch('tracking.middleware.TRACK_VISITOR_REFRESH_INTERVAL', 60)
+    def test_refresh_interval(self):
+        auth = {'username': 'me', 'password': 'me'}
+        User.objects.create_user(**auth)
+        self.assertTrue(self.client.login(**auth))
+
+        upsert = Visitor.objects.upsert
+        with patch.object(Visitor.objects, 'upsert', wraps=upsert) as mock:
+            self.client.get('/')
+            self.client.get('/')
+            self.assertEqual(mock.call_count, 1)
+            # a different user agent is written through
+            self.client.get('/', HTTP_USER_AGENT='django')
+            self.assertEqual(mock.call_count, 2)
+
+        self.assertEqual(Visitor.objects.count(), 1)
+        self.assertEqual(Pageview.objects.count(), 3)
+
+    def test_track_ignore_user_agent(self):
+        ignore_user_agent.cache_clear()
+        ignore_user_agents = compile_patterns(['.*bot', 'curl/'], re.I)
+        with patch('tracking.middleware.track_ignore_user_agents',
+                   ignore_user_agents):
+            self.client.get('/', HTTP_USER_AGENT='Googlebot/2.1')
+            self.client.get('/', HTTP_USER_AGENT='curl/7.64.1')
+            self.client.get('/', HTTP_USER_AGENT='Mozilla/5.0')
+        ignore_user_agent.cache_clear()
+        self.assertEqual(Visitor.objects.count(), 1)
+        self.assertEqual(Visitor.objects.get().user_agent, 'Mozilla/5.0')
+
+    @patch('tracking.middleware.TRACK_IGNORE_BOTS', True)
+    def test_track_ignore_bots(self):
+        ignore_user_agent.cache_clear()
+        self.client.get('/', HTTP_USER_AGENT=(
+            'Mozilla/5.0 (compatible; Googlebot/2.1; '
+            '+http://www.google.com/bot.html)'))
+        self.client.get('/', HTTP_USER_AGENT='Mozilla/5.0')
+        ignore_user_agent.cache_clear()
+        self.assertEqual(Visitor.objects.count(), 1)
+        self.assertEqual(Visitor.objects.get().user_agent, 'Mozilla/5.0')
+
+
+class AsyncMiddlewareTestCase(TransactionTestCase):
+
+    async def test_track_async(self):
+        await self.async_client.get('/')
+        count = await sync_to_async(Visitor.objects.count)()
+        self.assertEqual(count, 1)
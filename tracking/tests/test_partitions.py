@@ -0,0 +1,52 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+from unittest import skipUnless
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+
+from tracking import partitions
+from tracking.models import Visitor, Pageview
+from tracking.partitions import add_months, month_start, partition_name
+
+UTC = dt_timezone.utc
+
+
+class PartitionsTestCase(TestCase):
+
+    def test_months(self):
+        month = month_start(datetime(2014, 11, 15, 10, tzinfo=UTC))
+        self.assertEqual(month, datetime(2014, 11, 1, tzinfo=UTC))
+        self.assertEqual(add_months(month, 2), datetime(2015, 1, 1, tzinfo=UTC))
+        self.assertEqual(add_months(month, -11),
+                         datetime(2013, 12, 1, tzinfo=UTC))
+        self.assertEqual(partition_name(month), 'tracking_pageview_p201411')
+
+    def test_command_unsupported(self):
+        with self.assertRaises(CommandError):
+            call_command('tracking_partitions')
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Requires PostgreSQL')
+class PartitionsSetupTestCase(TransactionTestCase):
+
+    def test_setup(self):
+        now = timezone.now()
+        visitor = Visitor.objects.create(
+            pk='A', ip_address='10.0.0.1', start_time=now)
+        Pageview.objects.create(visitor=visitor, url='/', view_time=now)
+        # The existing table keeps taking the pageviews of the current month
+        partitions.setup(connection, now)
+        Pageview.objects.create(
+            visitor=visitor, url='/', view_time=now + timedelta(seconds=1))
+
+        bound = add_months(month_start(now + partitions.SETUP_MARGIN), 1)
+        self.assertEqual(partitions.partitions(connection),
+                         [('tracking_pageview_legacy', bound)])
+        self.assertEqual(Pageview.objects.count(), 2)
+
+        call_command('tracking_partitions', months_ahead=1)
+        self.assertEqual(partitions.partitions(connection)[1],
+                         (partition_name(bound), add_months(bound, 1)))
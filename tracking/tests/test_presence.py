@@ -0,0 +1,133 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+from unittest.mock import MagicMock, patch
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from tracking.models import Visitor
+from tracking.presence import LocalPresence, RedisPresence
+
+
+class LocalPresenceTestCase(TestCase):
+
+    def setUp(self):
+        self.presence = LocalPresence()
+        self.now = datetime(2014, 11, 3, tzinfo=dt_timezone.utc)
+        self.ts = self.now.timestamp()
+
+    def touch(self, session_key, minutes, registered=False):
+        self.presence.touch(
+            session_key, self.now + timedelta(minutes=minutes), registered)
+
+    def test_active(self):
+        self.touch('A', 10)
+        self.touch('B', 20, registered=True)
+        self.touch('C', -5)
+        self.assertEqual(self.presence.active_count(now=self.ts), 2)
+        self.assertEqual(
+            self.presence.active_count(registered_only=True, now=self.ts), 1)
+        self.assertEqual(
+            self.presence.active_session_keys(now=self.ts), ['A', 'B'])
+        self.assertEqual(
+            self.presence.active_count(now=self.ts + 15 * 60), 1)
+
+    def test_touch_again(self):
+        self.touch('A', 10)
+        self.touch('A', 30)
+        self.assertEqual(
+            self.presence.active_session_keys(now=self.ts + 20 * 60), ['A'])
+        self.presence.remove('A')
+        self.assertEqual(self.presence.active_count(now=self.ts), 0)
+
+    def test_prune(self):
+        self.touch('A', 10)
+        self.touch('B', -10, registered=True)
+        self.presence.prune(self.ts)
+        self.assertEqual(self.presence._sorted['all'],
+                         [(self.ts + 600, 'A')])
+        self.assertEqual(self.presence._scores['registered'], {})
+
+
+class RedisPresenceTestCase(TestCase):
+
+    def test_commands(self):
+        client = MagicMock()
+        client.zrangebyscore.return_value = [b'A']
+        presence = RedisPresence(client)
+        expiry = datetime(2014, 11, 3, tzinfo=dt_timezone.utc)
+
+        presence.touch('A', expiry, registered=True)
+        pipe = client.pipeline.return_value
+        pipe.zadd.assert_any_call(
+            'tracking:presence:registered', {'A': expiry.timestamp()})
+        self.assertEqual(pipe.zadd.call_count, 2)
+
+        presence.active_count(now=1.5)
+        client.zcount.assert_called_once_with(
+            'tracking:presence:all', '(1.5', '+inf')
+        self.assertEqual(presence.active_session_keys(now=1.5), ['A'])
+
+
+class FakeRedisError(Exception):
+    pass
+
+
+@patch('tracking.presence.redis', MagicMock(RedisError=FakeRedisError))
+class RedisOutageTestCase(TestCase):
+
+    def setUp(self):
+        self.redis = MagicMock()
+        self.redis.zcount.side_effect = FakeRedisError
+        self.redis.zrangebyscore.side_effect = FakeRedisError
+        patcher = patch(
+            'tracking.managers.presence', RedisPresence(self.redis))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_database_fallback(self):
+        now = datetime.now(dt_timezone.utc)
+        Visitor.objects.create(
+            session_key='A', ip_address='10.0.0.1', start_time=now,
+            expiry_time=now + timedelta(minutes=10))
+        self.assertEqual(Visitor.objects.active_count(False), 1)
+        self.assertEqual(
+            list(Visitor.objects.active(False).values_list('pk', flat=True)),
+            ['A'])
+        self.redis.zrangebyscore.assert_not_called()
+
+
+class PresenceTrackingTestCase(TestCase):
+
+    def setUp(self):
+        self.presence = LocalPresence()
+        for target in ('middleware', 'managers', 'handlers'):
+            patcher = patch('tracking.%s.presence' % target, self.presence)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_active(self):
+        User.objects.create_user(username='foo', password='bar')
+        self.client.get('/')
+        self.assertEqual(Visitor.objects.active_count(False), 1)
+        self.assertEqual(Visitor.objects.active_count(), 0)
+
+        self.client.login(username='foo', password='bar')
+        self.client.get('/')
+        self.assertEqual(Visitor.objects.active_count(), 1)
+        with self.assertNumQueries(0):
+            Visitor.objects.active_count()
+        self.assertEqual(
+            list(Visitor.objects.active().values_list('pk', flat=True)),
+            [self.client.session.session_key])
+
+        # Too many session keys for an IN list, the same from the database
+        # without fetching the keys
+        with patch('tracking.managers.ACTIVE_KEYS_LIMIT', 0), \
+                patch.object(self.presence, 'active_session_keys') as keys:
+            self.assertEqual(
+                list(Visitor.objects.active().values_list('pk', flat=True)),
+                [self.client.session.session_key])
+        keys.assert_not_called()
+
+        self.client.logout()
+        self.assertEqual(Visitor.objects.active_count(), 0)
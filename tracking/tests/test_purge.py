@@ -0,0 +1,65 @@
+import os
+import tempfile
+from datetime import datetime, timedelta, timezone as dt_timezone
+from io import StringIO
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+
+from tracking.cache import model_cache_key
+from tracking.models import Visitor, Pageview
+
+UTC = dt_timezone.utc
+
+
+class PurgeTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.cutoff = datetime(2014, 11, 1, tzinfo=UTC)
+        for i, session_key in enumerate('ABCDE'):
+            # A, C and E are before the cutoff
+            offset = timedelta(days=-1 if i % 2 == 0 else 1)
+            visitor = Visitor.objects.create(
+                session_key=session_key, ip_address='10.0.0.%d' % i,
+                start_time=self.cutoff + offset)
+            Pageview.objects.create(
+                visitor=visitor, url='/', view_time=visitor.start_time)
+            Pageview.objects.create(
+                visitor=visitor, url='/a/', view_time=visitor.start_time)
+
+    def purge(self, **options):
+        stdout = StringIO()
+        call_command('tracking_purge', before=self.cutoff, stdout=stdout,
+                     **options)
+        return stdout.getvalue()
+
+    def test_purge(self):
+        output = self.purge(batch_size=2)
+        self.assertIn('Deleted 3 visitors and 6 pageviews', output)
+        self.assertEqual(
+            sorted(Visitor.objects.values_list('pk', flat=True)), ['B', 'D'])
+        self.assertEqual(Pageview.objects.count(), 4)
+        self.assertIsNone(cache.get(model_cache_key(Visitor, 'A')))
+
+    def test_dry_run(self):
+        output = self.purge(dry_run=True)
+        self.assertIn('Would delete 3 visitors and 6 pageviews', output)
+        self.assertEqual(Visitor.objects.count(), 5)
+
+    def test_checkpoint(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'purge')
+            with open(path, 'w') as f:
+                f.write('A')
+            self.purge(checkpoint=path)
+            # Resumed after A, and the finished purge removes the checkpoint
+            self.assertTrue(Visitor.objects.filter(pk='A').exists())
+            self.assertEqual(Visitor.objects.count(), 3)
+            self.assertFalse(os.path.exists(path))
+
+    def test_cutoff_required(self):
+        with self.assertRaises(CommandError):
+            call_command('tracking_purge', stdout=StringIO())
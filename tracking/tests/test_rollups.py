@@ -0,0 +1,140 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+from io import StringIO
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase
+
+from tracking.models import Visitor, Pageview, VisitorRollup, PageviewRollup
+from tracking.utils import ceil_time, floor_time
+
+UTC = dt_timezone.utc
+
+
+class RollupTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='foo')
+        self.day = datetime(2014, 11, 3, tzinfo=UTC)
+        times = [
+            ('A', self.user, self.day + timedelta(hours=1)),
+            ('B', self.user, self.day + timedelta(hours=1, minutes=30)),
+            ('C', None, self.day + timedelta(hours=5)),
+            ('D', None, self.day + timedelta(days=1, hours=2)),
+        ]
+        for i, (session_key, user, start_time) in enumerate(times):
+            visitor = Visitor.objects.create(
+                session_key=session_key, user=user, start_time=start_time,
+                ip_address='10.0.0.%d' % i, time_on_site=60)
+            Pageview.objects.create(
+                visitor=visitor, url='/', view_time=start_time)
+
+    def rollup(self, since, until):
+        call_command('tracking_rollup', since=since, until=until,
+                     stdout=StringIO())
+
+    def test_time_buckets(self):
+        value = datetime(2014, 11, 3, 10, 30, tzinfo=UTC)
+        self.assertEqual(floor_time(value, 'hour'), value.replace(minute=0))
+        self.assertEqual(floor_time(value, 'day'), self.day)
+        self.assertEqual(ceil_time(value, 'hour'), value.replace(
+            hour=11, minute=0))
+        self.assertEqual(ceil_time(self.day, 'day'), self.day)
+
+    def test_build(self):
+        self.rollup(self.day, self.day + timedelta(days=2))
+        self.assertEqual(
+            VisitorRollup.objects.filter(period='hour').count(), 48)
+        self.assertEqual(
+            VisitorRollup.objects.filter(period='day').count(), 2)
+
+        hour = VisitorRollup.objects.get(
+            period='hour', start_time=self.day + timedelta(hours=1))
+        self.assertEqual(hour.registered_total, 2)
+        self.assertEqual(hour.registered_unique, 1)
+        self.assertEqual(hour.registered_time_on_site, 120)
+        self.assertEqual(hour.registered_pageviews, 2)
+        self.assertEqual(hour.guest_total, 0)
+
+        day = PageviewRollup.objects.get(period='day', start_time=self.day)
+        self.assertEqual(day.registered_total, 2)
+        self.assertEqual(day.guest_total, 1)
+
+    def test_build_incremental(self):
+        self.rollup(self.day, self.day + timedelta(hours=12))
+        self.assertEqual(VisitorRollup.objects.count(), 12)
+        self.assertEqual(
+            VisitorRollup.objects.next_start(),
+            self.day + timedelta(hours=12))
+
+        # continues where the last run stopped, completing the first day
+        self.rollup(None, self.day + timedelta(days=1))
+        self.assertEqual(
+            VisitorRollup.objects.filter(period='hour').count(), 24)
+        self.assertEqual(
+            VisitorRollup.objects.filter(period='day').count(), 1)
+
+    def test_stats(self):
+        start = self.day + timedelta(minutes=30)
+        end = self.day + timedelta(days=1, hours=6)
+        expected = (Visitor.objects.stats(start, end),
+                    Pageview.objects.stats(start, end))
+
+        # the second day is not rolled up yet, it is read from the raw rows
+        self.rollup(self.day, self.day + timedelta(days=1))
+        with patch('tracking.managers.TRACK_USE_ROLLUPS', True):
+            stats = (Visitor.objects.stats(start, end),
+                     Pageview.objects.stats(start, end))
+        self.assertEqual(stats, expected)
+        self.assertEqual(stats[0]['total'], 4)
+
+    @patch('tracking.managers.TRACK_APPROXIMATE_UNIQUES', True)
+    def test_stats_from_rollups(self):
+        self.rollup(self.day, self.day + timedelta(days=2))
+        Visitor.objects.all().delete()
+
+        with patch('tracking.managers.TRACK_USE_ROLLUPS', True):
+            stats = Visitor.objects.stats(
+                self.day, self.day + timedelta(days=2))
+        self.assertEqual(stats['total'], 4)
+        self.assertEqual(stats['registered']['unique'], 1)
+        self.assertEqual(stats['guests']['total'], 2)
+        self.assertEqual(stats['time_on_site'], timedelta(seconds=60))
+
+    def test_stats_unique_across_buckets(self):
+        Visitor.objects.create(
+            session_key='E', user=self.user, ip_address='10.0.0.1',
+            start_time=self.day + timedelta(days=1, hours=3), time_on_site=60)
+        self.rollup(self.day, self.day + timedelta(days=2))
+
+        end = self.day + timedelta(days=2)
+        self.assertEqual(
+            Visitor.objects.stats(self.day, end)['registered']['unique'], 1)
+        # the user visited on both days, but is counted once
+        with patch('tracking.managers.TRACK_USE_ROLLUPS', True):
+            stats = Visitor.objects.stats(self.day, end)
+            pageviews = Pageview.objects.stats(self.day, end)
+        self.assertEqual(stats['registered']['unique'], 1)
+        self.assertEqual(stats, Visitor.objects.stats(self.day, end))
+        self.assertEqual(pageviews['unique'], 4)
+
+    @patch('tracking.managers.TRACK_APPROXIMATE_UNIQUES', True)
+    def test_stats_approximate_uniques(self):
+        Visitor.objects.create(
+            session_key='E', user=self.user, ip_address='10.0.0.1',
+            start_time=self.day + timedelta(days=1, hours=3), time_on_site=60)
+        self.rollup(self.day, self.day + timedelta(days=1, hours=12))
+        day = VisitorRollup.objects.get(period='day', start_time=self.day)
+        self.assertIsNotNone(day.registered_sketch)
+
+        # the user is counted once from the merged sketches, the last hours
+        # are read from the raw rows
+        with patch('tracking.managers.TRACK_USE_ROLLUPS', True):
+            stats = Visitor.objects.stats(
+                self.day, self.day + timedelta(days=2))
+            pageviews = Pageview.objects.stats(
+                self.day, self.day + timedelta(days=2))
+        self.assertEqual(stats['registered']['unique'], 1)
+        self.assertEqual(stats['guests']['unique'], 2)
+        self.assertEqual(pageviews['unique'], 4)
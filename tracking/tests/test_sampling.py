@@ -0,0 +1,110 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.core.cache import cache
+from django.test import TestCase
+from django.utils import timezone
+
+from tracking.buffer import write_hits
+from tracking.models import Visitor, Pageview, PageviewRollup
+from tracking.sampling import PageviewSampler, sampler, session_fraction
+from tracking.tests.test_buffer import make_hit
+
+
+class SamplerTestCase(TestCase):
+
+    def test_session_fraction(self):
+        self.assertEqual(session_fraction('A'), session_fraction('A'))
+        fractions = [session_fraction(str(i)) for i in range(2000)]
+        self.assertTrue(all(0 <= f < 1 for f in fractions))
+        self.assertAlmostEqual(
+            sum(f < 0.25 for f in fractions) / 2000, 0.25, delta=0.05)
+
+    def test_weight(self):
+        self.assertEqual(PageviewSampler().weight('A'), 1)
+        sampler = PageviewSampler(rate=0.5)
+        weights = set(sampler.weight(str(i)) for i in range(100))
+        self.assertEqual(weights, {None, 2})
+        # whole sessions are in or out
+        self.assertEqual(
+            [sampler.weight(str(i)) for i in range(100)],
+            [sampler.weight(str(i)) for i in range(100)])
+
+    def test_dynamic_rate(self):
+        sampler = PageviewSampler(dynamic=True, min_rate=0.1, latency=0.05)
+        self.assertEqual(sampler.rate(), 1)
+        self.assertEqual(sampler.rate(queue_fill=0.75), 0.5)
+        self.assertEqual(sampler.rate(queue_fill=1), 0.1)
+        sampler.latency = 0.2
+        self.assertEqual(sampler.rate(), 0.25)
+        for _ in range(50):
+            sampler.record_latency(0.01)
+        self.assertEqual(sampler.rate(), 1)
+
+    def test_dynamic_rate_per_session(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        sampler = PageviewSampler(dynamic=True, min_rate=0.1, latency=0.05)
+        keys = [str(i) for i in range(100)]
+        self.assertEqual(set(sampler.weight(key) for key in keys), {1})
+
+        # The rate drops, the sessions started before keep their weight
+        sampler.latency = 0.5
+        self.assertEqual(set(sampler.weight(key) for key in keys), {1})
+        weights = set(sampler.weight(str(i)) for i in range(100, 200))
+        self.assertEqual(weights, {None, 10})
+
+    def test_import_latency(self):
+        # Only the live write paths feed the dynamic rate
+        latency = sampler.latency
+        write_hits([make_hit('A', timezone.now())])
+        self.assertEqual(sampler.latency, latency)
+
+
+class SampledStatsTestCase(TestCase):
+
+    def setUp(self):
+        self.now = timezone.now()
+        for i, weight in enumerate((1, 4)):
+            visitor = Visitor.objects.create(
+                session_key=str(i), ip_address='10.0.0.%d' % i,
+                start_time=self.now)
+            for url in ('/', '/a/'):
+                Pageview.objects.create(
+                    visitor=visitor, url=url, view_time=self.now,
+                    sample_weight=weight)
+
+    def test_stats(self):
+        start, end = self.now - timedelta(hours=1), self.now + timedelta(1)
+        stats = Pageview.objects.stats(start, end)
+        self.assertEqual(stats['total'], 10)
+        self.assertEqual(stats['unique'], 10)
+        stats = Visitor.objects.stats(start, end)
+        self.assertEqual(stats['guests']['pages_per_visit'], 2)
+
+    @patch('tracking.managers.TRACK_APPROXIMATE_UNIQUES', True)
+    def test_approximate_uniques(self):
+        start, end = self.now - timedelta(hours=1), self.now + timedelta(1)
+        # the raw rows and the rollups both scale the sketches
+        self.assertEqual(Pageview.objects.stats(start, end)['unique'], 10)
+        day = self.now.replace(hour=0, minute=0, second=0, microsecond=0)
+        PageviewRollup.objects.build(day, day + timedelta(days=1))
+        with patch('tracking.managers.TRACK_USE_ROLLUPS', True):
+            stats = Pageview.objects.stats(day, day + timedelta(days=1))
+        self.assertEqual(stats['unique'], 10)
+
+    @patch('tracking.middleware.sampler', PageviewSampler(rate=0.5))
+    def test_middleware(self):
+        for _ in range(10):
+            self.client.cookies.clear()
+            self.client.get('/')
+        # the visitors are all tracked, the pageviews of half of the sessions
+        visitors = Visitor.objects.exclude(pk__in=['0', '1'])
+        self.assertEqual(visitors.count(), 10)
+        for visitor in visitors:
+            weights = list(visitor.pageviews.values_list(
+                'sample_weight', flat=True))
+            if session_fraction(visitor.pk) < 0.5:
+                self.assertEqual(weights, [2])
+            else:
+                self.assertEqual(weights, [])
@@ -0,0 +1,125 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+from io import StringIO
+from unittest.mock import patch
+
+from django.core.management import call_command
+from django.db import DatabaseError, transaction
+from django.test import TestCase
+
+from tracking.buffer import Hit, write_hits
+from tracking.models import (
+    Pageview, PageviewRollup, Url, UrlRollup, Visitor)
+from tracking.utils import text_hash
+
+UTC = dt_timezone.utc
+
+
+class UrlTestCase(TestCase):
+
+    def setUp(self):
+        Url.objects.clear_cache()
+        self.day = datetime(2014, 11, 3, tzinfo=UTC)
+        self.visitor = Visitor.objects.create(
+            session_key='A', start_time=self.day, ip_address='10.0.0.1')
+        views = [
+            ('/', None, timedelta(hours=1)),
+            ('/', '/about/', timedelta(hours=2)),
+            ('/about/', '/', timedelta(hours=3)),
+            ('/', None, timedelta(days=1, hours=1)),
+            ('/contact/', '/', timedelta(days=1, hours=2)),
+            ('/contact/', '/', timedelta(days=1, hours=3)),
+        ]
+        # The interned URLs are remembered once committed
+        with self.captureOnCommitCallbacks(execute=True):
+            for url, referer, delta in views:
+                Pageview.objects.create(
+                    visitor=self.visitor, url=url, referer=referer,
+                    view_time=self.day + delta)
+
+    def test_intern(self):
+        self.assertEqual(Url.objects.count(), 3)
+        pageview = Pageview.objects.filter(referer='/about/').get()
+        self.assertEqual(pageview.page_id, text_hash('/'))
+        self.assertEqual(pageview.referer_page.url, '/about/')
+        self.assertIsNone(Pageview.objects.last().referer_page_id)
+
+        # Known URLs are not inserted again
+        with self.assertNumQueries(0):
+            ids = Url.objects.intern(['/', '/about/', None])
+        self.assertEqual(ids, {'/': text_hash('/'),
+                               '/about/': text_hash('/about/')})
+
+    def test_intern_rollback(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    Url.objects.intern(['/x/'])
+                    raise DatabaseError
+            except DatabaseError:
+                pass
+        self.assertFalse(Url.objects.filter(url='/x/').exists())
+        # Not remembered, so inserted again
+        with self.assertNumQueries(1):
+            Url.objects.intern(['/x/'])
+        self.assertTrue(Url.objects.filter(url='/x/').exists())
+
+    def test_write_hits(self):
+        write_hits([Hit(
+            session_key='A', user_id=None, ip_address='10.0.0.1',
+            user_agent=None, expiry_age=60, expiry_time=None,
+            time=self.day, url='/new/', method='GET', referer='/',
+            query_string=None)])
+        pageview = Pageview.objects.get(url='/new/')
+        self.assertEqual(pageview.page.url, '/new/')
+        self.assertEqual(pageview.referer_page_id, text_hash('/'))
+
+    def test_top(self):
+        end = self.day + timedelta(days=2)
+        self.assertEqual(Pageview.objects.top_urls(self.day, end), [
+            {'url': '/', 'total': 3},
+            {'url': '/contact/', 'total': 2},
+            {'url': '/about/', 'total': 1},
+        ])
+        self.assertEqual(
+            Pageview.objects.top_referers(self.day, end, n=1),
+            [{'url': '/', 'total': 3}])
+
+    def test_top_rollups(self):
+        call_command('tracking_rollup', since=self.day,
+                     until=self.day + timedelta(days=1), stdout=StringIO())
+        self.assertEqual(UrlRollup.objects.count(), 6)
+        self.assertEqual(UrlRollup.objects.get(
+            kind='page', url_id=text_hash('/')).total, 2)
+        self.assertEqual(UrlRollup.objects.get(kind='page', url=None).total, 3)
+
+        end = self.day + timedelta(days=2)
+        expected = Pageview.objects.top_referers(self.day, end)
+        # The rolled up first day is no longer read from the pageviews
+        Pageview.objects.filter(
+            view_time__lt=self.day + timedelta(days=1)).delete()
+        with patch('tracking.managers.TRACK_USE_ROLLUPS', True):
+            self.assertEqual(
+                Pageview.objects.top_referers(self.day, end), expected)
+            self.assertEqual(
+                Pageview.objects.top_urls(self.day, end, n=1),
+                [{'url': '/', 'total': 3}])
+
+    def test_top_rollups_missing(self):
+        # A day of pageview rollups without URL rollups is not covered
+        PageviewRollup.objects.build(self.day, self.day + timedelta(days=1))
+        end = self.day + timedelta(days=2)
+        with patch('tracking.managers.TRACK_USE_ROLLUPS', True):
+            self.assertEqual(
+                Pageview.objects.top_urls(self.day, end, n=1),
+                [{'url': '/', 'total': 3}])
+
+    def test_top_rollups_empty_day(self):
+        # A day without pageviews is covered, the pageviews added after its
+        # rollup are not read
+        before = self.day - timedelta(days=1)
+        UrlRollup.objects.build(before, self.day)
+        Pageview.objects.create(
+            visitor=self.visitor, url='/late/', view_time=before)
+        with patch('tracking.managers.TRACK_USE_ROLLUPS', True):
+            self.assertEqual(
+                Pageview.objects.top_urls(before, self.day), [])
@@ -0,0 +1,64 @@
+from datetime import timedelta
+
+from django.test import TestCase
+from django.utils import timezone
+
+from tracking.models import UserAgent, Visitor
+from tracking.useragents import _parse_fallback
+from tracking.utils import text_hash
+
+CHROME = ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+          '(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36')
+SAFARI = ('Mozilla/5.0 (iPhone; CPU iPhone OS 17_1 like Mac OS X) '
+          'AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.1 '
+          'Mobile/15E148 Safari/604.1')
+BOT = 'Mozilla/5.0 (compatible; bingbot/2.0; +http://www.bing.com/bingbot.htm)'
+
+
+class UserAgentTestCase(TestCase):
+
+    def setUp(self):
+        UserAgent.objects.clear_cache()
+        self.now = timezone.now()
+
+    def test_parse_fallback(self):
+        self.assertEqual(_parse_fallback(CHROME), {
+            'browser': 'Chrome', 'os': 'Windows', 'device': 'Other',
+            'is_bot': False})
+        self.assertEqual(_parse_fallback(SAFARI), {
+            'browser': 'Safari', 'os': 'iOS', 'device': 'Mobile',
+            'is_bot': False})
+        self.assertTrue(_parse_fallback(BOT)['is_bot'])
+        self.assertEqual(_parse_fallback('')['browser'], 'Other')
+
+    def test_upsert(self):
+        Visitor.objects.upsert('A', '10.0.0.1', self.now, user_agent=CHROME)
+        Visitor.objects.upsert('B', '10.0.0.2', self.now, user_agent=CHROME)
+        Visitor.objects.upsert('B', '10.0.0.2', self.now)
+        self.assertEqual(UserAgent.objects.get().pk, text_hash(CHROME))
+        self.assertEqual(
+            list(Visitor.objects.values_list('agent_id', flat=True)),
+            [text_hash(CHROME)] * 2)
+
+    def test_save(self):
+        visitor = Visitor.objects.create(
+            session_key='A', ip_address='10.0.0.1', user_agent=SAFARI)
+        self.assertEqual(visitor.agent_id, text_hash(SAFARI))
+        self.assertEqual(
+            Visitor.objects.get(pk='A').agent.browser, 'Safari')
+
+    def test_browser_stats(self):
+        for session_key, user_agent in (('A', CHROME), ('B', CHROME),
+                                        ('C', SAFARI), ('D', BOT),
+                                        ('E', None)):
+            Visitor.objects.upsert(
+                session_key, '10.0.0.1', self.now, user_agent=user_agent)
+        end = self.now + timedelta(hours=1)
+
+        stats = Visitor.objects.browser_stats(self.now, end)
+        self.assertEqual(stats[0]['browser'], 'Chrome')
+        self.assertCountEqual(
+            [(row['browser'], row['total']) for row in stats],
+            [('Chrome', 2), ('Safari', 1), (None, 1)])
+        stats = Visitor.objects.browser_stats(self.now, end, include_bots=True)
+        self.assertEqual(len(stats), 4)
@@ -1,7 +1,7 @@
 from django.test import TestCase
 from unittest.mock import Mock
 
-from tracking.utils import get_ip_address
+from tracking.utils import PatternList, compile_patterns, get_ip_address
 
 
 class UtilsTestCase(TestCase):
@@ -12,3 +12,29 @@ class UtilsTestCase(TestCase):
         self.assertEqual(get_ip_address(r), '2001:0DB8:0:CD30::')
         r = Mock(META={'HTTP_X_CLUSTERED_CLIENT_IP': '10.0.0.1, 10.1.1.1'})
         self.assertEqual(get_ip_address(r), '10.0.0.1')
+
+    def test_compile_patterns(self):
+        self.assertEqual(compile_patterns([]), None)
+        pattern = compile_patterns([r'^(favicon\.ico|robots\.txt)$', 'foo'])
+        self.assertTrue(pattern.match('robots.txt'))
+        self.assertTrue(pattern.match('foo/bar'))
+        self.assertFalse(pattern.match('bar/foo'))
+        self.assertFalse(pattern.match('robots.txt.bak'))
+
+    def test_compile_patterns_separately(self):
+        # a backreference, a repeated group name and an inline global flag
+        # each keep their meaning
+        pattern = compile_patterns([
+            r'(a)\1', r'(?P<x>b)', r'(?P<x>c)', r'(?i)d',
+        ])
+        self.assertTrue(pattern.match('aa'))
+        self.assertFalse(pattern.match('ab'))
+        self.assertTrue(pattern.match('b'))
+        self.assertTrue(pattern.match('c'))
+        self.assertTrue(pattern.match('D'))
+        self.assertFalse(pattern.match('e'))
+
+        pattern = compile_patterns(['foo', '(?i)bar'])
+        self.assertIsInstance(pattern, PatternList)
+        self.assertTrue(pattern.match('BAR'))
+        self.assertFalse(pattern.match('FOO'))
@@ -1,13 +1,20 @@
-from datetime import timedelta
-from unittest.mock import patch
+import gzip
+import json
+from datetime import datetime, timedelta, timezone as dt_timezone
+from io import StringIO
+from unittest.mock import Mock, patch
 
 from django.contrib.admin.sites import AdminSite
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
 from django.test import TestCase
 from django.utils.timezone import now
 
 from tracking.admin import VisitorAdmin
-from tracking.models import Visitor
+from tracking.handlers import track_ended_session
+from tracking.models import Visitor, Pageview
+from tracking.views import get_track_start_time
 
 
 class ViewsTestCase(TestCase):
@@ -47,6 +54,16 @@ class ViewsTestCase(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertContains(response, 'Enter a valid date/time.')
 
+    @patch('tracking.views.TRACK_CACHE_STATS', True)
+    def test_track_start_time_cached(self):
+        cache.clear()
+        self.assertIsNone(get_track_start_time())
+        visitor = Visitor.objects.create(
+            session_key='A', ip_address='10.0.0.1')
+        self.assertEqual(get_track_start_time(), visitor.start_time)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_track_start_time(), visitor.start_time)
+
     @patch('tracking.handlers.timezone.now', autospec=True)
     def test_logout_tracking(self, mock_end):
         # logout should call post-logout signal
@@ -59,7 +76,9 @@ class ViewsTestCase(TestCase):
 
         # ... now we have!
         self.client.login(**self.auth)
+        mock_end.return_value = self.now - timedelta(seconds=30)
         self.client.get('/tracking/')
+        mock_end.return_value = self.now
         self.client.logout()
 
         self.assertEqual(Visitor.objects.count(), 1)
@@ -90,3 +109,154 @@ class AdminViewTestCase(TestCase):
         visitor.time_on_site = 30
         time_on_site = timedelta(seconds=30)
         self.assertEqual(admin.pretty_time_on_site(visitor), time_on_site)
+
+
+class ExportTestCase(TestCase):
+
+    def setUp(self):
+        self.auth = {'username': 'john', 'password': 'smith'}
+        user = User.objects.create_user(**self.auth)
+        user.is_superuser = True
+        user.save()
+        self.assertTrue(self.client.login(**self.auth))
+        self.visitor = Visitor.objects.create(
+            session_key='A', ip_address='10.0.0.1', user=user,
+            start_time=datetime(2014, 11, 3, tzinfo=dt_timezone.utc))
+        Pageview.objects.create(
+            visitor=self.visitor, url='/a,b/', view_time=self.visitor.start_time)
+
+    def content(self, response):
+        return b''.join(response.streaming_content)
+
+    def test_export_csv(self):
+        response = self.client.get('/tracking/export/pageviews/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        lines = self.content(response).decode().splitlines()
+        self.assertEqual(lines[0].split(',')[:3], ['id', 'visitor_id', 'url'])
+        self.assertIn('A,"/a,b/"', lines[1])
+
+    def test_export_jsonl_gzip(self):
+        response = self.client.get(
+            '/tracking/export/visitors/?format=jsonl&gzip=1&end=2014-12')
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        rows = [json.loads(line) for line in gzip.decompress(
+            self.content(response)).decode().splitlines()]
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['session_key'], 'A')
+        self.assertEqual(rows[0]['start_time'], '2014-11-03T00:00:00Z')
+
+    def test_export_range(self):
+        response = self.client.get(
+            '/tracking/export/visitors/?start=2014-12&end=2015')
+        self.assertEqual(len(self.content(response).splitlines()), 1)
+        response = self.client.get('/tracking/export/visitors/?start=bad')
+        self.assertEqual(response.status_code, 400)
+
+    def test_export_command(self):
+        stdout = StringIO()
+        call_command('tracking_export', 'visitors', format='jsonl',
+                     until=datetime(2014, 11, 4, tzinfo=dt_timezone.utc),
+                     stdout=stdout)
+        self.assertEqual(len(stdout.getvalue().splitlines()), 1)
+
+    def test_export_permission(self):
+        self.client.logout()
+        response = self.client.get('/tracking/export/visitors/')
+        self.assertEqual(response.status_code, 302)
+
+
+class StatsAPITestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.auth = {'username': 'john', 'password': 'smith'}
+        self.user = User.objects.create_user(**self.auth)
+        self.user.is_superuser = True
+        self.user.save()
+        self.assertTrue(self.client.login(**self.auth))
+        self.visitor = Visitor.objects.create(
+            session_key='A', ip_address='10.0.0.1', user=self.user,
+            start_time=datetime(2014, 11, 3, tzinfo=dt_timezone.utc),
+            time_on_site=90)
+        Pageview.objects.create(
+            visitor=self.visitor, url='/', view_time=self.visitor.start_time)
+        self.query = '?start=2014-11-01&end=2014-12-01'
+
+    def test_visitors(self):
+        response = self.client.get('/tracking/api/visitors/' + self.query)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['stats']['total'], 1)
+        self.assertEqual(data['stats']['time_on_site'], 90)
+        self.assertEqual(data['start'], '2014-11-01T00:00:00Z')
+
+    def test_users(self):
+        response = self.client.get('/tracking/api/users/' + self.query)
+        self.assertEqual(response.json()['stats'], [{
+            'id': self.user.pk, 'username': 'john', 'visit_count': 1,
+            'time_on_site': 90, 'pages_per_visit': 1.0}])
+
+    def test_not_modified(self):
+        url = '/tracking/api/pageviews/' + self.query
+        response = self.client.get(url)
+        self.assertEqual(response.json()['stats']['total'], 1)
+        etag = response['ETag']
+
+        # the API requests themselves are not tracked
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        Pageview.objects.create(
+            visitor=self.visitor, url='/a/',
+            view_time=self.visitor.start_time + timedelta(hours=1))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['stats']['total'], 2)
+
+    def test_not_modified_refresh(self):
+        url = '/tracking/api/visitors/' + self.query
+        etag = self.client.get(url)['ETag']
+
+        # a visitor refresh bumps the visitors version
+        Visitor.objects.upsert(
+            'A', '10.0.0.1', self.visitor.start_time + timedelta(minutes=2),
+            expiry_time=self.visitor.start_time + timedelta(hours=1))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['stats']['time_on_site'], 120)
+        etag = response['ETag']
+
+        # and so does ending it on logout
+        request = Mock(session=Mock(session_key='A'))
+        track_ended_session(sender=None, request=request, user=self.user)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_not_modified_default_end(self):
+        url = '/tracking/api/visitors/'
+        start = datetime(2014, 11, 3, 10, 0, 30, tzinfo=dt_timezone.utc)
+        with patch('tracking.views.now', return_value=start):
+            response = self.client.get(url)
+        etag = response['ETag']
+        self.assertEqual(response.json()['end'], '2014-11-03T10:00:00Z')
+
+        # the same end until the next minute
+        with patch('tracking.views.now',
+                   return_value=start + timedelta(seconds=20)):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        with patch('tracking.views.now',
+                   return_value=start + timedelta(seconds=40)):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_invalid(self):
+        response = self.client.get('/tracking/api/visitors/?start=bad')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('start', response.json()['errors'])
+
+    def test_permission(self):
+        self.client.logout()
+        response = self.client.get('/tracking/api/visitors/')
+        self.assertEqual(response.status_code, 403)
@@ -0,0 +1,81 @@
+from unittest.mock import patch
+
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+
+from tracking.models import Visitor, Pageview
+from tracking.tests.test_buffer import make_hit
+from tracking.writer import STOP, BackgroundWriter
+
+
+class BackgroundWriterTestCase(TestCase):
+
+    def test_flush(self):
+        writer = BackgroundWriter(10, threads=0, batch_size=2)
+        for session_key in 'ABC':
+            self.assertTrue(writer.put(make_hit(session_key, timezone.now())))
+        self.assertEqual(writer.stats()['depth'], 3)
+
+        writer.flush()
+        self.assertEqual(Visitor.objects.count(), 3)
+        self.assertEqual(writer.stats(), {
+            'depth': 0, 'written': 3, 'dropped': 0, 'failed': 0})
+
+    def test_overflow_drop(self):
+        writer = BackgroundWriter(1, threads=0)
+        self.assertTrue(writer.put(make_hit('A', timezone.now())))
+        self.assertFalse(writer.put(make_hit('B', timezone.now())))
+        self.assertEqual(writer.stats()['dropped'], 1)
+
+    def test_overflow_sample(self):
+        writer = BackgroundWriter(4, threads=0, overflow='sample',
+                                  sample_rate=0.5)
+        with patch('tracking.writer.random.random', side_effect=[0.9, 0.1]):
+            for session_key in 'ABCD':
+                writer.put(make_hit(session_key, timezone.now()))
+        # the queue is half full after two hits, then one in two is kept
+        self.assertEqual(writer.stats()['depth'], 3)
+        self.assertEqual(writer.stats()['dropped'], 1)
+
+    def test_overflow_unknown(self):
+        with self.assertRaises(ValueError):
+            BackgroundWriter(1, threads=0, overflow='wait')
+        with self.assertRaises(ValueError):
+            BackgroundWriter(1, threads=0, overflow='block')
+
+    def test_middleware(self):
+        writer = BackgroundWriter(10, threads=0)
+        with patch('tracking.middleware.TRACK_BACKGROUND_WRITES', True), \
+                patch('tracking.middleware.writer', writer):
+            self.client.get('/')
+        self.assertEqual(Visitor.objects.count(), 0)
+
+        writer.flush()
+        self.assertEqual(Visitor.objects.count(), 1)
+        self.assertEqual(Pageview.objects.count(), 1)
+
+
+class BackgroundWriterThreadTestCase(TransactionTestCase):
+
+    def test_stop(self):
+        writer = BackgroundWriter(10, threads=1, batch_size=2, timeout=0.1)
+        for session_key in 'ABC':
+            writer.put(make_hit(session_key, timezone.now()))
+        writer.stop()
+        self.assertEqual(Visitor.objects.count(), 3)
+        self.assertEqual(writer.stats()['written'], 3)
+
+    def test_restart_after_fork(self):
+        writer = BackgroundWriter(10, threads=1)
+        writer._start()
+        parent = writer._workers[0]
+        with patch('tracking.writer.os.getpid', return_value=-1):
+            writer._start()
+        self.assertEqual(len(writer._workers), 1)
+        self.assertIsNot(writer._workers[0], parent)
+
+        writer.queue.put(STOP)
+        writer.queue.put(STOP)
+        for worker in (parent, writer._workers[0]):
+            worker.join(10)
+            self.assertFalse(worker.is_alive())
@@ -1,7 +1,11 @@
 from django.urls import re_path
 
-from tracking.views import dashboard
+from tracking.views import dashboard, export_view, stats_api
 
 urlpatterns = [
     re_path(r'^$', dashboard, name='tracking-dashboard'),
+    re_path(r'^export/(?P<name>visitors|pageviews)/$', export_view,
+            name='tracking-export'),
+    re_path(r'^api/(?P<name>visitors|pageviews|users)/$', stats_api,
+            name='tracking-stats-api'),
 ]
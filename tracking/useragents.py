@@ -0,0 +1,96 @@
+"""Parsing of user agent strings into their browser, OS and device family and
+whether they are a bot.
+
+The `user_agents` package (ua-parser) is used when it is installed, otherwise
+a handful of patterns recognize the common browsers and operating systems.
+The results of the most recent `TRACK_USER_AGENT_CACHE_SIZE` user agents are
+kept in memory. The returned dicts are shared between callers and must not
+be modified.
+"""
+import re
+from functools import lru_cache
+
+from tracking.settings import TRACK_USER_AGENT_CACHE_SIZE
+
+try:
+    from user_agents import parse
+    HAS_USER_AGENTS = True
+except ImportError:
+    HAS_USER_AGENTS = False
+
+# Also the family of anything not recognized, as with ua-parser
+OTHER = 'Other'
+
+# The first match wins, e.g. Edge and Chrome also claim to be Safari
+BROWSER_PATTERNS = (
+    ('Edge', r'Edg(?:e|A|iOS)?/'),
+    ('Opera', r'OPR/|Opera'),
+    ('Samsung Internet', r'SamsungBrowser/'),
+    ('Chrome', r'Chrome/|CriOS/'),
+    ('Firefox', r'Firefox/|FxiOS/'),
+    ('Safari', r'Safari/'),
+    ('IE', r'MSIE |Trident/'),
+)
+OS_PATTERNS = (
+    ('iOS', r'iPhone|iPad|iPod'),
+    ('Android', r'Android'),
+    ('Windows', r'Windows'),
+    ('Mac OS X', r'Mac OS X'),
+    ('Chrome OS', r'CrOS'),
+    ('Linux', r'Linux'),
+)
+DEVICE_PATTERNS = (
+    ('Tablet', r'iPad|Tablet'),
+    ('Mobile', r'Mobi|iPhone|iPod|Android'),
+)
+BOT_RE = re.compile(
+    r'bot\b|bot/|crawl|spider|slurp|archiver|facebookexternalhit|'
+    r'headless|curl/|wget/|python-|java/|go-http-client|okhttp',
+    re.IGNORECASE)
+
+
+def _compile(patterns):
+    return tuple((name, re.compile(pattern)) for name, pattern in patterns)
+
+
+BROWSER_RES = _compile(BROWSER_PATTERNS)
+OS_RES = _compile(OS_PATTERNS)
+DEVICE_RES = _compile(DEVICE_PATTERNS)
+
+
+def _family(patterns, user_agent):
+    for name, pattern in patterns:
+        if pattern.search(user_agent):
+            return name
+    return OTHER
+
+
+def _parse_fallback(user_agent):
+    is_bot = bool(BOT_RE.search(user_agent))
+    return {
+        'browser': _family(BROWSER_RES, user_agent),
+        'os': _family(OS_RES, user_agent),
+        'device': 'Spider' if is_bot else _family(DEVICE_RES, user_agent),
+        'is_bot': is_bot,
+    }
+
+
+@lru_cache(maxsize=TRACK_USER_AGENT_CACHE_SIZE)
+def parse_user_agent(user_agent):
+    """Returns the `browser`, `os` and `device` family of the user agent and
+    whether it `is_bot`.
+    """
+    if not HAS_USER_AGENTS:
+        return _parse_fallback(user_agent)
+
+    parsed = parse(user_agent)
+    return {
+        'browser': parsed.browser.family[:100],
+        'os': parsed.os.family[:100],
+        'device': parsed.device.family[:100],
+        'is_bot': parsed.is_bot,
+    }
+
+
+def is_bot(user_agent):
+    return bool(user_agent) and parse_user_agent(user_agent)['is_bot']
@@ -1,7 +1,18 @@
 from __future__ import division
 
+import re
+from datetime import timedelta, timezone as dt_timezone
+from hashlib import blake2b
+
 from django.core.exceptions import ValidationError
 from django.core.validators import validate_ipv46_address
+from django.utils import timezone
+
+# Lengths of the rollup buckets, which are aligned to UTC
+PERIODS = {
+    'hour': timedelta(hours=1),
+    'day': timedelta(days=1),
+}
 
 headers = (
     'HTTP_CLIENT_IP', 'HTTP_X_FORWARDED_FOR', 'HTTP_X_FORWARDED',
@@ -25,3 +36,73 @@ def get_ip_address(request):
 def total_seconds(delta):
     day_seconds = (delta.days * 24 * 3600) + delta.seconds
     return (delta.microseconds + day_seconds * 10**6) / 10**6
+
+
+# Numbered backreferences and conditionals, whose group numbers would shift
+# once the patterns are combined
+NUMBERED_GROUP_RE = re.compile(r'\\[1-9]|\\g<\d|\(\?\(\d')
+
+
+class PatternList(object):
+    "Matches a string against several compiled patterns in turn."
+    def __init__(self, patterns):
+        self.patterns = patterns
+
+    def match(self, string):
+        for pattern in self.patterns:
+            match = pattern.match(string)
+            if match:
+                return match
+        return None
+
+
+def compile_patterns(patterns, flags=0):
+    """Compiles regular expressions into a single alternation so a string is
+    matched against all of them in one pass. Returns None if there are no
+    patterns.
+
+    Patterns that cannot be combined, e.g. with numbered backreferences,
+    duplicate group names or inline global flags, are matched one by one
+    instead.
+    """
+    if not patterns:
+        return None
+    compiled = [re.compile(p, flags) for p in patterns]
+    # Before Python 3.11 an inline global flag after the start of the
+    # alternation only warns and applies to all of it, look for them here
+    default = re.compile('', flags).flags
+    if not any(
+        NUMBERED_GROUP_RE.search(p) or c.flags != default
+        for p, c in zip(patterns, compiled)
+    ):
+        try:
+            return re.compile('|'.join('(?:%s)' % p for p in patterns), flags)
+        except re.error:
+            pass
+    return PatternList(compiled)
+
+
+def floor_time(value, period):
+    "Returns the start of the `period` bucket `value` falls in."
+    if timezone.is_aware(value):
+        value = value.astimezone(dt_timezone.utc)
+    value = value.replace(minute=0, second=0, microsecond=0)
+    if period == 'day':
+        value = value.replace(hour=0)
+    return value
+
+
+def ceil_time(value, period):
+    "Returns the start of the first `period` bucket at or after `value`."
+    floor = floor_time(value, period)
+    if floor < value:
+        floor += PERIODS[period]
+    return floor
+
+
+def text_hash(value):
+    """Returns the 63 bit hash identifying a URL or user agent in the `Url`
+    and `UserAgent` tables.
+    """
+    digest = blake2b(value.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') >> 1
@@ -1,14 +1,30 @@
+import hashlib
 import logging
+import sys
 
 from datetime import timedelta
 
 from django import forms
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import (
+    Http404, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse,
+)
 from django.shortcuts import render
 from django.contrib.auth.decorators import permission_required
+from django.core.cache import cache
+from django.db.models import Max, Min
 from django.utils.timezone import now
+from django.views.decorators.http import condition
 
+from tracking.cache import stats_cache_key, stats_version, visitors_version
+from tracking.decorators import tracking_exempt
+from tracking.export import EXPORTS, FORMATS, export
 from tracking.models import Visitor, Pageview
-from tracking.settings import TRACK_PAGEVIEWS
+from tracking.settings import (
+    TRACK_CACHE_STATS,
+    TRACK_DASHBOARD_USER_LIMIT,
+    TRACK_PAGEVIEWS,
+)
 
 log = logging.getLogger(__file__)
 
@@ -27,10 +43,24 @@ class DashboardForm(forms.Form):
     end = forms.DateTimeField(required=False, input_formats=input_formats)
 
 
+def get_track_start_time():
+    "Returns the start time of the first visitor, cached with the stats."
+    key = stats_cache_key('track_start_time') if TRACK_CACHE_STATS else None
+    start_time = key and cache.get(key)
+    if start_time is None:
+        start_time = Visitor.objects.aggregate(
+            first=Min('start_time'))['first']
+        if key and start_time is not None:
+            cache.set(key, start_time, None)
+    return start_time
+
+
 @permission_required('tracking.visitor_log')
 def dashboard(request):
     "Counts, aggregations and more!"
-    end_time = now()
+    # The default range moves by whole intervals, as with the stats API, so
+    # the cached stats of the last week are reused meanwhile
+    end_time = stats_end_time()
     start_time = end_time - timedelta(days=7)
     defaults = {'start': start_time, 'end': end_time}
 
@@ -40,17 +70,14 @@ def dashboard(request):
         end_time = form.cleaned_data['end']
 
     # determine when tracking began
-    try:
-        obj = Visitor.objects.order_by('start_time')[0]
-        track_start_time = obj.start_time
-    except (IndexError, Visitor.DoesNotExist):
-        track_start_time = now()
+    track_start_time = get_track_start_time() or now()
 
     # If the start_date is before tracking began, warn about incomplete data
     warn_incomplete = (start_time < track_start_time)
 
     # queries take `date` objects (for now)
-    user_stats = Visitor.objects.user_stats(start_time, end_time)
+    user_stats = Visitor.objects.user_stats(
+        start_time, end_time, limit=TRACK_DASHBOARD_USER_LIMIT)
     visitor_stats = Visitor.objects.stats(start_time, end_time)
     if TRACK_PAGEVIEWS:
         pageview_stats = Pageview.objects.stats(start_time, end_time)
@@ -66,3 +93,131 @@ def dashboard(request):
         'pageview_stats': pageview_stats,
     }
     return render(request, 'tracking/dashboard.html', context)
+
+
+class ExportForm(DashboardForm):
+    format = forms.ChoiceField(
+        required=False, choices=[(name, name) for name in sorted(FORMATS)])
+    gzip = forms.BooleanField(required=False)
+
+
+@permission_required('tracking.visitor_log')
+def export_view(request, name):
+    "Streams the visitors or pageviews of a date range as CSV or JSON lines."
+    if name not in EXPORTS:
+        raise Http404
+
+    form = ExportForm(data=request.GET)
+    if not form.is_valid():
+        return HttpResponseBadRequest(
+            form.errors.as_text(), content_type='text/plain')
+    data = form.cleaned_data
+    format = data['format'] or 'csv'
+
+    filename = 'tracking-{0}.{1}'.format(name, format)
+    content_type = FORMATS[format]
+    if data['gzip']:
+        filename += '.gz'
+        content_type = 'application/gzip'
+
+    response = StreamingHttpResponse(
+        export(name, data['start'], data['end'], format, data['gzip']),
+        content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename="{0}"'.format(
+        filename)
+    return response
+
+
+class StatsForm(DashboardForm):
+    registered_only = forms.BooleanField(required=False)
+    limit = forms.IntegerField(required=False, min_value=0)
+    offset = forms.IntegerField(required=False, min_value=0)
+
+
+class StatsEncoder(DjangoJSONEncoder):
+    "Serializes timedeltas, e.g. the time on site, as seconds."
+    def default(self, o):
+        if isinstance(o, timedelta):
+            return o.total_seconds()
+        return super(StatsEncoder, self).default(o)
+
+
+STATS_APIS = ('visitors', 'pageviews', 'users')
+
+# Without an explicit end, the stats APIs end at the current time rounded
+# down to this many seconds, so the ETag of the range can be computed
+STATS_END_INTERVAL = 60
+
+
+def stats_end_time():
+    "The default end of the stats API ranges, see `STATS_END_INTERVAL`."
+    end_time = now()
+    return end_time - timedelta(
+        seconds=end_time.timestamp() % STATS_END_INTERVAL)
+
+
+def _md5(data):
+    # Only a fingerprint, which keeps it usable where MD5 is restricted
+    if sys.version_info >= (3, 9):
+        return hashlib.md5(data, usedforsecurity=False)
+    return hashlib.md5(data)
+
+
+def stats_etag(request, name):
+    """The stats only change when visitors are added, which moves their
+    latest start time, when they are refreshed or ended, which bumps the
+    visitors version, when pageviews are added, which moves the latest view
+    time, when the default end of the range moves, or when the cached stats
+    are invalidated. Both maxima are read from an index.
+    """
+    parts = [name, request.GET.urlencode(), stats_version(),
+             visitors_version(),
+             Visitor.objects.aggregate(last=Max('start_time'))['last']]
+    if not request.GET.get('end'):
+        parts.append(stats_end_time())
+    if TRACK_PAGEVIEWS:
+        parts.append(Pageview.objects.aggregate(
+            last=Max('view_time'))['last'])
+    return _md5(repr(parts).encode('utf-8')).hexdigest()
+
+
+@tracking_exempt
+@permission_required('tracking.visitor_log', raise_exception=True)
+@condition(etag_func=stats_etag)
+def stats_api(request, name):
+    "Returns the visitor, pageview or user stats of a date range as JSON."
+    if name not in STATS_APIS:
+        raise Http404
+
+    form = StatsForm(data=request.GET)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+    data = form.cleaned_data
+    end_time = data['end'] or stats_end_time()
+    start_time = data['start'] or end_time - timedelta(days=7)
+
+    if name == 'visitors':
+        stats = Visitor.objects.stats(
+            start_time, end_time, data['registered_only'])
+    elif name == 'pageviews':
+        if not TRACK_PAGEVIEWS:
+            raise Http404
+        stats = Pageview.objects.stats(
+            start_time, end_time, data['registered_only'])
+    else:
+        limit = data['limit']
+        if limit is None:
+            limit = TRACK_DASHBOARD_USER_LIMIT
+        users = Visitor.objects.user_stats(
+            start_time, end_time, limit=limit, offset=data['offset'] or 0)
+        stats = [{
+            'id': user.pk,
+            'username': user.get_username(),
+            'visit_count': user.visit_count,
+            'time_on_site': user.time_on_site,
+            'pages_per_visit': user.pages_per_visit,
+        } for user in users]
+
+    return JsonResponse(
+        {'start': start_time, 'end': end_time, 'stats': stats},
+        encoder=StatsEncoder)
@@ -0,0 +1,183 @@
+import atexit
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+from django.db import close_old_connections
+
+from tracking.buffer import write_hits
+from tracking.sampling import sampler
+from tracking.settings import (
+    TRACK_BACKGROUND_WRITES,
+    TRACK_BUFFER_SIZE,
+    TRACK_BUFFER_TIMEOUT,
+    TRACK_WRITER_OVERFLOW,
+    TRACK_WRITER_QUEUE_SIZE,
+    TRACK_WRITER_SAMPLE_RATE,
+    TRACK_WRITER_THREADS,
+)
+
+log = logging.getLogger(__file__)
+
+OVERFLOW_POLICIES = ('drop', 'block', 'sample')
+
+# Tells a worker thread to exit
+STOP = object()
+
+
+class BackgroundWriter(object):
+    """Writes hits from a bounded queue in worker threads, off the request.
+
+    Each worker takes up to `batch_size` hits, waiting at most `timeout`
+    seconds for a batch to fill, and writes them with its own database
+    connection. When the queue is full a new hit is dropped (`drop`) or the
+    request waits for room (`block`). With `sample` only a `sample_rate`
+    fraction of hits is queued once the queue is half full, and hits are
+    dropped when it is full.
+    """
+    def __init__(self, maxsize, threads, overflow='drop', sample_rate=0.1,
+                 batch_size=100, timeout=5):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy "{0}"'.format(overflow))
+        if overflow == 'block' and not threads:
+            # Nothing would ever make room in the queue
+            raise ValueError('The "block" overflow policy needs threads')
+        self.queue = queue.Queue(maxsize)
+        self.threads = threads
+        self.overflow = overflow
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self._workers = []
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def stats(self):
+        "Returns the queue depth and the hit counters."
+        return {
+            'depth': self.queue.qsize(),
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
+
+    def put(self, hit):
+        "Queues a hit, returns False if it was dropped."
+        self._start()
+
+        if self.overflow == 'block':
+            self.queue.put(hit)
+            return True
+
+        if (
+            self.overflow == 'sample'
+            and self.queue.qsize() * 2 >= self.queue.maxsize
+            and random.random() >= self.sample_rate
+        ):
+            self._count('dropped', 1)
+            return False
+
+        try:
+            self.queue.put_nowait(hit)
+        except queue.Full:
+            self._count('dropped', 1)
+            return False
+        return True
+
+    def flush(self):
+        "Writes all queued hits in the calling thread."
+        hits = []
+        while True:
+            try:
+                hit = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if hit is not STOP:
+                hits.append(hit)
+            if len(hits) >= self.batch_size:
+                self._write(hits)
+                hits = []
+        self._write(hits)
+
+    def stop(self, timeout=10):
+        "Stops the worker threads and writes whatever is left in the queue."
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for _ in workers:
+            self.queue.put(STOP)
+        for worker in workers:
+            worker.join(timeout)
+        self.flush()
+
+    def _start(self):
+        if len(self._workers) >= self.threads and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                # Threads do not survive a fork, e.g. by a preforking server,
+                # the child starts its own
+                self._pid = os.getpid()
+                self._workers = []
+            while len(self._workers) < self.threads:
+                worker = threading.Thread(
+                    target=self._run, name='tracking-writer', daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def _run(self):
+        while True:
+            hits, stop = self._next_batch()
+            try:
+                self._write(hits)
+            finally:
+                close_old_connections()
+            if stop:
+                return
+
+    def _next_batch(self):
+        hits = [self.queue.get()]
+        deadline = time.time() + self.timeout
+        while hits[-1] is not STOP and len(hits) < self.batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                hits.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        if hits[-1] is STOP:
+            return hits[:-1], True
+        return hits, False
+
+    def _write(self, hits):
+        if not hits:
+            return
+        started = time.time()
+        try:
+            write_hits(hits, throttle=True)
+        except Exception:
+            # Keep the worker alive, the hits are lost either way
+            log.exception('Error writing %d queued hits', len(hits))
+            self._count('failed', len(hits))
+        else:
+            self._count('written', len(hits))
+            sampler.record_latency((time.time() - started) / len(hits))
+
+    def _count(self, counter, n):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + n)
+
+
+writer = BackgroundWriter(
+    TRACK_WRITER_QUEUE_SIZE, TRACK_WRITER_THREADS,
+    overflow=TRACK_WRITER_OVERFLOW, sample_rate=TRACK_WRITER_SAMPLE_RATE,
+    batch_size=TRACK_BUFFER_SIZE, timeout=TRACK_BUFFER_TIMEOUT)
+
+if TRACK_BACKGROUND_WRITES:
+    atexit.register(writer.stop)